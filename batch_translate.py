@@ -0,0 +1,199 @@
+# 批量翻译脚本（无界面）
+# 目的：流式读取大文本文件或标准输入，按微批次分发给多个工作进程翻译，按原顺序输出
+# 用法示例：
+#   python batch_translate.py -d EN -m 2 -i corpus.en -o corpus.zh -w 4 -t 2
+#   cat corpus.en | python batch_translate.py -d EN > corpus.zh
+#   python batch_translate.py -d EN -i corpus.en -o corpus.zh --resume   # 崩溃后从断点继续
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import threading
+import multiprocessing as mp
+
+from translation_engine import MODEL_PATHS, BACKENDS, DECODING_PROFILES, DEFAULT_PROFILE, get_generate_kwargs
+
+# 工作进程中的模型（每个进程只加载一次）
+_worker_state = {}
+
+class WorkerInitError(RuntimeError):
+    """工作进程加载模型失败"""
+
+def init_worker(model_path, num_threads, generate_kwargs, quantize=False, backend="pytorch", direction="EN"):
+    """
+    工作进程初始化：限制线程数并加载模型
+    初始化函数抛出异常时Pool会不断重启工作进程，任务永远无法完成；
+    因此加载失败时只记录错误，由该进程收到的第一个任务抛出
+    """
+    try:
+        import torch
+        from translation_engine import load_model, load_length_ratio
+
+        torch.set_num_threads(num_threads)
+        model, tokenizer, device = load_model(model_path, quantize=quantize, backend=backend)
+        generate_kwargs = dict(generate_kwargs, length_ratio=load_length_ratio(model_path, tokenizer, direction))
+    except Exception as e:
+        _worker_state["error"] = f"{type(e).__name__}: {str(e)}"
+        return
+    _worker_state.update(
+        model=model, tokenizer=tokenizer, device=device, generate_kwargs=generate_kwargs
+    )
+
+def translate_batch(batch):
+    """
+    翻译一个微批次
+    batch: (批次编号, 行列表)
+    返回: (批次编号, 译文列表)
+    """
+    from translation_engine import translate_sentences
+
+    if "error" in _worker_state:
+        raise WorkerInitError(f"工作进程加载模型失败: {_worker_state['error']}")
+    batch_id, lines = batch
+    results = translate_sentences(
+        lines,
+        _worker_state["model"],
+        _worker_state["tokenizer"],
+        _worker_state["device"],
+        **_worker_state["generate_kwargs"]
+    )
+    return batch_id, results
+
+def read_batches(stream, batch_lines, skip_lines=0):
+    """
+    流式读取输入并切分为微批次
+    stream: 输入流
+    batch_lines: 每个微批次的行数
+    skip_lines: 断点续传时跳过的行数
+    返回: (批次编号, 行列表) 生成器
+    """
+    lines = (line.rstrip("\r\n") for line in itertools.islice(stream, skip_lines, None))
+    for batch_id in itertools.count():
+        batch = list(itertools.islice(lines, batch_lines))
+        if not batch:
+            return
+        yield batch_id, batch
+
+def bounded(iterable, semaphore):
+    """限制同时在途的批次数，避免Pool.imap一次性读入整个输入文件"""
+    for item in iterable:
+        semaphore.acquire()
+        yield item
+
+def load_progress(progress_path):
+    """读取断点信息，返回(已完成输入行数, 输出文件字节偏移)"""
+    if not os.path.exists(progress_path):
+        return 0, 0
+    with open(progress_path, "r", encoding="utf-8") as f:
+        progress = json.load(f)
+    return progress["lines"], progress["offset"]
+
+def save_progress(progress_path, lines, offset):
+    """原子地写入断点信息"""
+    tmp_path = progress_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"lines": lines, "offset": offset}, f)
+    os.replace(tmp_path, progress_path)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="批量翻译文本文件或标准输入（每行一条）")
+    parser.add_argument("-d", "--direction", choices=["EN", "CN"], default="EN",
+                        help="翻译方向：EN英译中，CN中译英")
+    parser.add_argument("-m", "--model", choices=["1", "2"], default="1",
+                        help="模型类型：1小数据量模型，2全量数据模型")
+    parser.add_argument("--model-path", default=None, help="直接指定模型路径（优先于--model）")
+    parser.add_argument("-i", "--input", default="-", help="输入文件，默认从标准输入读取")
+    parser.add_argument("-o", "--output", default="-", help="输出文件，默认写到标准输出")
+    parser.add_argument("-w", "--workers", type=int, default=max(1, (os.cpu_count() or 1) // 2),
+                        help="工作进程数")
+    parser.add_argument("-t", "--threads", type=int, default=None,
+                        help="每个工作进程的PyTorch线程数，默认按CPU核数均分")
+    parser.add_argument("-b", "--batch-lines", type=int, default=64, help="每个微批次的行数")
+    parser.add_argument("-p", "--profile", choices=DECODING_PROFILES, default=DEFAULT_PROFILE,
+                        help="解码策略：fast贪心，balanced小束宽，quality完整束搜索")
+    parser.add_argument("--num-beams", type=int, default=None, help="束搜索宽度，覆盖解码策略中的设置")
+    parser.add_argument("--int8", action="store_true", help="使用CPU INT8动态量化模型")
+    parser.add_argument("--backend", choices=BACKENDS, default="pytorch",
+                        help="推理后端：pytorch或onnx（onnxruntime CPU）")
+    parser.add_argument("--resume", action="store_true", help="从上次中断的位置继续（需要指定输出文件）")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    model_path = args.model_path or MODEL_PATHS[(args.model, args.direction)]
+    if not os.path.exists(model_path):
+        print(f"模型路径不存在: {model_path}", file=sys.stderr)
+        return 1
+
+    workers = max(1, args.workers)
+    threads = args.threads or max(1, (os.cpu_count() or 1) // workers)
+    generate_kwargs = get_generate_kwargs(args.profile)
+    if args.num_beams:
+        generate_kwargs["num_beams"] = args.num_beams
+
+    # 断点续传只支持输出到文件
+    progress_path = None
+    done_lines, offset = 0, 0
+    if args.output != "-":
+        progress_path = args.output + ".progress"
+        if args.resume:
+            done_lines, offset = load_progress(progress_path)
+    elif args.resume:
+        print("断点续传需要使用 -o 指定输出文件", file=sys.stderr)
+        return 1
+
+    if args.output == "-":
+        out = sys.stdout
+    else:
+        out = open(args.output, "r+" if args.resume and os.path.exists(args.output) else "w", encoding="utf-8")
+        # 丢弃断点之后写了一半的输出
+        out.seek(offset)
+        out.truncate()
+
+    source = sys.stdin if args.input == "-" else open(args.input, "r", encoding="utf-8")
+
+    print(f"模型: {model_path}，工作进程: {workers}，每进程线程: {threads}，"
+          f"微批次: {args.batch_lines}行，已完成: {done_lines}行", file=sys.stderr)
+
+    start_time = time.time()
+    translated_lines = 0
+    # 每个工作进程最多保留两个在途批次
+    semaphore = threading.BoundedSemaphore(workers * 2)
+    ctx = mp.get_context("spawn")
+    try:
+        with ctx.Pool(workers, initializer=init_worker,
+                      initargs=(model_path, threads, generate_kwargs, args.int8, args.backend, args.direction)) as pool:
+            batches = bounded(read_batches(source, args.batch_lines, done_lines), semaphore)
+            # imap按提交顺序返回结果，保证输出顺序与输入一致
+            for batch_id, results in pool.imap(translate_batch, batches):
+                semaphore.release()
+                for line in results:
+                    out.write(line.replace("\n", " ") + "\n")
+                out.flush()
+
+                translated_lines += len(results)
+                if progress_path:
+                    os.fsync(out.fileno())
+                    save_progress(progress_path, done_lines + translated_lines, out.tell())
+
+                elapsed = time.time() - start_time
+                print(f"\r已翻译 {done_lines + translated_lines} 行，"
+                      f"{translated_lines / elapsed:.1f} 行/秒", end="", file=sys.stderr)
+    except WorkerInitError as e:
+        print(f"\n{str(e)}", file=sys.stderr)
+        return 1
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if out is not sys.stdout:
+            out.close()
+
+    print(f"\n翻译完成，共 {translated_lines} 行，用时 {time.time() - start_time:.1f} 秒", file=sys.stderr)
+    if progress_path and os.path.exists(progress_path):
+        os.remove(progress_path)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
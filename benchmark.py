@@ -0,0 +1,373 @@
+# 离线性能基准测试
+# 目的：在不同批量大小、束宽、线程数和推理后端下测量翻译延迟和吞吐量，并与保存的基线对比发现性能退化
+# 默认用dataset语料训练的SentencePiece分词器和随机初始化的小型Marian模型，完全离线运行
+# 用法示例：
+#   python benchmark.py                                          # 随机小模型，默认参数扫描
+#   python benchmark.py --models real -m 2 -d EN                 # 使用./train*/中训练好的模型
+#   python benchmark.py --save-baseline benchmark_baseline.json  # 保存为基线
+#   python benchmark.py --baseline benchmark_baseline.json       # 与基线对比，有退化时返回1
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import shutil
+import tempfile
+import resource
+import importlib.util
+import multiprocessing as mp
+
+from translation_config import MODEL_PATHS
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dataset")
+CLI_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "translator(无gui备份).py")
+VARIANTS = ("pytorch", "int8", "onnx")  # int8为PyTorch动态量化模型
+PATHS = ("gui", "cli")                  # gui: 分桶批量翻译；cli: 命令行翻译器逐句翻译
+CLI_PROFILE_BEAMS = {"fast": 1, "balanced": 2, "quality": 5}  # 命令行翻译器只能按解码策略选择束宽
+DEFAULT_TOLERANCE = 0.15                # 吞吐量下降或p95延迟上升超过该比例视为退化
+
+# 随机小模型的结构（只用于测量推理开销，不追求翻译质量）
+TINY_VOCAB_SIZE = 4000
+TINY_CONFIG = {
+    "d_model": 128,
+    "encoder_layers": 2,
+    "decoder_layers": 2,
+    "encoder_attention_heads": 4,
+    "decoder_attention_heads": 4,
+    "encoder_ffn_dim": 512,
+    "decoder_ffn_dim": 512,
+    "max_position_embeddings": 512,
+}
+
+def read_corpus(direction, limit=None):
+    """读取源语言句子，EN方向为英文，CN方向为中文"""
+    name = "data.en" if direction == "EN" else "data.zh"
+    with open(os.path.join(DATA_DIR, name), "r", encoding="utf-8") as f:
+        lines = [line.strip() for line in f if line.strip()]
+    return lines[:limit] if limit else lines
+
+def train_spm(language, work_dir):
+    """用dataset语料训练SentencePiece模型（已存在时直接返回）"""
+    import sentencepiece as spm
+
+    prefix = os.path.join(work_dir, f"spm_{language}")
+    if not os.path.exists(prefix + ".model"):
+        spm.SentencePieceTrainer.train(
+            input=os.path.join(DATA_DIR, f"data.{language}"),
+            model_prefix=prefix,
+            vocab_size=TINY_VOCAB_SIZE,
+            model_type="unigram",
+            character_coverage=0.9995 if language == "zh" else 1.0,
+            bos_id=-1, eos_id=-1, unk_id=0,
+            minloglevel=2,
+        )
+    return prefix + ".model"
+
+def build_tiny_model(direction, work_dir, seed=0):
+    """
+    构建随机初始化的小型Marian模型和分词器（已存在时直接返回）
+    返回: 模型目录
+    """
+    import torch
+    import sentencepiece as spm
+    from transformers import MarianConfig, MarianMTModel, MarianTokenizer
+
+    model_dir = os.path.join(work_dir, f"tiny_{'en_zh' if direction == 'EN' else 'zh_en'}")
+    if os.path.exists(os.path.join(model_dir, "config.json")):
+        return model_dir
+
+    source_lang, target_lang = ("en", "zh") if direction == "EN" else ("zh", "en")
+    source_spm = train_spm(source_lang, work_dir)
+    target_spm = train_spm(target_lang, work_dir)
+
+    # Marian的两个SentencePiece模型共用一个词表：</s>、<unk>在前，<pad>在最后
+    vocab = {"</s>": 0, "<unk>": 1}
+    for spm_file in (source_spm, target_spm):
+        processor = spm.SentencePieceProcessor(model_file=spm_file)
+        for i in range(processor.get_piece_size()):
+            vocab.setdefault(processor.id_to_piece(i), len(vocab))
+    vocab["<pad>"] = len(vocab)
+
+    os.makedirs(model_dir, exist_ok=True)
+    vocab_file = os.path.join(work_dir, f"vocab_{direction}.json")
+    with open(vocab_file, "w", encoding="utf-8") as f:
+        json.dump(vocab, f, ensure_ascii=False)
+    tokenizer = MarianTokenizer(source_spm=source_spm, target_spm=target_spm, vocab=vocab_file)
+    tokenizer.save_pretrained(model_dir)
+
+    torch.manual_seed(seed)
+    config = MarianConfig(
+        vocab_size=len(vocab), decoder_vocab_size=len(vocab),
+        pad_token_id=vocab["<pad>"], decoder_start_token_id=vocab["<pad>"],
+        eos_token_id=0, forced_eos_token_id=0, **TINY_CONFIG
+    )
+    MarianMTModel(config).save_pretrained(model_dir)
+    return model_dir
+
+def load_variant(model_path, variant, threads):
+    """加载指定变体的模型，返回(model, tokenizer, device)"""
+    from translation_engine import load_model, load_tokenizer
+
+    if variant == "onnx":
+        from onnx_backend import OnnxMarianModel
+        model = OnnxMarianModel(model_path, num_threads=threads)
+        return model, load_tokenizer(model_path), model.device
+    return load_model(model_path, quantize=variant == "int8")
+
+def export_onnx_model(model_path):
+    """在子进程中导出ONNX，导出过程的输出写到标准错误，不混入标准输出的JSON结果"""
+    from contextlib import redirect_stdout
+    from onnx_backend import export_onnx
+
+    with redirect_stdout(sys.stderr):
+        export_onnx(model_path)
+
+def load_cli_module():
+    """按文件路径导入命令行翻译器（文件名含括号，不能直接import）"""
+    spec = importlib.util.spec_from_file_location("cli_translator", CLI_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def percentile(values, q):
+    """线性插值的分位数"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * q
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+def peak_rss_mb():
+    """当前进程的峰值常驻内存（MB）"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux上单位为KB，macOS上为字节
+    return usage / (1 << 20) if sys.platform == "darwin" else usage / 1024
+
+def benchmark_configs(paths, beams, batch_sizes):
+    """
+    列出要测量的(翻译路径, 束宽, 批量大小)组合
+    命令行翻译器每次只翻译一句，且只能使用解码策略对应的束宽
+    """
+    configs = []
+    for path in paths:
+        for num_beams in beams:
+            if path == "cli":
+                if num_beams in CLI_PROFILE_BEAMS.values():
+                    configs.append((path, num_beams, 1))
+            else:
+                configs.extend((path, num_beams, batch_size) for batch_size in batch_sizes)
+    return configs
+
+def run_config(job):
+    """
+    在独立进程中测量一个配置，峰值内存只包含该配置下加载模型和翻译的内存占用
+    job: 参数字典
+    返回: 结果字典
+    """
+    import torch
+    from contextlib import redirect_stdout
+    from translation_engine import translate_sentences, load_length_ratio, DEFAULT_LENGTH_RATIO
+
+    torch.set_num_threads(job["threads"])
+    torch.manual_seed(0)
+    # 加载和量化模型时的输出写到标准错误，不混入标准输出的JSON结果
+    with redirect_stdout(sys.stderr):
+        model, tokenizer, device = load_variant(job["model_path"], job["variant"], job["threads"])
+        if job["models"] == "tiny":
+            # 随机模型的长度比例没有意义，使用固定值保证每次测量的工作量相同
+            length_ratio = DEFAULT_LENGTH_RATIO
+        else:
+            length_ratio = load_length_ratio(job["model_path"], tokenizer, job["direction"])
+    sentences = job["sentences"]
+    path, beams, batch_size = job["path"], job["beams"], job["batch_size"]
+
+    if path == "cli":
+        cli = load_cli_module()
+        profile = next(p for p, b in CLI_PROFILE_BEAMS.items() if b == beams)
+
+        def translate(batch):
+            return [cli.translate_text(batch[0], model, tokenizer, device,
+                                       profile=profile, length_ratio=length_ratio)]
+    else:
+        generate_kwargs = {"num_beams": beams}
+        if beams > 1:
+            generate_kwargs["early_stopping"] = True
+
+        def translate(batch):
+            return translate_sentences(batch, model, tokenizer, device, max_batch_size=batch_size,
+                                       length_ratio=length_ratio, **generate_kwargs)
+
+    # 预热一次，不计入统计
+    translate(sentences[:batch_size])
+    latencies = []
+    translated = 0
+    total_start = time.perf_counter()
+    for r in range(job["requests"]):
+        start = (r * batch_size) % max(1, len(sentences) - batch_size)
+        batch = sentences[start:start + batch_size]
+        request_start = time.perf_counter()
+        translate(batch)
+        latencies.append(time.perf_counter() - request_start)
+        translated += len(batch)
+    elapsed = time.perf_counter() - total_start
+
+    result = {
+        "path": path,
+        "variant": job["variant"],
+        "threads": job["threads"],
+        "batch_size": batch_size,
+        "beams": beams,
+        "requests": job["requests"],
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "sentences_per_s": round(translated / elapsed, 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    print(f"  {result_key(result)}: p50 {result['p50_ms']} ms，p95 {result['p95_ms']} ms，"
+          f"{result['sentences_per_s']} 句/秒，峰值内存 {result['peak_rss_mb']} MB", file=sys.stderr)
+    return result
+
+def result_key(result):
+    """用于与基线对应的配置键"""
+    return (f"{result['path']}/{result['variant']}/threads={result['threads']}"
+            f"/batch={result['batch_size']}/beams={result['beams']}")
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    与基线对比
+    返回: 退化的配置列表[(配置键, 说明)]
+    """
+    base = {result_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = base.get(result_key(result))
+        if old is None:
+            continue
+        if result["sentences_per_s"] < old["sentences_per_s"] * (1 - tolerance):
+            regressions.append((result_key(result),
+                                f"吞吐量 {old['sentences_per_s']} -> {result['sentences_per_s']} 句/秒"))
+        if result["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+            regressions.append((result_key(result), f"p95延迟 {old['p95_ms']} -> {result['p95_ms']} ms"))
+    return regressions
+
+def parse_args():
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="离线翻译性能基准测试")
+    parser.add_argument("--models", choices=["tiny", "real"], default="tiny",
+                        help="tiny: 随机初始化的小模型（离线）；real: ./train*/中训练好的模型")
+    parser.add_argument("-m", "--model", choices=["1", "2"], default="1",
+                        help="使用real模型时的模型类型：1小数据量模型，2全量数据模型")
+    parser.add_argument("--model-path", default=None, help="直接指定模型路径（优先于--models）")
+    parser.add_argument("-d", "--direction", choices=["EN", "CN"], default="EN", help="翻译方向")
+    parser.add_argument("--paths", nargs="+", choices=PATHS, default=list(PATHS),
+                        help="测试的翻译路径：gui分桶批量翻译，cli命令行逐句翻译")
+    parser.add_argument("--variants", nargs="+", choices=VARIANTS, default=list(VARIANTS), help="推理后端")
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 8, 32], help="每个请求的句子数")
+    parser.add_argument("--beams", nargs="+", type=int, default=[1, 5], help="束宽")
+    parser.add_argument("--threads", nargs="+", type=int, default=sorted({1, cpu_count}), help="PyTorch线程数")
+    parser.add_argument("--requests", type=int, default=10, help="每个配置测量的请求数")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "translator_benchmark"),
+                        help="随机小模型和训练好的模型副本的存放目录")
+    parser.add_argument("-o", "--output", default=None, help="结果JSON文件，默认输出到标准输出")
+    parser.add_argument("--baseline", default=None, help="基线JSON文件，与之对比并报告性能退化")
+    parser.add_argument("--save-baseline", default=None, help="把本次结果保存为基线")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="允许的性能波动比例")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    if args.model_path:
+        model_path = args.model_path
+    elif args.models == "real":
+        model_path = MODEL_PATHS[(args.model, args.direction)]
+    else:
+        os.makedirs(args.work_dir, exist_ok=True)
+        print("正在准备随机初始化的小模型...", file=sys.stderr)
+        model_path = build_tiny_model(args.direction, args.work_dir)
+    if not os.path.exists(model_path):
+        print(f"模型路径不存在: {model_path}", file=sys.stderr)
+        return 1
+
+    sentences = read_corpus(args.direction, limit=max(args.batch_sizes) * (args.requests + 1))
+    models = "real" if args.model_path or args.models == "real" else "tiny"
+
+    # 每个配置在独立进程中运行，峰值内存互不影响
+    ctx = mp.get_context("spawn")
+    configs = benchmark_configs(args.paths, args.beams, args.batch_sizes)
+    results = []
+    run_path = model_path
+    scratch_dir = None
+    try:
+        if models == "real":
+            # 训练好的模型复制到--work-dir下的临时目录中测试：safetensors转换、INT8量化结果、
+            # 长度比例和ONNX导出都写在副本中，测试结束后删除，不改动模型目录
+            os.makedirs(args.work_dir, exist_ok=True)
+            scratch_dir = tempfile.mkdtemp(prefix="real_model_", dir=args.work_dir)
+            run_path = os.path.join(scratch_dir, os.path.basename(os.path.normpath(model_path)))
+            print(f"正在把模型复制到 {run_path}...", file=sys.stderr)
+            shutil.copytree(model_path, run_path)
+        if "onnx" in args.variants:
+            from onnx_backend import ONNX_DIR, DECODER_WITH_PAST_FILE
+            if not os.path.exists(os.path.join(run_path, ONNX_DIR, DECODER_WITH_PAST_FILE)):
+                # 预先在单独的进程中导出，导出时的内存占用不计入测试配置的峰值内存
+                with ctx.Pool(1) as pool:
+                    pool.apply(export_onnx_model, (run_path,))
+        for variant in args.variants:
+            for threads in args.threads:
+                print(f"正在测试 {variant}，线程数 {threads}...", file=sys.stderr)
+                for path, beams, batch_size in configs:
+                    job = {
+                        "model_path": run_path, "models": models, "direction": args.direction,
+                        "variant": variant, "threads": threads,
+                        "path": path, "beams": beams, "batch_size": batch_size,
+                        "requests": args.requests, "sentences": sentences,
+                    }
+                    with ctx.Pool(1) as pool:
+                        results.append(pool.apply(run_config, (job,)))
+    finally:
+        if scratch_dir is not None:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+    import torch
+    report = {
+        "meta": {
+            "model_path": model_path,
+            "models": models,
+            "direction": args.direction,
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+
+    data = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(data)
+    else:
+        print(data)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            f.write(data)
+        print(f"基线已保存到 {args.save_baseline}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n发现{len(regressions)}处性能退化（允许波动 {args.tolerance:.0%}）：", file=sys.stderr)
+            for key, detail in regressions:
+                print(f"  {key}: {detail}", file=sys.stderr)
+            return 1
+        print(f"\n与基线相比没有性能退化（允许波动 {args.tolerance:.0%}）", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,310 @@
+# 离线的BLEU/chrF评分
+# 目的：训练评估原来用evaluate.load("sacrebleu")计算BLEU，需要联网下载指标脚本，离线机器上训练到评估时会失败。
+# 这里按sacreBLEU 2.x的默认设置实现语料级BLEU（13a/zh分词、exp平滑、4-gram）和chrF（字符6-gram、beta=2），
+# 只依赖标准库和NumPy，整个语料的n-gram一次性编码为NumPy数组后排序计数，分数与sacreBLEU一致
+# 用法示例：
+#   python bleu_scorer.py                 # 用内置的参考分数检查一致性
+#   python bleu_scorer.py --samples 2000  # 安装了sacrebleu时，另在dataset语料上与sacrebleu逐项对比
+import os
+import re
+import sys
+import math
+import argparse
+from functools import lru_cache
+
+import numpy as np
+
+MAX_NGRAM_ORDER = 4  # BLEU的最大n-gram阶数
+CHAR_ORDER = 6       # chrF的字符n-gram阶数
+CHRF_BETA = 2        # chrF中召回率的权重
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dataset")
+
+# 13a分词（mteval-v13a）：标点和符号两侧加空格，数字中的小数点、逗号和数字后的连字符除外
+_POST_TOKENIZE = [
+    (re.compile(r"([\{-\~\[-\` -\&\(-\+\:-\@\/])"), r" \1 "),
+    (re.compile(r"([^0-9])([\.,])"), r"\1 \2 "),
+    (re.compile(r"([\.,])([^0-9])"), r" \1 \2"),
+    (re.compile(r"([0-9])(-)"), r"\1 \2 "),
+]
+
+# zh分词按字切分的字符范围，与sacreBLEU的_UCODE_RANGES相同
+# sacreBLEU把扩展B区和兼容补充区写成了'\u20000'、'\u2f800'这样的5位转义（实际是两个字符的字符串），按字符串比较时
+# 实际匹配的是U+2001~U+2A6D和U+2F81~U+2FA1，这里照此保留，保证分词结果一致
+_ZH_RANGES = [
+    (0x3400, 0x4DB5), (0x4E00, 0x9FA5), (0x9FA6, 0x9FBB), (0xF900, 0xFA2D), (0xFA30, 0xFA6A),
+    (0xFA70, 0xFAD9), (0x2001, 0x2A6D), (0x2F81, 0x2FA1), (0xFF00, 0xFFEF), (0x2E80, 0x2EFF),
+    (0x3000, 0x303F), (0x31C0, 0x31EF), (0x2F00, 0x2FDF), (0x2FF0, 0x2FFF), (0x3100, 0x312F),
+    (0x31A0, 0x31BF), (0xFE10, 0xFE1F), (0xFE30, 0xFE4F), (0x2600, 0x26FF), (0x2700, 0x27BF),
+    (0x3200, 0x32FF), (0x3300, 0x33FF),
+]
+_ZH_CHAR = re.compile("([" + "".join(f"\\u{start:04x}-\\u{end:04x}" for start, end in _ZH_RANGES) + "])")
+
+def _post_tokenize(line):
+    for pattern, replacement in _POST_TOKENIZE:
+        line = pattern.sub(replacement, line)
+    return " ".join(line.split())
+
+@lru_cache(maxsize=2 ** 16)
+def tokenize_13a(line):
+    """sacreBLEU默认的13a分词"""
+    line = line.replace("<skipped>", "").replace("-\n", "").replace("\n", " ")
+    if "&" in line:
+        line = line.replace("&quot;", '"').replace("&amp;", "&").replace("&lt;", "<").replace("&gt;", ">")
+    return _post_tokenize(f" {line} ")
+
+@lru_cache(maxsize=2 ** 16)
+def tokenize_zh(line):
+    """sacreBLEU的zh分词：汉字和中文标点逐字切分，其余部分按13a规则分词"""
+    return _post_tokenize(_ZH_CHAR.sub(r" \1 ", line.strip()))
+
+TOKENIZERS = {"13a": tokenize_13a, "zh": tokenize_zh, "none": lambda line: line}
+
+def tokenize_for(target_lang):
+    """目标语言对应的分词方式（与sacreBLEU的推荐一致：中文用zh，其余用13a）"""
+    return "zh" if target_lang == "zh" else "13a"
+
+def _check_lengths(hypotheses, references):
+    if len(hypotheses) != len(references):
+        raise ValueError(f"译文和参考译文数量不一致（{len(hypotheses)}和{len(references)}）")
+
+def _clipped_matches(hyp_ids, hyp_lengths, ref_ids, ref_lengths, max_order):
+    """
+    统计整个语料1~max_order阶n-gram的截断匹配数：同一句中两侧都出现的n-gram按较小的出现次数计
+    n阶n-gram的编号由n-1阶编号和其后一个元素组合后重新编号得到，每阶只需对整数数组排序计数，不逐个n-gram循环
+    hyp_ids / ref_ids: 所有句子首尾相接的id数组
+    hyp_lengths / ref_lengths: 各句长度
+    返回: 长度为max_order的数组
+    """
+    matches = np.zeros(max_order, dtype=np.int64)
+    ids = np.concatenate([hyp_ids, ref_ids]).astype(np.int64)
+    if len(ids) == 0:
+        return matches
+    lengths = np.concatenate([hyp_lengths, ref_lengths])
+    # 每个位置所在句子的结束位置和句子序号（两侧第i句的序号都是i）
+    ends = np.repeat(np.cumsum(lengths), lengths)
+    sentence = np.repeat(np.concatenate([np.arange(len(hyp_lengths)), np.arange(len(ref_lengths))]), lengths)
+    is_hyp = np.arange(len(ids)) < len(hyp_ids)
+
+    vocab, unigrams = np.unique(ids, return_inverse=True)
+    grams, gram_count = unigrams, len(vocab)
+    for n in range(1, max_order + 1):
+        if n > 1:
+            if len(grams) < 2:
+                break
+            # 位置p的n-gram = 位置p的(n-1)-gram + 位置p+n-1的元素；跨句的组合不计入下面的统计
+            uniques, grams = np.unique(grams[:-1] * len(vocab) + unigrams[n - 1:], return_inverse=True)
+            gram_count = len(uniques)
+        size = len(grams)
+        valid = np.arange(size) + n <= ends[:size]
+        keys = sentence[:size] * gram_count + grams
+        hyp_keys, hyp_counts = np.unique(keys[valid & is_hyp[:size]], return_counts=True)
+        ref_keys, ref_counts = np.unique(keys[valid & ~is_hyp[:size]], return_counts=True)
+        _, hyp_index, ref_index = np.intersect1d(hyp_keys, ref_keys, assume_unique=True, return_indices=True)
+        matches[n - 1] = np.minimum(hyp_counts[hyp_index], ref_counts[ref_index]).sum()
+    return matches
+
+def _encode_tokens(hypotheses, references):
+    """
+    把两侧的token统一映射为整数id
+    返回: (译文id数组, 各句token数, 参考id数组, 各句token数)
+    """
+    sides = []
+    for sentences in (hypotheses, references):
+        lengths = np.fromiter((len(tokens) for tokens in sentences), dtype=np.int64, count=len(sentences))
+        sides.append(([token for tokens in sentences for token in tokens], lengths))
+    tokens = sides[0][0] + sides[1][0]
+    vocab = {}
+    ids = np.fromiter((vocab.setdefault(token, len(vocab)) for token in tokens), dtype=np.uint32, count=len(tokens))
+    split = len(sides[0][0])
+    return ids[:split], sides[0][1], ids[split:], sides[1][1]
+
+def _encode_chars(sentences):
+    """
+    去掉空白后按Unicode码位编码
+    返回: (所有句子首尾相接的码位数组, 各句字符数)
+    """
+    sentences = ["".join(sentence.split()) for sentence in sentences]
+    lengths = np.fromiter((len(sentence) for sentence in sentences), dtype=np.int64, count=len(sentences))
+    return np.frombuffer("".join(sentences).encode("utf-32-le"), dtype=np.uint32), lengths
+
+def bleu_statistics(hypotheses, references, tokenize="13a"):
+    """
+    统计语料级BLEU的充分统计量（每句一个参考译文）
+    返回: 长度为2 + 2 * MAX_NGRAM_ORDER的数组：[译文长度, 参考长度, 各阶匹配数..., 各阶n-gram数...]
+    """
+    _check_lengths(hypotheses, references)
+    tokenizer = TOKENIZERS[tokenize]
+    hyp_ids, hyp_lengths, ref_ids, ref_lengths = _encode_tokens(
+        [tokenizer(hypothesis.rstrip()).split() for hypothesis in hypotheses],
+        [tokenizer(reference.rstrip()).split() for reference in references]
+    )
+    stats = np.zeros(2 + 2 * MAX_NGRAM_ORDER, dtype=np.int64)
+    stats[0], stats[1] = hyp_lengths.sum(), ref_lengths.sum()
+    stats[2:2 + MAX_NGRAM_ORDER] = _clipped_matches(hyp_ids, hyp_lengths, ref_ids, ref_lengths, MAX_NGRAM_ORDER)
+    for n in range(1, MAX_NGRAM_ORDER + 1):
+        stats[1 + MAX_NGRAM_ORDER + n] = np.maximum(hyp_lengths - n + 1, 0).sum()
+    return stats
+
+def bleu_from_statistics(stats):
+    """
+    由语料级统计量（bleu_statistics）计算BLEU，使用exp平滑（mteval-v13a的平滑方式）
+    返回: {"score": BLEU分数, "precisions": 各阶精确率, "bp": 长度惩罚, "sys_len": 译文长度, "ref_len": 参考长度}
+    """
+    sys_len, ref_len = int(stats[0]), int(stats[1])
+    correct = [int(c) for c in stats[2:2 + MAX_NGRAM_ORDER]]
+    total = [int(t) for t in stats[2 + MAX_NGRAM_ORDER:]]
+    bp = 1.0
+    if sys_len < ref_len:
+        bp = math.exp(1 - ref_len / sys_len) if sys_len > 0 else 0.0
+    precisions = [0.0] * MAX_NGRAM_ORDER
+    result = {"score": 0.0, "precisions": precisions, "bp": bp, "sys_len": sys_len, "ref_len": ref_len}
+    if not any(correct):
+        return result
+
+    smooth = 1.0
+    for n in range(MAX_NGRAM_ORDER):
+        if total[n] == 0:
+            break
+        if correct[n] == 0:
+            smooth *= 2
+            precisions[n] = 100.0 / (smooth * total[n])
+        else:
+            precisions[n] = 100.0 * correct[n] / total[n]
+    # 精确率为0时按sacreBLEU的做法取一个极小的对数值，BLEU为0
+    log_sum = sum(math.log(p) if p > 0 else -9999999999 for p in precisions)
+    result["score"] = bp * math.exp(log_sum / MAX_NGRAM_ORDER)
+    return result
+
+def corpus_bleu(hypotheses, references, tokenize="13a"):
+    """
+    语料级BLEU，与sacrebleu.corpus_bleu(hypotheses, [references], tokenize=tokenize)一致
+    hypotheses: 译文列表
+    references: 参考译文列表（每句一个）
+    tokenize: "13a"、"zh"或"none"
+    """
+    return bleu_from_statistics(bleu_statistics(hypotheses, references, tokenize))
+
+def chrf_statistics(hypotheses, references):
+    """
+    统计语料级chrF的充分统计量（字符n-gram，不计空白）
+    返回: 长度为3 * CHAR_ORDER的数组，每阶为[译文n-gram数, 参考n-gram数, 匹配数]
+    """
+    _check_lengths(hypotheses, references)
+    hyp_ids, hyp_lengths = _encode_chars(hypotheses)
+    ref_ids, ref_lengths = _encode_chars(references)
+    stats = np.zeros(3 * CHAR_ORDER, dtype=np.int64)
+    stats[2::3] = _clipped_matches(hyp_ids, hyp_lengths, ref_ids, ref_lengths, CHAR_ORDER)
+    for n in range(1, CHAR_ORDER + 1):
+        hyp_counts = np.maximum(hyp_lengths - n + 1, 0)
+        ref_counts = np.maximum(ref_lengths - n + 1, 0)
+        # 与sacreBLEU一致：参考译文没有该阶n-gram的句子，译文的n-gram也不计数
+        stats[3 * n - 3] = hyp_counts[ref_counts > 0].sum()
+        stats[3 * n - 2] = ref_counts.sum()
+    return stats
+
+def chrf_from_statistics(stats):
+    """
+    由语料级统计量计算chrF：各阶精确率和召回率分别平均（只计两侧都有n-gram的阶）后计算F-beta
+    返回: {"score": chrF分数}
+    """
+    factor = CHRF_BETA ** 2
+    avg_prec = avg_rec = 0.0
+    effective_order = 0
+    for n in range(CHAR_ORDER):
+        n_hyp, n_ref, n_match = (int(x) for x in stats[3 * n:3 * n + 3])
+        if n_hyp > 0 and n_ref > 0:
+            avg_prec += n_match / n_hyp
+            avg_rec += n_match / n_ref
+            effective_order += 1
+    if effective_order:
+        avg_prec /= effective_order
+        avg_rec /= effective_order
+    if avg_prec + avg_rec == 0:
+        return {"score": 0.0}
+    return {"score": 100 * (1 + factor) * avg_prec * avg_rec / (factor * avg_prec + avg_rec)}
+
+def corpus_chrf(hypotheses, references):
+    """语料级chrF，与sacrebleu.corpus_chrf(hypotheses, [references])一致"""
+    return chrf_from_statistics(chrf_statistics(hypotheses, references))
+
+# 参考分数由sacrebleu 2.6.0计算：(分词方式, 译文, 参考译文, BLEU, chrF)
+REFERENCE_CASES = [
+    ("13a",
+     ["The cat sat on the mat.", "It costs $1,000.50 - not 3-4 dollars!", "Tom &amp; Jerry &quot;fight&quot;",
+      "", "A completely different sentence here"],
+     ["The cat is sitting on the mat.", "It costs $1,000.50, not 3-4 dollars.", "Tom & Jerry \"fight\" again",
+      "Nothing was translated.", "Nothing in common"],
+     48.98388849418974, 42.47388264884918),
+    ("zh",
+     ["我们今天去公园散步。", "他在2023年买了3台iPhone手机", "这是一个测试", "完全不同"],
+     ["今天我们去公园散步了。", "他在2023年购买了三台iPhone手机。", "这是一个测试。", "毫无关系的句子"],
+     44.700864765724496, 50.823912948369895),
+    ("zh", ["猫"], ["狗"], 0.0, 0.0),
+]
+
+def check_reference_cases():
+    """检查内置用例的分数与sacreBLEU的参考分数一致，返回不一致的用例数"""
+    failures = 0
+    for tokenize, hypotheses, references, bleu, chrf in REFERENCE_CASES:
+        scores = (corpus_bleu(hypotheses, references, tokenize)["score"], corpus_chrf(hypotheses, references)["score"])
+        ok = all(math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-9) for a, b in zip(scores, (bleu, chrf)))
+        failures += not ok
+        print(f"[{tokenize}] {len(hypotheses)}句: BLEU {scores[0]:.4f}（参考{bleu:.4f}），"
+              f"chrF {scores[1]:.4f}（参考{chrf:.4f}）{'' if ok else '  不一致'}")
+    return failures
+
+def _perturb(sentences, rng):
+    """随机删除、重复部分字符，作为与参考译文部分匹配的模拟译文"""
+    outputs = []
+    for sentence in sentences:
+        keep = rng.random(len(sentence)) > 0.15
+        repeat = rng.random(len(sentence)) < 0.05
+        outputs.append("".join(c * (1 + r) for c, k, r in zip(sentence, keep, repeat) if k))
+    return outputs
+
+def compare_with_sacrebleu(samples):
+    """在dataset语料上与sacrebleu逐项对比，返回不一致的项数"""
+    import time
+    import sacrebleu
+    from corpus_reader import ParallelCorpus
+
+    with ParallelCorpus(DATA_DIR) as corpus:
+        english, chinese = corpus.lines(0, samples)
+    rng = np.random.default_rng(0)
+    failures = 0
+    for lang, references in (("en", english), ("zh", chinese)):
+        hypotheses = _perturb(references, rng)
+        tokenize = tokenize_for(lang)
+        tokenize_13a.cache_clear()
+        tokenize_zh.cache_clear()
+        start = time.perf_counter()
+        ours = (corpus_bleu(hypotheses, references, tokenize)["score"], corpus_chrf(hypotheses, references)["score"])
+        ours_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        theirs = (sacrebleu.corpus_bleu(hypotheses, [references], tokenize=tokenize).score,
+                  sacrebleu.corpus_chrf(hypotheses, [references]).score)
+        theirs_seconds = time.perf_counter() - start
+        ok = all(math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-9) for a, b in zip(ours, theirs))
+        failures += not ok
+        print(f"[{lang}/{tokenize}] {len(references)}句: BLEU {ours[0]:.4f} / sacrebleu {theirs[0]:.4f}，"
+              f"chrF {ours[1]:.4f} / sacrebleu {theirs[1]:.4f}，耗时{ours_seconds:.2f}秒 / {theirs_seconds:.2f}秒"
+              f"{'' if ok else '  不一致'}")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="检查离线BLEU/chrF评分与sacreBLEU的一致性")
+    parser.add_argument("--samples", type=int, default=0, help="在dataset语料前N个句对上与sacrebleu对比（需要安装sacrebleu）")
+    args = parser.parse_args()
+
+    failures = check_reference_cases()
+    if args.samples:
+        try:
+            failures += compare_with_sacrebleu(args.samples)
+        except ImportError:
+            print("未安装sacrebleu，跳过语料对比")
+    print("全部一致" if failures == 0 else f"{failures}项不一致")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+# 内存映射的语料读取
+# 目的：训练脚本原来用readlines()把data.en和data.zh整个读成Python字符串列表，只取前100条时也要读完整个语料，
+# 语料达到千万行时会占用几十GB内存。这里把语料文件内存映射，并为每个文件保存一份行偏移索引，
+# 可以O(1)随机读取任意一行、读取任意区间、逐行流式遍历以及随机抽样，都不需要把整个语料读入内存
+# 用法示例：
+#   python corpus_reader.py                 # 建立/检查dataset中语料的行索引
+#   python corpus_reader.py --show 100 105  # 显示第100到104行的句对
+import os
+import sys
+import mmap
+import hashlib
+import argparse
+
+import numpy as np
+
+INDEX_SUFFIX = ".lineidx.npz"   # 行索引文件保存在语料文件旁边
+SCAN_CHUNK_SIZE = 64 << 20      # 建立索引时每次扫描64MB，内存占用与语料大小无关
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dataset")
+
+def _file_stamp(path):
+    """文件大小和修改时间，任一变化时重建索引"""
+    stat = os.stat(path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def build_line_index(buffer, size):
+    """
+    扫描换行符，返回行起始偏移数组
+    数组长度为行数+1，第i行为buffer[offsets[i]:offsets[i + 1]]（包含行尾换行符）
+    最后一行没有换行符时同样计为一行，与readlines()一致
+    """
+    parts = [np.zeros(1, dtype=np.int64)]
+    for start in range(0, size, SCAN_CHUNK_SIZE):
+        chunk = np.frombuffer(buffer, dtype=np.uint8, count=min(SCAN_CHUNK_SIZE, size - start), offset=start)
+        parts.append(np.flatnonzero(chunk == ord("\n")).astype(np.int64) + start + 1)
+    offsets = np.concatenate(parts)
+    if offsets[-1] != size:
+        offsets = np.append(offsets, size)
+    return offsets
+
+class MmapLines:
+    """内存映射的文本文件，按行号读取，每行去掉首尾空白（与原来的line.strip()一致）"""
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.file = open(path, "rb")
+        # 空文件不能内存映射
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        self.index_path = self.path + INDEX_SUFFIX
+        self.stamp = _file_stamp(self.path)
+        self.digest = None  # 文件内容的SHA-256，第一次用到时计算
+        self.offsets = self._load_index()
+
+    def _load_index(self):
+        """读取保存的行索引；不存在或语料已改变时重新建立并保存"""
+        if os.path.exists(self.index_path):
+            try:
+                with np.load(self.index_path) as data:
+                    if np.array_equal(data["stamp"], self.stamp):
+                        if "sha256" in data:
+                            self.digest = str(data["sha256"])
+                        return data["offsets"]
+            except (OSError, ValueError, KeyError):
+                pass
+        self.offsets = build_line_index(self.buffer, self.size)
+        self._save_index()
+        return self.offsets
+
+    def _save_index(self):
+        """保存行索引（目录不可写时只在内存中使用）"""
+        extra = {"sha256": np.array(self.digest)} if self.digest is not None else {}
+        try:
+            temp_path = self.index_path + ".tmp.npz"
+            np.savez(temp_path, offsets=self.offsets, stamp=self.stamp, **extra)
+            os.replace(temp_path, self.index_path)
+        except OSError:
+            pass
+
+    def sha256(self):
+        """文件内容的SHA-256（用作语料的缓存键），计算一次后保存在行索引文件中"""
+        if self.digest is None:
+            digest = hashlib.sha256()
+            for start in range(0, self.size, SCAN_CHUNK_SIZE):
+                digest.update(self.buffer[start:start + SCAN_CHUNK_SIZE])
+            self.digest = digest.hexdigest()
+            self._save_index()
+        return self.digest
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def line(self, index):
+        """第index行（支持负数下标）"""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"行号超出范围: {index}")
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.buffer[start:end].decode("utf-8").strip()
+
+    def lines(self, start=0, stop=None):
+        """第start到stop-1行，只读取这一段"""
+        start, stop, _ = slice(start, stop).indices(len(self))
+        if start >= stop:
+            return []
+        chunk = self.buffer[self.offsets[start]:self.offsets[stop]].decode("utf-8")
+        # 按\n切分而不是splitlines()，与readlines()的分行方式一致
+        parts = chunk.split("\n")
+        if chunk.endswith("\n"):
+            parts.pop()
+        return [part.strip() for part in parts]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                return [self.line(i) for i in range(*key.indices(len(self)))]
+            return self.lines(key.start, key.stop)
+        return self.line(key)
+
+    def take(self, indices):
+        """按行号列表读取"""
+        return [self.line(int(i)) for i in indices]
+
+    def __iter__(self):
+        """逐行流式遍历"""
+        for i in range(len(self)):
+            yield self.line(i)
+
+    def close(self):
+        if self.size:
+            self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+class ParallelCorpus:
+    """按行对齐的平行语料（data.en和data.zh）"""
+
+    def __init__(self, data_dir=DATA_DIR, names=("data.en", "data.zh")):
+        self.files = [MmapLines(os.path.join(data_dir, name)) for name in names]
+        if len({len(f) for f in self.files}) != 1:
+            lengths = "，".join(f"{name}: {len(f)}行" for name, f in zip(names, self.files))
+            self.close()
+            raise ValueError(f"平行语料行数不一致（{lengths}）")
+
+    def __len__(self):
+        return len(self.files[0])
+
+    def __getitem__(self, index):
+        """第index个句对"""
+        return tuple(f.line(index) for f in self.files)
+
+    def lines(self, start=0, stop=None):
+        """第start到stop-1个句对，返回每种语言一个列表"""
+        return tuple(f.lines(start, stop) for f in self.files)
+
+    def take(self, indices):
+        """按行号列表读取句对，返回每种语言一个列表"""
+        return tuple(f.take(indices) for f in self.files)
+
+    def sample(self, count, seed=0, start=0, stop=None):
+        """
+        从[start, stop)中不放回随机抽取count个句对（按行号升序），只读取被抽中的行
+        返回: 每种语言一个列表
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        rng = np.random.default_rng(seed)
+        indices = np.sort(rng.choice(stop - start, size=min(count, stop - start), replace=False)) + start
+        return self.take(indices)
+
+    def __iter__(self):
+        """逐个句对流式遍历"""
+        return zip(*self.files)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+def main():
+    parser = argparse.ArgumentParser(description="建立并检查平行语料的行索引")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="语料目录（包含data.en和data.zh）")
+    parser.add_argument("--show", type=int, nargs=2, metavar=("START", "STOP"), help="显示[START, STOP)行的句对")
+    args = parser.parse_args()
+
+    with ParallelCorpus(args.data_dir) as corpus:
+        print(f"平行语料: {len(corpus)}个句对")
+        for f in corpus.files:
+            print(f"  {f.path}: {f.size / 1e6:.1f} MB，索引 {f.path + INDEX_SUFFIX}")
+        if args.show:
+            for i, (english, chinese) in enumerate(zip(*corpus.lines(*args.show)), args.show[0]):
+                print(f"[{i}] {english}\n     {chinese}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,293 @@
+# 快速分词器
+# 目的：把MarianTokenizer（Python + SentencePiece）转换为tokenizers库的Rust实现，并提供带token id缓存的批量分词接口
+# 转换结果保存在模型目录的fast_tokenizer子目录中，只有在语料上与原分词器结果完全一致时才会保存
+# 用法示例：
+#   python fast_tokenizer.py --model-path ./train/en_zh_translator --direction EN --samples 5000
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import weakref
+from collections import OrderedDict
+
+from tokenizers import Tokenizer, AddedToken, processors
+from tokenizers.models import Unigram
+from transformers import MarianTokenizer, PreTrainedTokenizerFast
+from transformers.convert_slow_tokenizer import SpmConverter, import_protobuf
+from corpus_reader import ParallelCorpus
+
+FAST_TOKENIZER_DIR = "fast_tokenizer"  # 转换结果保存在模型目录下的子目录
+SOURCE_DIR = "source"                  # 源语言分词器（编码输入）
+TARGET_DIR = "target"                  # 目标语言分词器（编码标签、解码译文）
+PARITY_FILE = "parity.json"            # 一致性检查记录
+# Marian词表与SentencePiece的id不对齐，词表中有而源语言SentencePiece模型中没有的词
+# 按字符数给一个极低的分数，只有在无法用其他词切分时才会被选中（与原分词器把未知字符按字面查词表的行为一致）
+NOT_IN_SPM_SCORE = -1e4
+DEFAULT_TOKEN_CACHE_ENTRIES = 50000    # 每个分词器最多缓存的句子数
+
+class MarianSpmConverter(SpmConverter):
+    """按Marian词表(vocab.json)的id顺序，把一个SentencePiece模型转换为Unigram快速分词器"""
+
+    def __init__(self, original_tokenizer, spm_file, vocab):
+        """
+        original_tokenizer: 原MarianTokenizer
+        spm_file: SentencePiece模型文件（source.spm或target.spm）
+        vocab: 词到id的映射
+        """
+        self.original_tokenizer = original_tokenizer
+        self.vocab_map = vocab
+        model_pb2 = import_protobuf()
+        proto = model_pb2.ModelProto()
+        with open(spm_file, "rb") as f:
+            proto.ParseFromString(f.read())
+        self.proto = proto
+
+    def vocab(self, proto):
+        # 只有普通词(type 1)参与切分，控制符和未知词由特殊token处理
+        scores = {piece.piece: piece.score for piece in proto.pieces if piece.type == 1}
+        by_id = sorted(self.vocab_map.items(), key=lambda item: item[1])
+        if [i for _, i in by_id] != list(range(len(by_id))):
+            raise ValueError("词表id不连续，无法转换为快速分词器")
+        return [(token, scores.get(token, NOT_IN_SPM_SCORE * len(token))) for token, _ in by_id]
+
+    def unk_id(self, proto):
+        return self.vocab_map[self.original_tokenizer.unk_token]
+
+    def tokenizer(self, proto):
+        tokenizer = Tokenizer(Unigram(self.vocab(proto), unk_id=self.unk_id(proto), byte_fallback=False))
+        special_tokens = [
+            token for token in (self.original_tokenizer.eos_token, self.original_tokenizer.unk_token,
+                                self.original_tokenizer.pad_token)
+            if token in self.vocab_map
+        ]
+        tokenizer.add_special_tokens([AddedToken(token, normalized=False, special=True) for token in special_tokens])
+        return tokenizer
+
+    def post_processor(self):
+        # 与MarianTokenizer一样，只在句末添加</s>
+        eos = self.original_tokenizer.eos_token
+        return processors.TemplateProcessing(
+            single=f"$A {eos}", pair=f"$A $B {eos}", special_tokens=[(eos, self.vocab_map[eos])]
+        )
+
+def convert_marian_tokenizer(slow_tokenizer):
+    """
+    把MarianTokenizer转换为源语言、目标语言两个快速分词器
+    返回: FastMarianTokenizer
+    """
+    source_vocab = slow_tokenizer.encoder
+    target_vocab = slow_tokenizer.target_encoder if slow_tokenizer.separate_vocabs else slow_tokenizer.encoder
+    source_spm, target_spm = slow_tokenizer.spm_files
+
+    def wrap(spm_file, vocab):
+        tokenizer = MarianSpmConverter(slow_tokenizer, spm_file, vocab).converted()
+        return PreTrainedTokenizerFast(
+            tokenizer_object=tokenizer,
+            eos_token=slow_tokenizer.eos_token,
+            unk_token=slow_tokenizer.unk_token,
+            pad_token=slow_tokenizer.pad_token,
+            model_max_length=slow_tokenizer.model_max_length,
+            clean_up_tokenization_spaces=slow_tokenizer.clean_up_tokenization_spaces,
+        )
+
+    return FastMarianTokenizer(wrap(source_spm, source_vocab), wrap(target_spm, target_vocab))
+
+class FastMarianTokenizer:
+    """
+    与MarianTokenizer接口兼容的快速分词器
+    输入用源语言分词器编码，text_target和解码使用目标语言分词器
+    """
+
+    def __init__(self, source, target):
+        """
+        source: 源语言PreTrainedTokenizerFast
+        target: 目标语言PreTrainedTokenizerFast
+        """
+        self.source = source
+        self.target = target
+        self.is_fast = True
+
+    def __getattr__(self, name):
+        # pad_token_id、eos_token_id、model_max_length等属性与源语言分词器相同
+        if name in ("source", "target"):
+            raise AttributeError(name)
+        return getattr(self.source, name)
+
+    def __call__(self, text=None, text_target=None, **kwargs):
+        if text is None:
+            return self.target(text_target, **kwargs)
+        encoding = self.source(text, **kwargs)
+        if text_target is not None:
+            encoding["labels"] = self.target(text_target, **kwargs)["input_ids"]
+        return encoding
+
+    def __len__(self):
+        return len(self.source)
+
+    def decode(self, token_ids, **kwargs):
+        return self.target.decode(token_ids, **kwargs)
+
+    def batch_decode(self, sequences, **kwargs):
+        return self.target.batch_decode(sequences, **kwargs)
+
+    def save_pretrained(self, save_directory):
+        """保存到save_directory/fast_tokenizer"""
+        directory = os.path.join(save_directory, FAST_TOKENIZER_DIR)
+        self.source.save_pretrained(os.path.join(directory, SOURCE_DIR))
+        self.target.save_pretrained(os.path.join(directory, TARGET_DIR))
+        return directory
+
+    @classmethod
+    def from_pretrained(cls, model_path):
+        directory = os.path.join(model_path, FAST_TOKENIZER_DIR)
+        return cls(
+            PreTrainedTokenizerFast.from_pretrained(os.path.join(directory, SOURCE_DIR)),
+            PreTrainedTokenizerFast.from_pretrained(os.path.join(directory, TARGET_DIR)),
+        )
+
+def has_fast_tokenizer(model_path):
+    """模型目录中是否有通过一致性检查的快速分词器"""
+    return os.path.exists(os.path.join(model_path, FAST_TOKENIZER_DIR, PARITY_FILE))
+
+def load_tokenizer(model_path):
+    """加载分词器：优先使用已转换的快速分词器，否则使用MarianTokenizer"""
+    if has_fast_tokenizer(model_path):
+        try:
+            return FastMarianTokenizer.from_pretrained(model_path)
+        except Exception as e:
+            print(f"加载快速分词器失败，改用MarianTokenizer: {str(e)}")
+    return MarianTokenizer.from_pretrained(model_path)
+
+class TokenIdCache:
+    """句子到token id列表的LRU缓存（线程安全）"""
+
+    def __init__(self, max_entries=DEFAULT_TOKEN_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def encode(self, tokenizer, texts, max_length=None):
+        """
+        批量分词，已缓存的句子直接返回，未命中的句子合并为一次分词调用
+        返回: token id列表的列表，顺序与texts一致
+        """
+        results = [None] * len(texts)
+        missing = []
+        with self.lock:
+            for i, text in enumerate(texts):
+                ids = self.entries.get((text, max_length))
+                if ids is None:
+                    missing.append(i)
+                else:
+                    self.entries.move_to_end((text, max_length))
+                    results[i] = ids
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            encoded = tokenizer(
+                [texts[i] for i in missing],
+                truncation=max_length is not None,
+                max_length=max_length
+            )["input_ids"]
+            with self.lock:
+                for i, ids in zip(missing, encoded):
+                    results[i] = ids
+                    self.entries[(texts[i], max_length)] = ids
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return results
+
+# 每个分词器实例对应一个token id缓存，分词器释放后缓存随之释放
+_token_id_caches = weakref.WeakKeyDictionary()
+_token_id_caches_lock = threading.Lock()
+
+def token_id_cache(tokenizer):
+    """获取分词器对应的token id缓存"""
+    with _token_id_caches_lock:
+        cache = _token_id_caches.get(tokenizer)
+        if cache is None:
+            cache = _token_id_caches[tokenizer] = TokenIdCache()
+        return cache
+
+def encode_batch(tokenizer, texts, max_length=None):
+    """带缓存的批量分词，返回token id列表的列表"""
+    return token_id_cache(tokenizer).encode(tokenizer, texts, max_length)
+
+def check_parity(slow, fast, sources, targets):
+    """
+    对比原分词器和快速分词器在语料上的结果
+    返回: 不一致的样例列表[(类型, 文本)]
+    """
+    mismatches = []
+    slow_source = slow(sources)["input_ids"]
+    fast_source = fast(sources)["input_ids"]
+    for text, a, b in zip(sources, slow_source, fast_source):
+        if a != b:
+            mismatches.append(("source", text))
+
+    slow_target = slow(text_target=targets)["input_ids"]
+    fast_target = fast(text_target=targets)["input_ids"]
+    for text, a, b in zip(targets, slow_target, fast_target):
+        if a != b:
+            mismatches.append(("target", text))
+
+    # 解码：译文由目标语言token组成
+    slow_decoded = slow.batch_decode(slow_target, skip_special_tokens=True)
+    fast_decoded = fast.batch_decode(slow_target, skip_special_tokens=True)
+    for text, a, b in zip(targets, slow_decoded, fast_decoded):
+        if a != b:
+            mismatches.append(("decode", text))
+    return mismatches
+
+def read_corpus(direction, samples):
+    """读取dataset中的平行语料，返回(源语言句子, 目标语言句子)"""
+    with ParallelCorpus() as corpus:
+        english, chinese = corpus.lines(0, samples or None)
+    return (english, chinese) if direction == "EN" else (chinese, english)
+
+def time_tokenizer(tokenizer, texts, repeat=3):
+    """分词耗时（秒，取多次中的最小值）"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        tokenizer(texts)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="把模型的MarianTokenizer转换为快速分词器并做一致性检查")
+    parser.add_argument("--model-path", required=True, help="模型目录")
+    parser.add_argument("--direction", choices=["EN", "CN"], default="EN", help="翻译方向：EN英译中，CN中译英")
+    parser.add_argument("--samples", type=int, default=0, help="用于一致性检查的句子数，0表示全部语料")
+    args = parser.parse_args()
+
+    slow = MarianTokenizer.from_pretrained(args.model_path)
+    fast = convert_marian_tokenizer(slow)
+    sources, targets = read_corpus(args.direction, args.samples)
+
+    print(f"正在检查一致性（{len(sources)}对句子）...")
+    mismatches = check_parity(slow, fast, sources, targets)
+    if mismatches:
+        print(f"快速分词器与原分词器有{len(mismatches)}处不一致，未保存。示例：")
+        for kind, text in mismatches[:10]:
+            print(f"  [{kind}] {text}")
+        return 1
+
+    slow_time = time_tokenizer(slow, sources)
+    fast_time = time_tokenizer(fast, sources)
+    directory = fast.save_pretrained(args.model_path)
+    with open(os.path.join(directory, PARITY_FILE), "w", encoding="utf-8") as f:
+        json.dump({"direction": args.direction, "sentences": len(sources),
+                   "slow_s": slow_time, "fast_s": fast_time}, f, indent=2)
+    print(f"一致性检查通过，快速分词器已保存到 {directory}")
+    print(f"分词耗时: MarianTokenizer {slow_time * 1000:.1f} ms，快速分词器 {fast_time * 1000:.1f} ms，"
+          f"加速比 {slow_time / fast_time:.1f}x")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+# 模型注册表
+# 目的：在内存预算内缓存已加载的翻译模型，超出预算时按最近最少使用（LRU）顺序淘汰
+# 同一模型目录的不同变体（FP32/INT8/ONNX）共用一个tokenizer实例
+import gc
+import os
+import threading
+from collections import OrderedDict, Counter
+
+import torch
+
+from quantization import model_size_mb
+from fast_tokenizer import load_tokenizer
+
+DEFAULT_MEMORY_BUDGET_MB = 2048  # 默认内存预算，可通过环境变量TRANSLATOR_MEMORY_BUDGET_MB修改
+MEMORY_BUDGET_ENV = "TRANSLATOR_MEMORY_BUDGET_MB"
+
+def estimate_model_mb(model, model_path):
+    """
+    估计模型常驻内存（MB）
+    PyTorch模型统计参数和缓冲区实际占用的存储，绑定的词嵌入和lm_head只计一次（与权重文件大小相当）；
+    ONNX Runtime模型按onnx文件大小估计
+    """
+    if isinstance(model, torch.nn.Module):
+        return model_size_mb(model)
+    from onnx_backend import ONNX_DIR
+    onnx_dir = os.path.join(model_path, ONNX_DIR)
+    total = 0
+    if os.path.isdir(onnx_dir):
+        for name in os.listdir(onnx_dir):
+            total += os.path.getsize(os.path.join(onnx_dir, name))
+    return total / (1 << 20)
+
+class ModelEntry:
+    """注册表中的一个模型"""
+
+    def __init__(self, model_path, model, tokenizer, device, cache_scope, length_ratio, size_mb):
+        self.model_path = model_path
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.cache_scope = cache_scope
+        self.length_ratio = length_ratio
+        self.size_mb = size_mb
+
+class ModelRegistry:
+    """带内存预算的模型缓存（线程安全，后台加载线程和界面线程可同时访问）"""
+
+    def __init__(self, memory_budget_mb=None):
+        """
+        memory_budget_mb: 模型总内存预算（MB），为None时读取环境变量或使用默认值
+        """
+        if memory_budget_mb is None:
+            memory_budget_mb = float(os.environ.get(MEMORY_BUDGET_ENV, DEFAULT_MEMORY_BUDGET_MB))
+        self.memory_budget_mb = memory_budget_mb
+        self.entries = OrderedDict()  # 缓存键 -> ModelEntry，按使用时间排序
+        self.tokenizers = {}          # 模型目录 -> 共享的tokenizer
+        self.pending = Counter()      # 模型目录 -> 已取得tokenizer、尚未put的加载数，期间不释放其tokenizer
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def get(self, key):
+        """获取模型并标记为最近使用，不存在时返回None"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def get_tokenizer(self, model_path):
+        """
+        获取模型目录对应的共享tokenizer（优先使用快速分词器），第一次使用时加载
+        调用方之后必须调用put注册模型，或在加载失败时调用release_tokenizer
+        """
+        key = os.path.abspath(model_path)
+        with self.lock:
+            tokenizer = self.tokenizers.get(key)
+            if tokenizer is not None:
+                self.pending[key] += 1
+                return tokenizer
+        tokenizer = load_tokenizer(model_path)
+        with self.lock:
+            # 并发加载时保留先放入的实例
+            tokenizer = self.tokenizers.setdefault(key, tokenizer)
+            self.pending[key] += 1
+        return tokenizer
+
+    def release_tokenizer(self, model_path):
+        """加载失败时释放get_tokenizer取得的引用"""
+        with self.lock:
+            self._release_pending(os.path.abspath(model_path))
+
+    def _release_pending(self, key):
+        self.pending[key] -= 1
+        if self.pending[key] <= 0:
+            del self.pending[key]
+
+    def put(self, key, model_path, model, tokenizer, device, cache_scope, length_ratio, protected=()):
+        """
+        注册已加载的模型，超出内存预算时淘汰最近最少使用的模型
+        protected: 不可淘汰的缓存键（如界面正在使用的模型）
+        返回: 被淘汰的缓存键列表
+        """
+        entry = ModelEntry(
+            model_path, model, tokenizer, device, cache_scope, length_ratio,
+            estimate_model_mb(model, model_path)
+        )
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            if os.path.abspath(model_path) in self.pending:
+                self._release_pending(os.path.abspath(model_path))
+            evicted = self._evict_over_budget(set(protected) | {key})
+        if evicted:
+            self._release_memory()
+        return evicted
+
+    def _evict_over_budget(self, protected):
+        """按LRU顺序淘汰模型，直到总占用不超过预算（调用方持有锁）"""
+        evicted = []
+        for key in list(self.entries):
+            if self._used_mb() <= self.memory_budget_mb:
+                break
+            if key in protected:
+                continue
+            entry = self.entries.pop(key)
+            evicted.append(key)
+            self.evictions += 1
+            print(f"内存预算不足，卸载模型: {key}（{entry.size_mb:.0f} MB）")
+        # 不再被任何模型或正在进行的加载使用的tokenizer一并释放
+        in_use = {os.path.abspath(entry.model_path) for entry in self.entries.values()} | set(self.pending)
+        for path in list(self.tokenizers):
+            if path not in in_use:
+                del self.tokenizers[path]
+        return evicted
+
+    def _used_mb(self):
+        return sum(entry.size_mb for entry in self.entries.values())
+
+    def _release_memory(self):
+        """把已淘汰模型占用的内存还给系统"""
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def occupancy(self):
+        """注册表占用情况"""
+        with self.lock:
+            return {
+                "models": len(self.entries),
+                "tokenizers": len(self.tokenizers),
+                "used_mb": round(self._used_mb(), 1),
+                "budget_mb": self.memory_budget_mb,
+                "evictions": self.evictions,
+                "entries": {key: round(entry.size_mb, 1) for key, entry in self.entries.items()},
+            }
+
+    def summary(self):
+        """用于状态栏显示的占用摘要"""
+        occupancy = self.occupancy()
+        return (f"模型内存 {occupancy['used_mb']:.0f}/{occupancy['budget_mb']:.0f} MB，"
+                f"已加载{occupancy['models']}个模型")
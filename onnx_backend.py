@@ -0,0 +1,476 @@
+# ONNX Runtime推理后端
+# 目的：把save_model保存的模型导出为ONNX编码器、解码器（首步）和带KV缓存的解码器三个计算图，
+# 并在onnxruntime的CPU执行器上完成贪心解码和束搜索
+# 用法示例：
+#   python onnx_backend.py --model-path ./train/en_zh_translator            # 导出
+#   python onnx_backend.py --model-path ./train/en_zh_translator --verify   # 导出并与PyTorch结果对比
+import os
+import sys
+import time
+import inspect
+import argparse
+
+import numpy as np
+import torch
+from transformers import GenerationConfig, MarianConfig, MarianMTModel, MarianTokenizer
+
+ONNX_DIR = "onnx"  # ONNX文件保存在源模型目录下的子目录中
+ENCODER_FILE = "encoder.onnx"
+DECODER_FILE = "decoder.onnx"
+DECODER_WITH_PAST_FILE = "decoder_with_past.onnx"
+ONNX_OPSET = 14
+
+def _to_legacy_cache(past_key_values):
+    """把transformers的Cache对象转换为每层(自注意力K, V, 交叉注意力K, V)的元组格式"""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    if hasattr(past_key_values, "self_attention_cache"):
+        self_cache = past_key_values.self_attention_cache
+        cross_cache = past_key_values.cross_attention_cache
+        return tuple(
+            (s.keys, s.values, c.keys, c.values)
+            for s, c in zip(self_cache.layers, cross_cache.layers)
+        )
+    return past_key_values
+
+def _from_legacy_cache(past_key_values):
+    """新版本transformers要求使用Cache对象"""
+    try:
+        from transformers.cache_utils import EncoderDecoderCache
+    except ImportError:
+        return past_key_values
+    if hasattr(EncoderDecoderCache, "from_legacy_cache"):
+        return EncoderDecoderCache.from_legacy_cache(past_key_values)
+    return EncoderDecoderCache(past_key_values)
+
+class _EncoderWrapper(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.encoder = model.get_encoder()
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+
+class _DecoderWrapper(torch.nn.Module):
+    """解码第一步：输出logits以及自注意力和交叉注意力的KV缓存"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.decoder = model.get_decoder()
+        self.lm_head = model.lm_head
+        self.register_buffer("final_logits_bias", model.final_logits_bias)
+
+    def forward(self, input_ids, encoder_hidden_states, encoder_attention_mask):
+        out = self.decoder(
+            input_ids=input_ids,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            use_cache=True,
+            return_dict=True,
+        )
+        logits = self.lm_head(out.last_hidden_state) + self.final_logits_bias
+        present = _to_legacy_cache(out.past_key_values)
+        return (logits,) + tuple(t for layer in present for t in layer[:4])
+
+class _DecoderWithPastWrapper(_DecoderWrapper):
+    """后续解码步：输入上一步的KV缓存，只输出更新后的自注意力缓存"""
+
+    def forward(self, input_ids, encoder_hidden_states, encoder_attention_mask, *past):
+        legacy = tuple(tuple(past[i:i + 4]) for i in range(0, len(past), 4))
+        out = self.decoder(
+            input_ids=input_ids,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            past_key_values=_from_legacy_cache(legacy),
+            use_cache=True,
+            return_dict=True,
+        )
+        logits = self.lm_head(out.last_hidden_state) + self.final_logits_bias
+        present = _to_legacy_cache(out.past_key_values)
+        return (logits,) + tuple(t for layer in present for t in layer[:2])
+
+def _past_names(prefix, num_layers, with_cross=True):
+    kinds = ["self_key", "self_value", "cross_key", "cross_value"] if with_cross else ["self_key", "self_value"]
+    return [f"{prefix}.{i}.{kind}" for i in range(num_layers) for kind in kinds]
+
+def _onnx_export(module, args, path, **kwargs):
+    """调用torch.onnx.export；新版本PyTorch默认使用dynamo导出器，这里固定使用支持dynamic_axes的TorchScript导出器"""
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+    torch.onnx.export(module, args, path, opset_version=ONNX_OPSET, **kwargs)
+
+def export_onnx(model_path, output_dir=None):
+    """
+    导出ONNX编码器、解码器和带KV缓存的解码器
+    model_path: save_model保存的模型目录
+    output_dir: 输出目录，默认为model_path/onnx
+    返回: 输出目录
+    """
+    output_dir = output_dir or os.path.join(model_path, ONNX_DIR)
+    os.makedirs(output_dir, exist_ok=True)
+
+    model = MarianMTModel.from_pretrained(model_path).eval()
+    config = model.config
+    num_layers = config.decoder_layers
+    heads = config.decoder_attention_heads
+    head_dim = config.d_model // heads
+
+    input_ids = torch.tensor([[5, 6, 7, config.eos_token_id]] * 2, dtype=torch.long)
+    attention_mask = torch.ones_like(input_ids)
+    decoder_input_ids = torch.full((2, 1), config.decoder_start_token_id, dtype=torch.long)
+
+    print("正在导出编码器...")
+    with torch.no_grad():
+        _onnx_export(
+            _EncoderWrapper(model), (input_ids, attention_mask),
+            os.path.join(output_dir, ENCODER_FILE),
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "src_len"},
+                "attention_mask": {0: "batch", 1: "src_len"},
+                "last_hidden_state": {0: "batch", 1: "src_len"},
+            },
+        )
+        encoder_hidden_states = _EncoderWrapper(model)(input_ids, attention_mask)
+
+    print("正在导出解码器...")
+    present_names = _past_names("present", num_layers)
+    axes = {
+        "input_ids": {0: "batch"},
+        "encoder_hidden_states": {0: "batch", 1: "src_len"},
+        "encoder_attention_mask": {0: "batch", 1: "src_len"},
+        "logits": {0: "batch"},
+    }
+    for name in present_names:
+        axes[name] = {0: "batch", 2: "src_len" if "cross" in name else "past_len"}
+    with torch.no_grad():
+        _onnx_export(
+            _DecoderWrapper(model), (decoder_input_ids, encoder_hidden_states, attention_mask),
+            os.path.join(output_dir, DECODER_FILE),
+            input_names=["input_ids", "encoder_hidden_states", "encoder_attention_mask"],
+            output_names=["logits"] + present_names,
+            dynamic_axes=axes,
+        )
+
+    print("正在导出带KV缓存的解码器...")
+    past = []
+    for i in range(num_layers):
+        past += [torch.zeros(2, heads, 1, head_dim), torch.zeros(2, heads, 1, head_dim)]
+        past += [torch.zeros(2, heads, input_ids.shape[1], head_dim)] * 2
+    past_names = _past_names("past", num_layers)
+    present_self_names = _past_names("present", num_layers, with_cross=False)
+    axes = {
+        "input_ids": {0: "batch"},
+        "encoder_hidden_states": {0: "batch", 1: "src_len"},
+        "encoder_attention_mask": {0: "batch", 1: "src_len"},
+        "logits": {0: "batch"},
+    }
+    for name in past_names:
+        axes[name] = {0: "batch", 2: "src_len" if "cross" in name else "past_len"}
+    for name in present_self_names:
+        axes[name] = {0: "batch", 2: "total_len"}
+    with torch.no_grad():
+        _onnx_export(
+            _DecoderWithPastWrapper(model),
+            (decoder_input_ids, encoder_hidden_states, attention_mask, *past),
+            os.path.join(output_dir, DECODER_WITH_PAST_FILE),
+            input_names=["input_ids", "encoder_hidden_states", "encoder_attention_mask"] + past_names,
+            output_names=["logits"] + present_self_names,
+            dynamic_axes=axes,
+        )
+
+    config.save_pretrained(output_dir)
+    print(f"ONNX模型已导出到 {output_dir}")
+    return output_dir
+
+def _log_softmax(x):
+    x = x - x.max(axis=-1, keepdims=True)
+    return x - np.log(np.exp(x).sum(axis=-1, keepdims=True))
+
+class OnnxMarianModel:
+    """
+    基于onnxruntime的Marian翻译模型
+    generate接口与transformers的model.generate兼容，可直接用于translate_sentences等函数
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        """
+        model_path: 源模型目录（其中的onnx子目录由export_onnx生成）
+        num_threads: onnxruntime的算子内线程数
+        """
+        import onnxruntime as ort
+
+        onnx_dir = os.path.join(model_path, ONNX_DIR)
+        if not os.path.exists(os.path.join(onnx_dir, DECODER_WITH_PAST_FILE)):
+            export_onnx(model_path, onnx_dir)
+
+        self.config = MarianConfig.from_pretrained(model_path)
+        try:
+            self.generation_config = GenerationConfig.from_pretrained(model_path)
+        except OSError:
+            self.generation_config = GenerationConfig.from_model_config(self.config)
+        self.num_layers = self.config.decoder_layers
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        providers = ["CPUExecutionProvider"]
+        self.encoder = ort.InferenceSession(os.path.join(onnx_dir, ENCODER_FILE), options, providers=providers)
+        self.decoder = ort.InferenceSession(os.path.join(onnx_dir, DECODER_FILE), options, providers=providers)
+        self.decoder_with_past = ort.InferenceSession(
+            os.path.join(onnx_dir, DECODER_WITH_PAST_FILE), options, providers=providers
+        )
+        self.device = torch.device("cpu")
+        self.last_encode_seconds = 0.0  # 最近一次generate中编码器的耗时，供性能统计使用
+
+    # 与PyTorch模型接口保持一致，便于统一调用
+    def to(self, device):
+        return self
+
+    def eval(self):
+        return self
+
+    @staticmethod
+    def _run(session, feeds):
+        # 导出时未被使用的输入会被优化掉，只传入计算图实际需要的输入
+        names = {i.name for i in session.get_inputs()}
+        return session.run(None, {k: v for k, v in feeds.items() if k in names})
+
+    def _first_step(self, decoder_input_ids, encoder_hidden_states, attention_mask):
+        logits, *present = self._run(self.decoder, {
+            "input_ids": decoder_input_ids,
+            "encoder_hidden_states": encoder_hidden_states,
+            "encoder_attention_mask": attention_mask,
+        })
+        return logits, present
+
+    def _next_step(self, last_tokens, encoder_hidden_states, attention_mask, past):
+        feeds = {
+            "input_ids": last_tokens[:, None],
+            "encoder_hidden_states": encoder_hidden_states,
+            "encoder_attention_mask": attention_mask,
+        }
+        feeds.update(zip(_past_names("past", self.num_layers), past))
+        logits, *present_self = self._run(self.decoder_with_past, feeds)
+        # 交叉注意力缓存不随解码步变化，只更新自注意力缓存
+        for i in range(self.num_layers):
+            past[4 * i] = present_self[2 * i]
+            past[4 * i + 1] = present_self[2 * i + 1]
+        return logits, past
+
+    def _process_scores(self, scores, sequences, min_length, max_length, no_repeat_ngram_size):
+        """屏蔽填充token、未达最小长度时的结束token以及重复的n-gram，达到最大长度时强制结束"""
+        eos = self.config.eos_token_id
+        scores[:, self.config.pad_token_id] = -np.inf
+        if sequences.shape[1] < min_length:
+            scores[:, eos] = -np.inf
+        if sequences.shape[1] == max_length - 1 and getattr(self.generation_config, "forced_eos_token_id", None) is not None:
+            scores[:, :eos] = -np.inf
+            scores[:, eos + 1:] = -np.inf
+            scores[:, eos] = 0
+            return scores
+        n = no_repeat_ngram_size
+        if n and sequences.shape[1] >= n:
+            for row, seq in enumerate(sequences.tolist()):
+                prefix = tuple(seq[-(n - 1):]) if n > 1 else ()
+                for i in range(len(seq) - n + 1):
+                    if tuple(seq[i:i + n - 1]) == prefix:
+                        scores[row, seq[i + n - 1]] = -np.inf
+        return scores
+
+    def generate(self, input_ids, attention_mask=None, num_beams=None, max_length=None,
+                 max_new_tokens=None, min_length=0, length_penalty=None, early_stopping=None,
+                 no_repeat_ngram_size=0, streamer=None, stopping_criteria=None, **kwargs):
+        """
+        生成译文token序列
+        stopping_criteria: transformers的StoppingCriteriaList，全部样本都满足时提前结束
+        返回: 形状为[batch, seq_len]的numpy数组，第一个token为解码起始token
+        """
+        input_ids = np.asarray(input_ids.cpu() if hasattr(input_ids, "cpu") else input_ids, dtype=np.int64)
+        if attention_mask is None:
+            attention_mask = np.ones_like(input_ids)
+        attention_mask = np.asarray(
+            attention_mask.cpu() if hasattr(attention_mask, "cpu") else attention_mask, dtype=np.int64
+        )
+
+        defaults = self.generation_config
+        num_beams = num_beams or getattr(defaults, "num_beams", None) or 1
+        # max_length包含解码起始token；都未配置时与transformers一致，最多生成20个token
+        if max_new_tokens is None:
+            max_length = max_length or getattr(defaults, "max_length", None) or 21
+        else:
+            max_length = max_new_tokens + 1
+        max_new_tokens = max_length - 1
+        if length_penalty is None:
+            length_penalty = getattr(defaults, "length_penalty", None) or 1.0
+        if early_stopping is None:
+            early_stopping = getattr(defaults, "early_stopping", False) is True
+
+        start = time.perf_counter()
+        encoder_hidden_states = self._run(self.encoder, {
+            "input_ids": input_ids, "attention_mask": attention_mask
+        })[0]
+        self.last_encode_seconds = time.perf_counter() - start
+
+        if num_beams == 1:
+            return self._greedy(encoder_hidden_states, attention_mask, max_length,
+                                min_length, no_repeat_ngram_size, streamer, stopping_criteria)
+        return self._beam_search(encoder_hidden_states, attention_mask, num_beams, max_length,
+                                 min_length, length_penalty, early_stopping, no_repeat_ngram_size,
+                                 stopping_criteria)
+
+    @staticmethod
+    def _should_stop(stopping_criteria, sequences):
+        """检查停止条件（如取消翻译请求）"""
+        if stopping_criteria is None:
+            return False
+        return bool(stopping_criteria(torch.from_numpy(sequences), None).all())
+
+    def _greedy(self, encoder_hidden_states, attention_mask, max_length,
+                min_length, no_repeat_ngram_size, streamer, stopping_criteria=None):
+        pad, eos = self.config.pad_token_id, self.config.eos_token_id
+        batch = encoder_hidden_states.shape[0]
+        sequences = np.full((batch, 1), self.config.decoder_start_token_id, dtype=np.int64)
+        if streamer is not None:
+            streamer.put(torch.from_numpy(sequences))
+        finished = np.zeros(batch, dtype=bool)
+
+        logits, past = self._first_step(sequences, encoder_hidden_states, attention_mask)
+        for _ in range(max_length - 1):
+            scores = self._process_scores(
+                logits[:, -1, :].astype(np.float32), sequences, min_length, max_length, no_repeat_ngram_size
+            )
+            next_tokens = np.where(finished, pad, scores.argmax(axis=-1))
+            sequences = np.concatenate([sequences, next_tokens[:, None]], axis=1)
+            if streamer is not None:
+                streamer.put(torch.from_numpy(next_tokens))
+            finished |= next_tokens == eos
+            if finished.all() or self._should_stop(stopping_criteria, sequences):
+                break
+            logits, past = self._next_step(next_tokens, encoder_hidden_states, attention_mask, past)
+
+        if streamer is not None:
+            streamer.end()
+        return sequences
+
+    def _beam_search(self, encoder_hidden_states, attention_mask, num_beams, max_length,
+                     min_length, length_penalty, early_stopping, no_repeat_ngram_size,
+                     stopping_criteria=None):
+        pad, eos = self.config.pad_token_id, self.config.eos_token_id
+        batch = encoder_hidden_states.shape[0]
+        k = num_beams
+
+        encoder_hidden_states = np.repeat(encoder_hidden_states, k, axis=0)
+        attention_mask = np.repeat(attention_mask, k, axis=0)
+        sequences = np.full((batch * k, 1), self.config.decoder_start_token_id, dtype=np.int64)
+        # 初始时只有每组的第一个束有效，避免k个相同的束
+        beam_scores = np.zeros((batch, k), dtype=np.float32)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.reshape(-1)
+        hypotheses = [[] for _ in range(batch)]  # 每个样本已完成的(分数, 序列)
+        done = [False] * batch
+
+        logits, past = self._first_step(sequences, encoder_hidden_states, attention_mask)
+        for _ in range(max_length - 1):
+            cur_len = sequences.shape[1]
+            scores = _log_softmax(logits[:, -1, :].astype(np.float32))
+            scores = self._process_scores(scores, sequences, min_length, max_length, no_repeat_ngram_size)
+            vocab = scores.shape[1]
+            scores = (scores + beam_scores[:, None]).reshape(batch, k * vocab)
+
+            # 每个样本取分数最高的2k个候选，保证去掉结束token后仍有k个候选
+            top = np.argpartition(-scores, 2 * k, axis=1)[:, :2 * k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            order = np.argsort(-top_scores, axis=1)
+            top = np.take_along_axis(top, order, axis=1)
+
+            next_scores = np.zeros(batch * k, dtype=np.float32)
+            next_beams = np.zeros(batch * k, dtype=np.int64)
+            next_tokens = np.full(batch * k, pad, dtype=np.int64)
+            for b in range(batch):
+                if done[b]:
+                    next_beams[b * k:(b + 1) * k] = b * k
+                    continue
+                filled = 0
+                for rank, candidate in enumerate(top[b]):
+                    score = scores[b, candidate]
+                    beam, token = b * k + candidate // vocab, candidate % vocab
+                    if token == eos:
+                        if rank < k:
+                            hyp = np.append(sequences[beam], eos)
+                            hypotheses[b].append((score / (cur_len ** length_penalty), hyp))
+                            hypotheses[b].sort(key=lambda h: -h[0])
+                            del hypotheses[b][k:]
+                        continue
+                    next_scores[b * k + filled] = score
+                    next_beams[b * k + filled] = beam
+                    next_tokens[b * k + filled] = token
+                    filled += 1
+                    if filled == k:
+                        break
+
+                if len(hypotheses[b]) >= k:
+                    best_running = next_scores[b * k] / (cur_len ** length_penalty)
+                    if early_stopping or best_running <= hypotheses[b][-1][0]:
+                        done[b] = True
+
+            if all(done) or self._should_stop(stopping_criteria, sequences):
+                break
+            sequences = np.concatenate([sequences[next_beams], next_tokens[:, None]], axis=1)
+            beam_scores = next_scores
+            past = [p[next_beams] for p in past]
+            logits, past = self._next_step(next_tokens, encoder_hidden_states, attention_mask, past)
+
+        # 达到最大长度仍未结束的样本，用当前的束作为候选
+        results = []
+        for b in range(batch):
+            if not done[b]:
+                cur_len = sequences.shape[1]
+                for beam in range(b * k, (b + 1) * k):
+                    hypotheses[b].append((beam_scores[beam] / (cur_len ** length_penalty), sequences[beam]))
+            results.append(max(hypotheses[b], key=lambda h: h[0])[1])
+
+        width = max(len(seq) for seq in results)
+        output = np.full((batch, width), pad, dtype=np.int64)
+        for b, seq in enumerate(results):
+            output[b, :len(seq)] = seq
+        return output
+
+def verify(model_path, samples=8):
+    """在dataset语料上对比ONNX与PyTorch的贪心解码结果"""
+    from translation_engine import translate_sentences
+
+    tokenizer = MarianTokenizer.from_pretrained(model_path)
+    torch_model = MarianMTModel.from_pretrained(model_path).eval()
+    onnx_model = OnnxMarianModel(model_path)
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dataset")
+    source_file = "data.zh" if "zh_en" in os.path.basename(os.path.normpath(model_path)) else "data.en"
+    with open(os.path.join(data_dir, source_file), "r", encoding="utf-8") as f:
+        sentences = [next(f).strip() for _ in range(samples)]
+
+    device = torch.device("cpu")
+    expected = translate_sentences(sentences, torch_model, tokenizer, device, num_beams=1)
+    actual = translate_sentences(sentences, onnx_model, tokenizer, device, num_beams=1)
+    matched = sum(a == b for a, b in zip(expected, actual))
+    for source, a, b in zip(sentences, expected, actual):
+        if a != b:
+            print(f"不一致: {source}\n  PyTorch: {a}\n  ONNX:    {b}")
+    print(f"贪心解码一致: {matched}/{len(sentences)}")
+    return matched == len(sentences)
+
+def main():
+    parser = argparse.ArgumentParser(description="导出ONNX模型并可选地与PyTorch结果对比")
+    parser.add_argument("--model-path", required=True, help="save_model保存的模型目录")
+    parser.add_argument("--output-dir", default=None, help="输出目录，默认为<模型目录>/onnx")
+    parser.add_argument("--verify", action="store_true", help="导出后与PyTorch贪心解码结果对比")
+    args = parser.parse_args()
+
+    export_onnx(args.model_path, args.output_dir)
+    if args.verify:
+        return 0 if verify(args.model_path) else 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
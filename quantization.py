@@ -0,0 +1,159 @@
+# CPU INT8动态量化
+# 目的：用PyTorch动态量化把模型中的Linear层转换为INT8，降低CPU推理延迟和内存占用
+# 量化后的模型保存在源模型目录中，之后启动时直接加载，无需重新量化
+# 用法示例（生成对比报告）：
+#   python quantization.py --model-path ./train/en_zh_translator --direction EN --samples 200
+import os
+import sys
+import json
+import time
+import argparse
+
+import torch
+from transformers import MarianConfig, MarianMTModel, MarianTokenizer
+from corpus_reader import ParallelCorpus
+
+QUANTIZED_FILE = "quantized_int8.pt"          # 量化权重文件名
+QUANTIZED_META_FILE = "quantized_int8.json"   # 记录量化权重对应的源权重信息
+WEIGHT_FILES = ["model.safetensors", "pytorch_model.bin"]
+
+def quantize_model(model):
+    """
+    对模型中的Linear层做INT8动态量化
+    model: FP32模型
+    返回: 量化后的模型
+    """
+    model = model.to("cpu").eval()
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def source_weights_info(model_path):
+    """返回源权重文件的(文件名, 大小, 修改时间)，用于判断量化权重是否过期"""
+    for name in WEIGHT_FILES:
+        weight_path = os.path.join(model_path, name)
+        if os.path.exists(weight_path):
+            stat = os.stat(weight_path)
+            return {"file": name, "size": stat.st_size, "mtime": stat.st_mtime}
+    return None
+
+def load_quantized_model(model_path, tokenizer=None):
+    """
+    加载INT8量化模型（只能在CPU上运行）
+    如果源模型目录中已有未过期的量化权重则直接加载，否则量化后保存
+    model_path: 源模型目录
+    tokenizer: 已加载的tokenizer，为None时从模型目录加载
+    返回: (model, tokenizer)
+    """
+    if tokenizer is None:
+        from fast_tokenizer import load_tokenizer
+        tokenizer = load_tokenizer(model_path)
+    quantized_path = os.path.join(model_path, QUANTIZED_FILE)
+    meta_path = os.path.join(model_path, QUANTIZED_META_FILE)
+    source_info = source_weights_info(model_path)
+
+    if os.path.exists(quantized_path) and os.path.exists(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("source") == source_info and meta.get("torch") == torch.__version__:
+            # 按配置构建模型结构并量化，再载入量化权重，不必读取FP32权重
+            config = MarianConfig.from_pretrained(model_path)
+            model = quantize_model(MarianMTModel(config))
+            model.load_state_dict(torch.load(quantized_path, map_location="cpu"))
+            return model.eval(), tokenizer
+
+    print(f"正在对模型进行INT8动态量化: {model_path}")
+    model = quantize_model(MarianMTModel.from_pretrained(model_path))
+    try:
+        torch.save(model.state_dict(), quantized_path)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"source": source_info, "torch": torch.__version__}, f)
+        print(f"量化模型已保存到 {quantized_path}")
+    except OSError as e:
+        print(f"保存量化模型失败: {str(e)}")
+    return model, tokenizer
+
+def _tensor_storage(tensor):
+    """张量所在存储的(地址, 字节数)，共享存储的张量（如绑定的词嵌入和lm_head）地址相同"""
+    try:
+        storage = tensor.untyped_storage()
+        return storage.data_ptr(), storage.nbytes()
+    except (RuntimeError, NotImplementedError):
+        return id(tensor), tensor.numel() * tensor.element_size()
+
+def model_size_mb(model):
+    """
+    统计模型参数、缓冲区和量化打包参数的总大小（MB）
+    state_dict中共享同一存储的张量只计一次：Marian的shared、编码器和解码器的embed_tokens以及lm_head是同一个权重
+    """
+    storages = {}
+    for tensor in list(model.state_dict().values()):
+        # 量化Linear层的打包参数为(权重, 偏置)
+        for t in (tensor if isinstance(tensor, tuple) else (tensor,)):
+            if isinstance(t, torch.Tensor) and t.numel():
+                address, size = _tensor_storage(t)
+                storages[address] = max(size, storages.get(address, 0))
+    return sum(storages.values()) / (1 << 20)
+
+def evaluate_model(model, tokenizer, sources, references, target_lang, batch_size=16):
+    """
+    评估翻译延迟和BLEU分数
+    返回: {"latency_ms": 每句平均延迟, "bleu": BLEU分数}
+    """
+    import sacrebleu
+    from translation_engine import translate_sentences
+
+    device = torch.device("cpu")
+    start = time.perf_counter()
+    hypotheses = translate_sentences(sources, model, tokenizer, device, max_batch_size=batch_size)
+    elapsed = time.perf_counter() - start
+    tokenize = "zh" if target_lang == "zh" else "13a"
+    bleu = sacrebleu.corpus_bleu(hypotheses, [references], tokenize=tokenize).score
+    return {"latency_ms": elapsed * 1000 / max(1, len(sources)), "bleu": bleu}
+
+def read_eval_corpus(direction, samples):
+    """从dataset目录读取评估语料的最后samples条（训练时使用的是前90%）"""
+    with ParallelCorpus() as corpus:
+        english, chinese = corpus.lines(-samples)
+    if direction == "EN":
+        return english, chinese, "zh"
+    return chinese, english, "en"
+
+def main():
+    parser = argparse.ArgumentParser(description="INT8动态量化并与FP32模型对比延迟、内存和BLEU")
+    parser.add_argument("--model-path", required=True, help="源模型目录")
+    parser.add_argument("--direction", choices=["EN", "CN"], default="EN", help="翻译方向")
+    parser.add_argument("--samples", type=int, default=200, help="评估句子数")
+    parser.add_argument("--threads", type=int, default=None, help="PyTorch线程数")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    sources, references, target_lang = read_eval_corpus(args.direction, args.samples)
+
+    print("正在评估FP32模型...")
+    fp32_model = MarianMTModel.from_pretrained(args.model_path).eval()
+    tokenizer = MarianTokenizer.from_pretrained(args.model_path)
+    fp32 = evaluate_model(fp32_model, tokenizer, sources, references, target_lang)
+    fp32["size_mb"] = model_size_mb(fp32_model)
+    del fp32_model
+
+    print("正在评估INT8模型...")
+    start = time.perf_counter()
+    int8_model, tokenizer = load_quantized_model(args.model_path)
+    load_time = time.perf_counter() - start
+    int8 = evaluate_model(int8_model, tokenizer, sources, references, target_lang)
+    int8["size_mb"] = model_size_mb(int8_model)
+    int8["load_s"] = load_time
+
+    print(f"\n========== 量化对比（{len(sources)}句） ==========")
+    print(f"{'':8}{'延迟(ms/句)':>14}{'模型大小(MB)':>14}{'BLEU':>10}")
+    for name, result in (("FP32", fp32), ("INT8", int8)):
+        print(f"{name:8}{result['latency_ms']:>14.1f}{result['size_mb']:>14.1f}{result['bleu']:>10.2f}")
+    print(f"加速比: {fp32['latency_ms'] / int8['latency_ms']:.2f}x，"
+          f"体积缩小: {fp32['size_mb'] / int8['size_mb']:.2f}x，"
+          f"BLEU变化: {int8['bleu'] - fp32['bleu']:+.2f}")
+    print(json.dumps({"fp32": fp32, "int8": int8}, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
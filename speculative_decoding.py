@@ -0,0 +1,348 @@
+# 推测解码（assisted decoding）
+# 目的：用train_small中的小模型作为草稿模型，每轮连续猜测若干个token，由全量模型一次前向同时验证，
+# 得到与全量模型贪心解码完全相同的译文，但全量模型的解码步数大幅减少
+# 两个模型来自同一个Helsinki-NLP/opus-mt预训练模型，共用分词器和词表
+# 用法示例：
+#   python speculative_decoding.py -d EN                   # 在dataset语料上验证一致性并统计接受率和加速比
+#   python speculative_decoding.py -d CN --draft-tokens 6
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+from translation_config import MODEL_PATHS
+
+DEFAULT_DRAFT_TOKENS = 4  # 草稿模型每轮猜测的初始token数，之后按接受情况自动调整
+# 只影响束搜索的生成参数，贪心解码时没有作用，可以安全忽略
+BEAM_ONLY_KWARGS = ("length_penalty", "early_stopping")
+# 取这些值时与推测解码的行为一致，取其他值则不支持
+GREEDY_KWARGS = {"do_sample": False, "num_return_sequences": 1, "use_cache": True}
+
+def draft_model_path(direction):
+    """翻译方向对应的草稿模型（小数据量模型）和目标模型（全量数据模型）路径"""
+    return MODEL_PATHS[("1", direction)], MODEL_PATHS[("2", direction)]
+
+def check_compatible(target, draft):
+    """草稿模型必须与目标模型使用同一词表和特殊token，否则无法逐token验证"""
+    for name in ("vocab_size", "pad_token_id", "eos_token_id", "decoder_start_token_id"):
+        if getattr(target.config, name) != getattr(draft.config, name):
+            raise ValueError(f"草稿模型与目标模型的{name}不一致，不能用于推测解码")
+
+class SpeculativeStats:
+    """推测解码的累计统计"""
+
+    def __init__(self):
+        self.sequences = 0
+        self.tokens = 0          # 生成的token数
+        self.drafted = 0         # 草稿模型猜测的token数
+        self.accepted = 0        # 被目标模型接受的猜测token数
+        self.target_passes = 0   # 目标模型解码器的前向次数
+        self.draft_passes = 0    # 草稿模型解码器的前向次数
+
+    def acceptance_rate(self):
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    def tokens_per_pass(self):
+        """目标模型每次前向平均得到的token数（普通贪心解码为1）"""
+        return self.tokens / self.target_passes if self.target_passes else 0.0
+
+    def summary(self):
+        return (f"接受率 {self.acceptance_rate():.1%}（{self.accepted}/{self.drafted}），"
+                f"目标模型每次前向生成 {self.tokens_per_pass():.2f} 个token")
+
+class SpeculativeMarianModel:
+    """
+    推测解码模型：草稿模型猜测，目标模型验证
+    generate接口与transformers的model.generate兼容，可直接用于translate_sentences等函数；
+    只支持贪心解码（num_beams=1），批量输入会逐句解码
+    """
+
+    def __init__(self, target, draft, num_draft_tokens=DEFAULT_DRAFT_TOKENS):
+        """
+        target: 目标模型（全量数据模型）
+        draft: 草稿模型（小数据量模型），与目标模型共用词表
+        num_draft_tokens: 草稿模型每轮猜测的初始token数
+        """
+        check_compatible(target, draft)
+        self.target = target
+        self.draft = draft
+        self.num_draft_tokens = num_draft_tokens
+        self.config = target.config
+        self.generation_config = target.generation_config
+        self.device = target.device
+        self.stats = SpeculativeStats()
+        self.last_encode_seconds = 0.0  # 最近一次generate中两个编码器的耗时，供性能统计使用
+
+    # 与PyTorch模型接口保持一致，便于统一调用
+    def to(self, device):
+        self.target.to(device)
+        self.draft.to(device)
+        self.device = torch.device(device)
+        return self
+
+    def eval(self):
+        self.target.eval()
+        self.draft.eval()
+        return self
+
+    def _process_scores(self, scores, sequence, min_length, max_length, no_repeat_ngram_size):
+        """
+        与generate的贪心解码使用相同的logits处理：屏蔽填充token、未达最小长度时的结束token以及重复的n-gram，
+        达到最大长度时强制结束
+        """
+        eos = self.config.eos_token_id
+        scores = scores.clone()
+        scores[self.config.pad_token_id] = -float("inf")
+        if len(sequence) < min_length:
+            scores[eos] = -float("inf")
+        if len(sequence) == max_length - 1 and getattr(self.generation_config, "forced_eos_token_id", None) is not None:
+            scores[:] = -float("inf")
+            scores[eos] = 0
+            return scores
+        n = no_repeat_ngram_size
+        if n and len(sequence) >= n:
+            prefix = tuple(sequence[len(sequence) - n + 1:]) if n > 1 else ()
+            for i in range(len(sequence) - n + 1):
+                if tuple(sequence[i:i + n - 1]) == prefix:
+                    scores[sequence[i + n - 1]] = -float("inf")
+        return scores
+
+    @staticmethod
+    def _truncate_cache(past, length):
+        """把KV缓存截断到前length个token（crop传入负数表示删除末尾的token数）"""
+        extra = past.get_seq_length() - length
+        if extra > 0:
+            past.crop(-extra)
+
+    @staticmethod
+    def _forward(model, encoder_outputs, attention_mask, past, tokens):
+        """把尚未进入KV缓存的token送入解码器，返回每个位置的logits和更新后的缓存"""
+        output = model(
+            encoder_outputs=encoder_outputs,
+            attention_mask=attention_mask,
+            decoder_input_ids=torch.tensor([tokens], dtype=torch.long, device=attention_mask.device),
+            past_key_values=past,
+            use_cache=True,
+        )
+        return output.logits[0].float(), output.past_key_values
+
+    def _generate_one(self, input_ids, attention_mask, max_length, min_length,
+                      no_repeat_ngram_size, streamer, stopping_criteria):
+        """推测解码单个句子，返回token id列表（第一个token为解码起始token）"""
+        eos = self.config.eos_token_id
+        start = time.perf_counter()
+        target_encoded = self.target.get_encoder()(input_ids=input_ids, attention_mask=attention_mask)
+        draft_encoded = self.draft.get_encoder()(input_ids=input_ids, attention_mask=attention_mask)
+        self.last_encode_seconds += time.perf_counter() - start
+
+        process = lambda logits, sequence: self._process_scores(
+            logits, sequence, min_length, max_length, no_repeat_ngram_size
+        )
+        sequence = [self.config.decoder_start_token_id]
+        if streamer is not None:
+            streamer.put(torch.tensor(sequence))
+        # 两个模型的KV缓存及其中已包含的token数
+        target_past, target_cached = None, 0
+        draft_past, draft_cached = None, 0
+        # 猜测长度按接受情况调整：全部猜中时加2，否则减1（至少为1）
+        num_draft = self.num_draft_tokens
+
+        while len(sequence) < max_length and sequence[-1] != eos:
+            # 草稿模型逐个猜测token
+            proposal = []
+            for _ in range(min(num_draft, max_length - 1 - len(sequence))):
+                context = sequence + proposal
+                logits, draft_past = self._forward(
+                    self.draft, draft_encoded, attention_mask, draft_past, context[draft_cached:]
+                )
+                draft_cached = len(context)
+                self.stats.draft_passes += 1
+                token = int(process(logits[-1], context).argmax())
+                proposal.append(token)
+                if token == eos:
+                    break
+
+            # 目标模型一次前向验证全部猜测：第j行logits是在前缀sequence + proposal[:j]之后的预测
+            context = sequence + proposal
+            logits, target_past = self._forward(
+                self.target, target_encoded, attention_mask, target_past, context[target_cached:]
+            )
+            self.stats.target_passes += 1
+            offset = len(sequence) - 1 - target_cached
+            accepted = []
+            matched = 0  # 被接受的猜测token数
+            for j in range(len(proposal) + 1):
+                token = int(process(logits[offset + j], sequence + accepted).argmax())
+                accepted.append(token)
+                if j < len(proposal) and token == proposal[j]:
+                    matched += 1
+                    if token == eos:
+                        break
+                    continue
+                # 猜测错误时用目标模型的token替换，全部猜中时额外得到一个token
+                break
+            self.stats.drafted += len(proposal)
+            self.stats.accepted += matched
+            num_draft = num_draft + 2 if proposal and matched == len(proposal) else max(1, num_draft - 1)
+
+            # 丢弃缓存中未被接受的token（最后一个新token尚未送入目标模型）
+            target_cached = len(sequence) + matched
+            self._truncate_cache(target_past, target_cached)
+            if draft_past is not None:
+                draft_cached = min(draft_cached, len(sequence) + matched)
+                self._truncate_cache(draft_past, draft_cached)
+
+            sequence.extend(accepted)
+            self.stats.tokens += len(accepted)
+            if streamer is not None:
+                for token in accepted:
+                    streamer.put(torch.tensor([token]))
+            if stopping_criteria is not None and bool(
+                stopping_criteria(torch.tensor([sequence], device=self.device), None).all()
+            ):
+                break
+
+        if streamer is not None:
+            streamer.end()
+        self.stats.sequences += 1
+        return sequence
+
+    @torch.no_grad()
+    def generate(self, input_ids, attention_mask=None, num_beams=None, max_length=None,
+                 max_new_tokens=None, min_length=None, no_repeat_ngram_size=None, streamer=None,
+                 stopping_criteria=None, **kwargs):
+        """
+        生成译文token序列（结果与目标模型贪心解码相同）
+        未传入的长度和n-gram参数与transformers一样取目标模型generation_config中的默认值；
+        其他会改变解码结果的生成参数不支持，传入时抛出ValueError
+        返回: 形状为[batch, seq_len]的张量，第一个token为解码起始token，较短的序列用填充token补齐
+        """
+        if num_beams not in (None, 1):
+            raise ValueError("推测解码只支持贪心解码（num_beams=1）")
+        unsupported = sorted(
+            name for name, value in kwargs.items()
+            if name not in BEAM_ONLY_KWARGS and not (name in GREEDY_KWARGS and value == GREEDY_KWARGS[name])
+        )
+        if unsupported:
+            raise ValueError(f"推测解码不支持以下生成参数: {', '.join(unsupported)}")
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        config = self.generation_config
+        # max_length包含解码起始token；max_new_tokens优先，都未传入时使用generation_config.max_length，
+        # generation_config也未设置时才与transformers一样退回到与模型无关的默认值21
+        if max_new_tokens is not None:
+            max_length = max_new_tokens + 1
+        elif max_length is None:
+            max_length = config.max_length or 21
+        if min_length is None:
+            min_length = config.min_length
+        if no_repeat_ngram_size is None:
+            no_repeat_ngram_size = config.no_repeat_ngram_size
+
+        self.last_encode_seconds = 0.0
+        sequences = []
+        for row in range(input_ids.shape[0]):
+            # 去掉右侧填充，逐句解码
+            length = int(attention_mask[row].sum())
+            sequences.append(self._generate_one(
+                input_ids[row:row + 1, :length], attention_mask[row:row + 1, :length], max_length,
+                min_length or 0, no_repeat_ngram_size or 0, streamer, stopping_criteria
+            ))
+        longest = max(len(s) for s in sequences)
+        output = torch.full((len(sequences), longest), self.config.pad_token_id, dtype=torch.long)
+        for row, sequence in enumerate(sequences):
+            output[row, :len(sequence)] = torch.tensor(sequence, dtype=torch.long)
+        return output.to(self.device)
+
+def load_speculative_model(direction, device=None, num_draft_tokens=DEFAULT_DRAFT_TOKENS):
+    """
+    加载翻译方向对应的目标模型和草稿模型
+    返回: (SpeculativeMarianModel, tokenizer, device)
+    """
+    from translation_engine import load_model
+
+    draft_path, target_path = draft_model_path(direction)
+    target, tokenizer, device = load_model(target_path, device)
+    draft, _, _ = load_model(draft_path, device)
+    return SpeculativeMarianModel(target, draft, num_draft_tokens), tokenizer, device
+
+def compare(target, draft, tokenizer, device, sentences, length_ratio, num_draft_tokens, **generate_kwargs):
+    """
+    逐句比较目标模型贪心解码和推测解码的结果及耗时
+    返回: (不一致的句子数, 贪心解码耗时, 推测解码耗时, SpeculativeStats)
+    """
+    from translation_engine import pad_batch, encode_batch, max_new_tokens_for, MAX_INPUT_LENGTH
+
+    speculative = SpeculativeMarianModel(target, draft, num_draft_tokens)
+    mismatches = 0
+    greedy_seconds = speculative_seconds = 0.0
+    with torch.no_grad():
+        for sentence in sentences:
+            inputs = pad_batch(encode_batch(tokenizer, [sentence], MAX_INPUT_LENGTH), tokenizer.pad_token_id, device)
+            max_new_tokens = max_new_tokens_for(inputs["input_ids"].shape[1], length_ratio)
+
+            start = time.perf_counter()
+            expected = target.generate(**inputs, num_beams=1, max_new_tokens=max_new_tokens, **generate_kwargs)
+            greedy_seconds += time.perf_counter() - start
+
+            start = time.perf_counter()
+            output = speculative.generate(**inputs, num_beams=1, max_new_tokens=max_new_tokens, **generate_kwargs)
+            speculative_seconds += time.perf_counter() - start
+
+            if not torch.equal(expected.cpu(), output.cpu()):
+                mismatches += 1
+                print(f"结果不一致: {sentence}")
+                print(f"  贪心解码: {tokenizer.decode(expected[0], skip_special_tokens=True)}")
+                print(f"  推测解码: {tokenizer.decode(output[0], skip_special_tokens=True)}")
+    return mismatches, greedy_seconds, speculative_seconds, speculative.stats
+
+def main():
+    parser = argparse.ArgumentParser(description="推测解码：验证与全量模型贪心解码结果一致，并统计接受率和加速比")
+    parser.add_argument("-d", "--direction", choices=["EN", "CN"], default="EN", help="翻译方向")
+    parser.add_argument("--target-path", default=None, help="目标模型路径，默认为全量数据模型")
+    parser.add_argument("--draft-path", default=None, help="草稿模型路径，默认为小数据量模型")
+    parser.add_argument("--draft-tokens", type=int, default=DEFAULT_DRAFT_TOKENS, help="草稿模型每轮猜测的初始token数")
+    parser.add_argument("--samples", type=int, default=200, help="参与比较的语料句子数")
+    parser.add_argument("--no-repeat-ngram-size", type=int, default=2,
+                        help="禁止重复的n-gram长度（与命令行翻译器相同），0表示不限制")
+    args = parser.parse_args()
+
+    from translation_engine import load_model, load_length_ratio, DATA_DIR
+
+    draft_path, target_path = draft_model_path(args.direction)
+    target_path = args.target_path or target_path
+    draft_path = args.draft_path or draft_path
+    for path in (target_path, draft_path):
+        if not os.path.exists(path):
+            print(f"模型路径不存在: {path}")
+            return 1
+
+    target, tokenizer, device = load_model(target_path)
+    draft, _, _ = load_model(draft_path, device)
+    check_compatible(target, draft)
+    length_ratio = load_length_ratio(target_path, tokenizer, args.direction)
+
+    name = "data.en" if args.direction == "EN" else "data.zh"
+    with open(os.path.join(DATA_DIR, name), "r", encoding="utf-8") as f:
+        sentences = [line.strip() for _, line in zip(range(args.samples), f) if line.strip()]
+
+    generate_kwargs = {"no_repeat_ngram_size": args.no_repeat_ngram_size, "min_length": 1}
+    # 预热两个模型，不计入耗时
+    compare(target, draft, tokenizer, device, sentences[:2], length_ratio, args.draft_tokens, **generate_kwargs)
+    mismatches, greedy_seconds, speculative_seconds, stats = compare(
+        target, draft, tokenizer, device, sentences, length_ratio, args.draft_tokens, **generate_kwargs
+    )
+
+    print(f"\n目标模型: {target_path}")
+    print(f"草稿模型: {draft_path}（每轮猜测{args.draft_tokens}个token）")
+    print(f"结果一致: {len(sentences) - mismatches}/{len(sentences)}句")
+    print(stats.summary())
+    print(f"贪心解码耗时: {greedy_seconds:.2f}秒")
+    print(f"推测解码耗时: {speculative_seconds:.2f}秒")
+    print(f"加速比: {greedy_seconds / speculative_seconds:.2f}x")
+    return 0 if mismatches == 0 else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
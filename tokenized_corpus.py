@@ -0,0 +1,224 @@
+# 分词后语料的持久化缓存
+# 目的：训练脚本每次运行都要把整个语料重新构建成Dataset并重新分词，train和train_small之间也不能共用。
+# 这里把分词结果保存为紧凑的token id数组（词表不超过65536时为uint16，否则为uint32）和行偏移索引，
+# 缓存目录按语料内容、分词器、翻译方向和max_length计算的哈希命名，训练时内存映射读取，再次训练不需要重新分词
+# 缓存目录结构：
+#   meta.json                    构建参数、句对数、dtype
+#   source.bin / source.idx.npy  源句token id（不填充，包含结束token）及每句的起始偏移
+#   target.bin / target.idx.npy  译文token id及偏移
+# 缓存目录旁的parity_<key>.json记录快速分词器一致性检查的结论，再次训练时不需要重新检查
+# 用法示例：
+#   python tokenized_corpus.py                # 列出dataset/tokenized中的缓存
+#   python tokenized_corpus.py --clear        # 删除全部缓存
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+
+import numpy as np
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dataset", "tokenized")
+META_FILE = "meta.json"
+FORMAT_VERSION = 1  # 文件格式变化时递增，旧缓存自动失效
+
+def tokenizer_fingerprint(tokenizer):
+    """分词器的指纹：词表、SentencePiece模型和特殊token，任一变化时分词结果可能不同"""
+    digest = hashlib.sha256(type(tokenizer).__name__.encode("utf-8"))
+    digest.update(json.dumps(sorted(tokenizer.get_vocab().items()), ensure_ascii=False).encode("utf-8"))
+    digest.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True).encode("utf-8"))
+    for name in ("spm_source", "spm_target"):
+        spm = getattr(tokenizer, name, None)
+        if spm is not None:
+            digest.update(spm.serialized_model_proto())
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        digest.update(backend.to_str().encode("utf-8"))
+    # FastMarianTokenizer的目标语言分词器是单独的快速分词器
+    target_backend = getattr(getattr(tokenizer, "target", None), "backend_tokenizer", None)
+    if target_backend is not None:
+        digest.update(target_backend.to_str().encode("utf-8"))
+    return digest.hexdigest()
+
+def texts_fingerprint(texts):
+    """句子列表的指纹（不在语料文件中的句子，如蒸馏目标）"""
+    digest = hashlib.sha256()
+    for text in texts:
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+def cache_key(**parts):
+    """由语料、分词器和构建参数计算缓存键"""
+    parts["format"] = FORMAT_VERSION
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def cache_path(name, key, cache_dir=CACHE_DIR):
+    """缓存目录，name为便于辨认的前缀（如"en-zh_128"）"""
+    return os.path.join(cache_dir, f"{name}_{key}")
+
+def parity_path(key, cache_dir=CACHE_DIR):
+    """快速分词器一致性检查结论的保存路径（与分词缓存放在同一目录，清理缓存时一并删除）"""
+    return os.path.join(cache_dir, f"parity_{key}.json")
+
+def token_dtype(vocab_size):
+    return np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+def _memmap(path, dtype):
+    # 空文件不能内存映射
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+class TokenizedCorpus:
+    """内存映射读取的分词后平行语料"""
+
+    def __init__(self, path, size=None):
+        """
+        path: 缓存目录
+        size: 只使用前size个句对（None为全部）
+        """
+        self.path = path
+        with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        dtype = np.dtype(self.meta["dtype"])
+        self.source_ids = _memmap(os.path.join(path, "source.bin"), dtype)
+        self.target_ids = _memmap(os.path.join(path, "target.bin"), dtype)
+        self.source_offsets = np.load(os.path.join(path, "source.idx.npy"), mmap_mode="r")
+        self.target_offsets = np.load(os.path.join(path, "target.idx.npy"), mmap_mode="r")
+        count = len(self.source_offsets) - 1
+        self.size = count if size is None else min(size, count)
+
+    def __len__(self):
+        return self.size
+
+    def source(self, index):
+        """第index个源句的token id"""
+        return self.source_ids[self.source_offsets[index]:self.source_offsets[index + 1]]
+
+    def target(self, index):
+        """第index个译文的token id"""
+        return self.target_ids[self.target_offsets[index]:self.target_offsets[index + 1]]
+
+    def source_lengths(self, start=0, stop=None):
+        """[start, stop)范围内各源句的token数"""
+        stop = self.size if stop is None else stop
+        return np.diff(self.source_offsets[start:stop + 1])
+
+    def target_lengths(self, start=0, stop=None):
+        """[start, stop)范围内各译文的token数"""
+        stop = self.size if stop is None else stop
+        return np.diff(self.target_offsets[start:stop + 1])
+
+def pack_ids(ids, dtype):
+    """
+    把token id列表的列表打包为连续数组，便于在进程间传递和写入文件
+    返回: (所有token id, 各句token数)
+    """
+    lengths = np.fromiter((len(item) for item in ids), dtype=np.int64, count=len(ids))
+    flat = np.fromiter((t for item in ids for t in item), dtype=dtype, count=int(lengths.sum()))
+    return flat, lengths
+
+class TokenizedCorpusWriter:
+    """
+    按顺序追加分词结果，close时原子地生成缓存目录
+    先写入临时目录，完成后再改名，中断的构建不会留下不完整的缓存
+    """
+
+    def __init__(self, path, vocab_size):
+        self.path = path
+        self.dtype = token_dtype(vocab_size)
+        self.temp_path = f"{path}.tmp{os.getpid()}"
+        shutil.rmtree(self.temp_path, ignore_errors=True)
+        os.makedirs(self.temp_path)
+        self.files = {name: open(os.path.join(self.temp_path, f"{name}.bin"), "wb") for name in ("source", "target")}
+        self.lengths = {"source": [], "target": []}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, source_ids, target_ids):
+        """
+        追加一批句对
+        source_ids / target_ids: token id列表的列表
+        """
+        self.add_packed(*pack_ids(source_ids, self.dtype), *pack_ids(target_ids, self.dtype))
+
+    def add_packed(self, source_flat, source_lengths, target_flat, target_lengths):
+        """追加一批已打包（pack_ids）的句对"""
+        for name, flat, lengths in (("source", source_flat, source_lengths), ("target", target_flat, target_lengths)):
+            flat.astype(self.dtype, copy=False).tofile(self.files[name])
+            self.lengths[name].append(lengths)
+        self.count += len(source_lengths)
+
+    def _close_files(self):
+        for f in self.files.values():
+            f.close()
+
+    def close(self, meta):
+        """
+        写入索引和元数据并生成缓存目录
+        meta: 构建参数，保存到meta.json
+        返回: TokenizedCorpus
+        """
+        self._close_files()
+        tokens = {}
+        for name, parts in self.lengths.items():
+            lengths = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            np.save(os.path.join(self.temp_path, f"{name}.idx.npy"), offsets)
+            tokens[name] = int(offsets[-1])
+        meta = dict(meta, pairs=len(self), dtype=np.dtype(self.dtype).name, format=FORMAT_VERSION,
+                    source_tokens=tokens["source"], target_tokens=tokens["target"])
+        with open(os.path.join(self.temp_path, META_FILE), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        try:
+            os.replace(self.temp_path, self.path)
+        except OSError:
+            # 另一个进程已经生成了同一个缓存，使用已有的
+            shutil.rmtree(self.temp_path, ignore_errors=True)
+        return TokenizedCorpus(self.path)
+
+    def abort(self):
+        """放弃构建，删除临时目录"""
+        self._close_files()
+        shutil.rmtree(self.temp_path, ignore_errors=True)
+
+def open_cached(path, size=None):
+    """缓存存在且完整时返回TokenizedCorpus，否则返回None"""
+    if not os.path.exists(os.path.join(path, META_FILE)):
+        return None
+    return TokenizedCorpus(path, size)
+
+def main():
+    parser = argparse.ArgumentParser(description="查看或清理分词后语料的缓存")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="缓存目录")
+    parser.add_argument("--clear", action="store_true", help="删除全部缓存")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.cache_dir):
+        print(f"没有缓存: {args.cache_dir}")
+        return 0
+    if args.clear:
+        shutil.rmtree(args.cache_dir)
+        print(f"已删除 {args.cache_dir}")
+        return 0
+    for name in sorted(os.listdir(args.cache_dir)):
+        path = os.path.join(args.cache_dir, name)
+        if not os.path.isdir(path):
+            continue  # 快速分词器一致性检查结论
+        corpus = open_cached(path)
+        if corpus is None:
+            print(f"{name}: 不完整（可以删除）")
+            continue
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        meta = corpus.meta
+        print(f"{name}: {meta['pairs']}个句对，源{meta['source_tokens']}/译文{meta['target_tokens']}个token，"
+              f"{meta['dtype']}，{size / 1e6:.1f} MB，{meta.get('source', '')}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+# 中译英翻译模型蒸馏脚本（全量数据版）
+# 目的：用全量数据训练好的中译英模型作为教师，训练编码器6层、解码器2层的学生模型，适合在普通CPU上部署
+# 先用教师模型的束搜索译文作为训练目标（序列级知识蒸馏），再用这些目标微调学生模型
+# 需要先运行 zh_to_en_trainer.py 训练教师模型
+# 训练完成后，学生模型将保存到 ./zh_en_student 目录
+import os
+import json
+
+# 直接从当前目录导入工具函数
+from translator_utils import (
+    check_device, load_bilingual_data, load_tokenized_corpus, create_tokenized_datasets,
+    get_data_collator, create_batch_sampler, BucketedSeq2SeqTrainer, report_padding,
+    get_compute_metrics, get_training_args, load_model_and_tokenizer, save_model,
+    generate_distillation_targets, create_student_model, evaluate_translation
+)
+
+# 获取当前脚本所在目录
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 训练参数
+SAMPLE_SIZE = None  # 使用全量数据
+TEACHER_DIR = os.path.join(SCRIPT_DIR, 'zh_en_translator')
+# 使用绝对路径确保结果保存在脚本目录中
+OUTPUT_DIR = os.path.join(SCRIPT_DIR, 'results_zh_en_student')
+SAVE_DIR = os.path.join(SCRIPT_DIR, 'zh_en_student')
+TARGETS_FILE = os.path.join(OUTPUT_DIR, 'distill_targets.en')  # 教师模型生成的训练目标
+SOURCE_LANG = 'zh'
+TARGET_LANG = 'en'
+# 使用os.path.join确保路径正确
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataset')
+TRAIN_RATIO = 0.9  # 与create_tokenized_datasets的默认划分一致
+STUDENT_ENCODER_LAYERS = 6
+STUDENT_DECODER_LAYERS = 2
+EPOCHS = 5  # 学生模型的解码器变浅，需要更多轮次
+BATCH_SIZE = 8
+# 每批最多token数（源句+译文，含填充）；设置后按token数组成批次，BATCH_SIZE只用于评估
+# 默认为None，每批固定BATCH_SIZE句；设为2048时与每批8句、填充到128时的最大内存占用相同
+MAX_TOKENS = None
+LEARNING_RATE = 1e-4  # 比微调教师模型时大，使浅解码器尽快适应
+TEACHER_NUM_BEAMS = 4  # 生成蒸馏目标时的束宽
+EVAL_SAMPLES = 500  # 比较教师和学生模型时使用的评估句子数
+
+# 主函数
+def main():
+    print(f"========== 中译英翻译模型蒸馏（全量数据版） ==========")
+    print(f"数据目录：{DATA_DIR}")
+    print(f"教师模型目录：zh_en_translator")
+    print(f"输出目录：{OUTPUT_DIR}")
+    print(f"模型保存目录：{SAVE_DIR}")
+    if not os.path.exists(TEACHER_DIR):
+        print("教师模型不存在，请先运行 zh_to_en_trainer.py")
+        return
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    
+    # 1. 检查设备
+    device = check_device()
+    
+    # 2. 加载数据（不限制数据量）
+    english_texts, chinese_texts = load_bilingual_data(DATA_DIR, SAMPLE_SIZE)
+    source_texts, reference_texts = chinese_texts, english_texts
+    train_size = int(TRAIN_RATIO * len(source_texts))
+    
+    # 3. 加载教师模型和分词器
+    teacher, tokenizer = load_model_and_tokenizer(TEACHER_DIR, device)
+    
+    # 4. 生成蒸馏目标：训练部分使用教师模型的译文，评估部分保留参考译文
+    distilled_texts = generate_distillation_targets(
+        teacher, tokenizer, source_texts[:train_size], device, TARGETS_FILE, num_beams=TEACHER_NUM_BEAMS
+    )
+    
+    # 5. 创建学生模型（编码器层和解码器层从教师模型中选取）
+    student = create_student_model(teacher, STUDENT_ENCODER_LAYERS, STUDENT_DECODER_LAYERS)
+    
+    # 6. 加载分词后的语料：训练部分为蒸馏目标，按句子内容缓存，重新运行时不再分词
+    corpus = load_tokenized_corpus(
+        DATA_DIR, tokenizer, SOURCE_LANG, TARGET_LANG,
+        source_texts=source_texts, target_texts=distilled_texts + reference_texts[train_size:]
+    )
+    train_dataset, eval_dataset = create_tokenized_datasets(corpus, TRAIN_RATIO)
+    
+    # 7. 获取评估指标计算函数
+    compute_metrics = get_compute_metrics(tokenizer, TARGET_LANG)
+    
+    # 8. 获取训练参数
+    training_args = get_training_args(OUTPUT_DIR, epochs=EPOCHS, batch_size=BATCH_SIZE, learning_rate=LEARNING_RATE)
+    
+    # 9. 按批次动态填充、按长度分组成批，并统计减少的填充计算量
+    data_collator = get_data_collator(tokenizer, student)
+    batch_sampler = create_batch_sampler(train_dataset, training_args, MAX_TOKENS)
+    report_padding(student, train_dataset, data_collator, batch_sampler)
+    
+    # 10. 初始化Trainer
+    trainer = BucketedSeq2SeqTrainer(
+        model=student,
+        args=training_args,
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
+        tokenizer=tokenizer,
+        data_collator=data_collator,
+        compute_metrics=compute_metrics,
+        batch_sampler=batch_sampler,
+    )
+    
+    # 11. 训练学生模型
+    print("\n开始训练学生模型...")
+    print(f"训练数据量: {len(train_dataset)}条")
+    print(f"训练轮次: {EPOCHS}轮")
+    if MAX_TOKENS:
+        print(f"每批最多token数: {MAX_TOKENS}")
+    else:
+        print(f"批量大小: {BATCH_SIZE}")
+    trainer.train()
+    
+    # 12. 保存学生模型
+    save_model(student, tokenizer, SAVE_DIR)
+    
+    # 13. 在评估集上比较教师和学生模型的BLEU和单句延迟
+    eval_sources = source_texts[train_size:][:EVAL_SAMPLES]
+    eval_references = reference_texts[train_size:][:EVAL_SAMPLES]
+    print(f"\n正在比较教师和学生模型（{len(eval_sources)}句）...")
+    report = {}
+    for name, model in (("teacher", teacher), ("student", student)):
+        report[name] = evaluate_translation(
+            model, tokenizer, eval_sources, eval_references, device, TARGET_LANG
+        )
+    print(f"{'模型':<8}{'BLEU':>8}{'单句延迟(ms)':>14}")
+    for name, label in (("teacher", "教师"), ("student", "学生")):
+        print(f"{label:<8}{report[name]['bleu']:>8.2f}{report[name]['ms_per_sentence']:>14.1f}")
+    print(f"学生模型加速比: {report['teacher']['ms_per_sentence'] / report['student']['ms_per_sentence']:.2f}x")
+    with open(os.path.join(SAVE_DIR, 'distillation_report.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    
+    print(f"可以使用 ../translator.py 加载该模型进行翻译，或作为推测解码的草稿模型")
+    print(f"模型路径：{SAVE_DIR}")
+    print("========== 蒸馏结束 ==========")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
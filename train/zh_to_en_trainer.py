@@ -3,13 +3,12 @@
 # 训练完成后，模型将保存到 ./zh_en_translator 目录
 import os
 import torch
-from transformers import Seq2SeqTrainer
 
 # 直接从当前目录导入工具函数
 from translator_utils import (
-    check_device, load_bilingual_data, create_datasets,
-    get_preprocess_function, get_compute_metrics, 
-    get_training_args, load_model_and_tokenizer, save_model
+    check_device, load_tokenized_corpus, create_tokenized_datasets,
+    get_data_collator, create_batch_sampler, BucketedSeq2SeqTrainer, report_padding,
+    get_compute_metrics, get_training_args, load_model_and_tokenizer, save_model
 )
 
 # 获取当前脚本所在目录
@@ -27,6 +26,9 @@ TARGET_LANG = 'en'
 DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dataset')
 EPOCHS = 3  # 增加训练轮次
 BATCH_SIZE = 8  # 增加批量大小，如果GPU内存足够
+# 每批最多token数（源句+译文，含填充）；设置后按token数组成批次，BATCH_SIZE只用于评估
+# 默认为None，每批固定BATCH_SIZE句；设为2048时与每批8句、填充到128时的最大内存占用相同
+MAX_TOKENS = None
 
 # 主函数
 def main():
@@ -38,49 +40,49 @@ def main():
     # 1. 检查设备
     device = check_device()
     
-    # 2. 加载数据（不限制数据量）
-    english_texts, chinese_texts = load_bilingual_data(DATA_DIR, SAMPLE_SIZE)
-    
-    # 3. 创建数据集 - 注意源语言和目标语言与英译中相反
-    train_dataset, eval_dataset = create_datasets(
-        chinese_texts, english_texts, SOURCE_LANG, TARGET_LANG
-    )
-    
-    # 4. 加载模型和分词器
+    # 2. 加载模型和分词器
     model, tokenizer = load_model_and_tokenizer(MODEL_NAME, device)
     
-    # 5. 创建数据预处理函数
-    preprocess_function = get_preprocess_function(tokenizer, SOURCE_LANG, TARGET_LANG)
+    # 3. 加载分词后的语料（不限制数据量）：第一次运行时分词并缓存，之后直接内存映射读取
+    corpus = load_tokenized_corpus(DATA_DIR, tokenizer, SOURCE_LANG, TARGET_LANG, SAMPLE_SIZE)
     
-    # 6. 应用数据预处理
-    print("正在处理数据...")
-    train_dataset = train_dataset.map(preprocess_function, batched=True)
-    eval_dataset = eval_dataset.map(preprocess_function, batched=True)
+    # 4. 创建数据集
+    train_dataset, eval_dataset = create_tokenized_datasets(corpus)
     
-    # 7. 获取评估指标计算函数
-    compute_metrics = get_compute_metrics(tokenizer)
+    # 5. 获取评估指标计算函数
+    compute_metrics = get_compute_metrics(tokenizer, TARGET_LANG)
     
-    # 8. 获取训练参数（增加轮次和批量大小）
+    # 6. 获取训练参数（增加轮次和批量大小）
     training_args = get_training_args(OUTPUT_DIR, epochs=EPOCHS, batch_size=BATCH_SIZE)
     
-    # 9. 初始化Trainer
-    trainer = Seq2SeqTrainer(
+    # 7. 按批次动态填充、按长度分组成批，并统计减少的填充计算量
+    data_collator = get_data_collator(tokenizer, model)
+    batch_sampler = create_batch_sampler(train_dataset, training_args, MAX_TOKENS)
+    report_padding(model, train_dataset, data_collator, batch_sampler)
+    
+    # 8. 初始化Trainer
+    trainer = BucketedSeq2SeqTrainer(
         model=model,
         args=training_args,
         train_dataset=train_dataset,
         eval_dataset=eval_dataset,
         tokenizer=tokenizer,
+        data_collator=data_collator,
         compute_metrics=compute_metrics,
+        batch_sampler=batch_sampler,
     )
     
-    # 10. 训练模型
+    # 9. 训练模型
     print("\n开始训练模型...")
     print(f"训练数据量: {len(train_dataset)}条")
     print(f"训练轮次: {EPOCHS}轮")
-    print(f"批量大小: {BATCH_SIZE}")
+    if MAX_TOKENS:
+        print(f"每批最多token数: {MAX_TOKENS}")
+    else:
+        print(f"批量大小: {BATCH_SIZE}")
     trainer.train()
     
-    # 11. 保存模型
+    # 10. 保存模型
     save_model(model, tokenizer, SAVE_DIR)
     
     print(f"可以使用 ../translator.py 加载该模型进行翻译")
@@ -0,0 +1,207 @@
+# 翻译记忆缓存
+# 两级句子缓存：进程内有界LRU + 磁盘SQLite持久化存储
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+# 默认缓存数据库路径（与脚本放在同一目录）
+DEFAULT_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "translation_cache.db")
+DEFAULT_MEMORY_ENTRIES = 10000  # 内存LRU最多保存的句子数
+
+# 参与模型指纹计算的权重文件
+WEIGHT_FILES = ["model.safetensors", "pytorch_model.bin"]
+
+def normalize_text(text):
+    """
+    规范化源文本，使仅空白不同的句子命中同一缓存项
+    text: 源文本
+    返回: 规范化后的文本
+    """
+    text = unicodedata.normalize("NFC", text)
+    return " ".join(text.split())
+
+def hash_file(file_path, chunk_size=1 << 20):
+    """计算文件的SHA-256摘要"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class TranslationCache:
+    """
+    两级翻译缓存
+    第一级为进程内LRU，命中时只需一次字典查找；
+    第二级为SQLite数据库，程序重启后仍然有效。
+    """
+
+    def __init__(self, db_path=DEFAULT_CACHE_PATH, max_memory_entries=DEFAULT_MEMORY_ENTRIES):
+        """
+        db_path: SQLite数据库路径，为None时只使用内存缓存
+        max_memory_entries: 内存LRU最多保存的句子数
+        """
+        self.db_path = db_path
+        self.max_memory_entries = max_memory_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.conn = None
+        if db_path:
+            try:
+                # 图形界面的后台线程和主线程都会访问缓存，由self.lock保证串行
+                self.conn = sqlite3.connect(db_path, check_same_thread=False)
+                self.conn.execute("PRAGMA journal_mode=WAL")
+                self.conn.execute("PRAGMA synchronous=NORMAL")
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS translations ("
+                    "key TEXT PRIMARY KEY, source TEXT, target TEXT, created REAL)"
+                )
+                self.conn.execute(
+                    "CREATE TABLE IF NOT EXISTS fingerprints ("
+                    "path TEXT PRIMARY KEY, size INTEGER, mtime REAL, digest TEXT)"
+                )
+                self.conn.commit()
+            except sqlite3.Error as e:
+                print(f"无法打开翻译缓存数据库，仅使用内存缓存: {str(e)}")
+                self.conn = None
+
+    def model_fingerprint(self, model_path):
+        """
+        计算模型指纹（模型路径 + 权重文件哈希）
+        权重哈希按(路径, 大小, 修改时间)记录在数据库中，模型未变化时不会重复计算
+        model_path: 模型目录
+        返回: 指纹字符串
+        """
+        abs_path = os.path.abspath(model_path)
+        for name in WEIGHT_FILES:
+            weight_path = os.path.join(abs_path, name)
+            if os.path.exists(weight_path):
+                break
+        else:
+            return abs_path
+
+        stat = os.stat(weight_path)
+        digest = None
+        with self.lock:
+            if self.conn is not None:
+                row = self.conn.execute(
+                    "SELECT size, mtime, digest FROM fingerprints WHERE path = ?", (weight_path,)
+                ).fetchone()
+                if row and row[0] == stat.st_size and row[1] == stat.st_mtime:
+                    digest = row[2]
+
+        if digest is None:
+            digest = hash_file(weight_path)
+            with self.lock:
+                if self.conn is not None:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)",
+                        (weight_path, stat.st_size, stat.st_mtime, digest)
+                    )
+                    self.conn.commit()
+
+        return f"{abs_path}:{digest}"
+
+    @staticmethod
+    def make_key(scope, generate_kwargs, text):
+        """
+        生成缓存键
+        scope: (模型指纹, 翻译方向)
+        generate_kwargs: 生成参数字典
+        text: 源文本
+        返回: 缓存键
+        """
+        payload = json.dumps(
+            [list(scope), generate_kwargs or {}, normalize_text(text)],
+            sort_keys=True, ensure_ascii=False, default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _remember(self, key, value):
+        """写入内存LRU并淘汰最久未使用的项（调用方需持有锁）"""
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        查询缓存
+        key: 缓存键
+        返回: 译文，未命中时返回None
+        """
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return value
+
+            if self.conn is not None:
+                row = self.conn.execute(
+                    "SELECT target FROM translations WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    self._remember(key, row[0])
+                    self.disk_hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put_many(self, items):
+        """
+        批量写入缓存
+        items: (缓存键, 源文本, 译文) 列表
+        """
+        if not items:
+            return
+        with self.lock:
+            for key, _, value in items:
+                self._remember(key, value)
+            if self.conn is not None:
+                now = time.time()
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)",
+                    [(key, source, value, now) for key, source, value in items]
+                )
+                self.conn.commit()
+
+    def put(self, key, source, value):
+        """写入单条缓存"""
+        self.put_many([(key, source, value)])
+
+    def stats(self):
+        """返回命中/未命中计数"""
+        with self.lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / total if total else 0.0,
+                "memory_entries": len(self.memory),
+            }
+
+    def summary(self):
+        """返回简短的统计文字，用于状态栏和命令行输出"""
+        s = self.stats()
+        return (f"缓存命中 {s['memory_hits'] + s['disk_hits']}"
+                f"(内存{s['memory_hits']}/磁盘{s['disk_hits']})，未命中 {s['misses']}，"
+                f"命中率 {s['hit_rate']:.0%}")
+
+    def close(self):
+        """关闭数据库连接"""
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
@@ -0,0 +1,21 @@
+# 翻译配置
+# 只包含常量，不依赖PyTorch和transformers，图形界面可以在导入重量级模块之前使用
+MODEL_PATHS = {
+    # 键为模型类型("1"小数据量/"2"全量数据)和翻译方向("EN"英译中/"CN"中译英)
+    ("1", "EN"): "./train_small/en_zh_translator_small",
+    ("1", "CN"): "./train_small/zh_en_translator_small",
+    ("2", "EN"): "./train/en_zh_translator",
+    ("2", "CN"): "./train/zh_en_translator",
+}
+
+# 可选的推理后端
+BACKENDS = ("pytorch", "onnx")
+
+# 解码策略：在延迟和翻译质量之间取舍
+DECODING_PROFILES = {
+    "fast": {"num_beams": 1},                              # 贪心解码，延迟最低
+    "balanced": {"num_beams": 2, "early_stopping": True},  # 小束宽搜索
+    "quality": {"num_beams": 5, "early_stopping": True},   # 完整束搜索，质量最好
+}
+PROFILE_NAMES = {"fast": "快速", "balanced": "均衡", "quality": "高质量"}
+DEFAULT_PROFILE = "balanced"
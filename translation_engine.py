@@ -0,0 +1,454 @@
+# 翻译推理引擎
+# 包含图形界面和命令行翻译器共同使用的分句、分桶批量翻译等函数
+import os
+import re
+import json
+import math
+import time
+import difflib
+import torch
+from transformers import MarianMTModel
+from transformers.generation.streamers import BaseStreamer
+from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
+
+# 模型路径、推理后端和解码策略定义在不依赖PyTorch的配置模块中
+from translation_config import MODEL_PATHS, BACKENDS, DECODING_PROFILES, PROFILE_NAMES, DEFAULT_PROFILE
+from fast_tokenizer import load_tokenizer, encode_batch
+from translation_metrics import measure, timed_generate
+from vocab_shortlist import shortlist_scope, supports_shortlist
+
+# 分句规则：在句末标点后的空白处切分，中文句末标点后即使没有空白也切分
+SENTENCE_SPLIT_PATTERN = re.compile(r'(?<=[.!?])\s+|(?<=[。！？])\s*')
+
+# 默认的分桶参数
+DEFAULT_MAX_BATCH_SIZE = 16      # 每个桶最多包含的句子数
+DEFAULT_MAX_BATCH_TOKENS = 2048  # 每个桶填充后的最大token数（句子数 × 桶内最长句长度）
+MAX_INPUT_LENGTH = 512           # 单句最大输入长度
+
+# 译文最大长度 = 源句token数 × 长度比例 + 余量，长度比例在dataset语料上测量
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dataset")
+LENGTH_RATIO_FILE = "length_ratio.json"  # 测量结果缓存在模型目录中
+DEFAULT_LENGTH_RATIO = 2.0               # 无法测量时使用的保守比例
+LENGTH_MARGIN = 10
+
+# 权重文件：safetensors通过内存映射加载，启动时不必把整个文件读入内存再反序列化
+SAFETENSORS_FILE = "model.safetensors"
+LEGACY_WEIGHTS_FILE = "pytorch_model.bin"
+
+# 预热用的短句：首次generate会触发内核选择和内存分配，放在模型就绪之前完成
+WARM_UP_TEXT = {"EN": "Hello world.", "CN": "你好，世界。"}
+
+def load_model(model_path, device=None, quantize=False, backend="pytorch"):
+    """
+    加载本地训练好的模型
+    model_path: 本地模型路径
+    device: 计算设备，为None时自动选择
+    quantize: 是否使用CPU INT8动态量化模型
+    backend: 推理后端，"pytorch"或"onnx"（onnxruntime CPU）
+    返回: (model, tokenizer, device)
+    """
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"模型路径不存在: {model_path}")
+    if backend == "onnx":
+        from onnx_backend import OnnxMarianModel
+        model = OnnxMarianModel(model_path)
+        tokenizer = load_tokenizer(model_path)
+        return model, tokenizer, model.device
+    if quantize:
+        from quantization import load_quantized_model
+        model, tokenizer = load_quantized_model(model_path)
+        return model, tokenizer, torch.device("cpu")
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = load_pretrained_model(model_path)
+    tokenizer = load_tokenizer(model_path)
+    model = model.to(device)
+    model.eval()
+    return model, tokenizer, device
+
+def ensure_safetensors(model_path):
+    """
+    旧版训练脚本保存的是pytorch_model.bin，首次加载时转换为model.safetensors
+    转换失败（如目录只读）时继续使用原权重文件
+    """
+    if os.path.exists(os.path.join(model_path, SAFETENSORS_FILE)):
+        return True
+    if not os.path.exists(os.path.join(model_path, LEGACY_WEIGHTS_FILE)):
+        return False
+    try:
+        print(f"正在把模型权重转换为safetensors格式: {model_path}")
+        model = MarianMTModel.from_pretrained(model_path)
+        model.save_pretrained(model_path, safe_serialization=True)
+        return True
+    except OSError as e:
+        print(f"转换safetensors失败: {str(e)}")
+        return False
+
+def load_pretrained_model(model_path):
+    """从safetensors权重（内存映射）加载PyTorch模型"""
+    use_safetensors = ensure_safetensors(model_path)
+    return MarianMTModel.from_pretrained(model_path, use_safetensors=use_safetensors or None)
+
+def warm_up_model(model, tokenizer, device, direction="EN"):
+    """
+    用一个短句执行一次generate，让首个真实翻译不再承担初始化开销
+    返回: 预热耗时（秒）
+    """
+    start = time.perf_counter()
+    inputs = tokenizer([WARM_UP_TEXT[direction]], return_tensors="pt").to(device)
+    with torch.no_grad():
+        model.generate(**inputs, max_new_tokens=4, num_beams=1)
+    return time.perf_counter() - start
+
+def get_generate_kwargs(profile=DEFAULT_PROFILE, **overrides):
+    """
+    获取解码策略对应的生成参数
+    profile: 解码策略名称（fast/balanced/quality）
+    overrides: 额外或覆盖的生成参数
+    返回: 生成参数字典
+    """
+    if profile not in DECODING_PROFILES:
+        raise ValueError(f"未知的解码策略: {profile}，可选: {', '.join(DECODING_PROFILES)}")
+    return dict(DECODING_PROFILES[profile], **overrides)
+
+def max_new_tokens_for(source_length, length_ratio):
+    """根据源句token数估计译文最多需要的token数"""
+    return int(math.ceil(source_length * length_ratio)) + LENGTH_MARGIN
+
+def measure_length_ratio(tokenizer, sources, targets, percentile=0.99):
+    """
+    测量译文与源句token数之比
+    tokenizer: 分词器
+    sources: 源语言句子列表
+    targets: 目标语言句子列表
+    percentile: 取比例分布的分位数，避免长句被截断
+    返回: 长度比例
+    """
+    source_lengths = [len(ids) for ids in tokenizer(sources)["input_ids"]]
+    target_lengths = [len(ids) for ids in tokenizer(text_target=targets)["input_ids"]]
+    ratios = sorted(t / s for s, t in zip(source_lengths, target_lengths) if s > 0)
+    if not ratios:
+        return DEFAULT_LENGTH_RATIO
+    return ratios[min(len(ratios) - 1, int(len(ratios) * percentile))]
+
+def load_length_ratio(model_path, tokenizer, direction, data_dir=DATA_DIR, samples=2000):
+    """
+    获取模型的长度比例：优先读取模型目录中的测量结果，否则在dataset语料上测量并保存
+    model_path: 模型目录
+    tokenizer: 分词器
+    direction: 翻译方向（"EN"英译中/"CN"中译英）
+    data_dir: 语料目录
+    samples: 测量使用的句子数
+    返回: 长度比例
+    """
+    ratio_path = os.path.join(model_path, LENGTH_RATIO_FILE)
+    source_file, target_file = ("data.en", "data.zh") if direction == "EN" else ("data.zh", "data.en")
+    source_path = os.path.join(data_dir, source_file)
+    target_path = os.path.join(data_dir, target_file)
+    if not (os.path.exists(source_path) and os.path.exists(target_path)):
+        return DEFAULT_LENGTH_RATIO
+
+    corpus_key = f"{os.path.getsize(source_path)}:{os.path.getsize(target_path)}:{samples}"
+    if os.path.exists(ratio_path):
+        try:
+            with open(ratio_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("corpus") == corpus_key:
+                return saved["ratio"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    with open(source_path, "r", encoding="utf-8") as f:
+        sources = [line.strip() for _, line in zip(range(samples), f)]
+    with open(target_path, "r", encoding="utf-8") as f:
+        targets = [line.strip() for _, line in zip(range(samples), f)]
+    pairs = [(s, t) for s, t in zip(sources, targets) if s and t]
+    ratio = measure_length_ratio(tokenizer, [s for s, _ in pairs], [t for _, t in pairs])
+
+    try:
+        with open(ratio_path, "w", encoding="utf-8") as f:
+            json.dump({"ratio": ratio, "corpus": corpus_key}, f)
+    except OSError:
+        pass
+    return ratio
+
+def split_sentences(text):
+    """
+    将文本切分为句子列表
+    text: 输入文本
+    返回: 去除首尾空白后的非空句子列表，顺序与原文一致
+    """
+    sentences = SENTENCE_SPLIT_PATTERN.split(text.strip())
+    return [s.strip() for s in sentences if s and s.strip()]
+
+def build_length_buckets(lengths, max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                         max_batch_tokens=DEFAULT_MAX_BATCH_TOKENS):
+    """
+    按token长度将句子分组，长度相近的句子放在同一个桶中以减少填充
+    lengths: 每个句子的token长度列表
+    max_batch_size: 每个桶最多包含的句子数
+    max_batch_tokens: 每个桶填充后的最大token数
+    返回: 桶列表，每个桶是原句子下标的列表
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    buckets = []
+    bucket = []
+    for index in order:
+        # 按长度升序排列，新加入的句子就是桶内最长的句子
+        padded_tokens = (len(bucket) + 1) * lengths[index]
+        if bucket and (len(bucket) >= max_batch_size or padded_tokens > max_batch_tokens):
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(index)
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+def pad_batch(id_lists, pad_token_id, device):
+    """
+    把token id列表在右侧填充为同一长度（与tokenizer(padding=True)的结果相同）
+    返回: {"input_ids": 张量, "attention_mask": 张量}
+    """
+    max_length = max(len(ids) for ids in id_lists)
+    input_ids = torch.full((len(id_lists), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(id_lists), max_length), dtype=torch.long)
+    for row, ids in enumerate(id_lists):
+        input_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, :len(ids)] = 1
+    return {"input_ids": input_ids.to(device), "attention_mask": attention_mask.to(device)}
+
+class TranslationCancelled(Exception):
+    """翻译请求在完成前被取消（例如用户已经修改了输入）"""
+
+class CancelCriteria(StoppingCriteria):
+    """generate每生成一步检查一次should_stop，返回True时中止整个批次"""
+
+    def __init__(self, should_stop):
+        self.should_stop = should_stop
+
+    def __call__(self, input_ids, scores, **kwargs):
+        stop = bool(self.should_stop())
+        return torch.full((input_ids.shape[0],), stop, dtype=torch.bool, device=input_ids.device)
+
+def cancel_kwargs(should_stop):
+    """把should_stop转换为generate的stopping_criteria参数"""
+    if should_stop is None:
+        return {}
+    return {"stopping_criteria": StoppingCriteriaList([CancelCriteria(should_stop)])}
+
+def translate_sentences(sentences, model, tokenizer, device,
+                        max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+                        max_batch_tokens=DEFAULT_MAX_BATCH_TOKENS,
+                        cache=None, cache_scope=None, length_ratio=None, should_stop=None,
+                        stats=None, shortlist=None, **generate_kwargs):
+    """
+    分桶批量翻译句子列表，每个桶只调用一次填充后的generate
+    sentences: 句子列表
+    model: 翻译模型
+    tokenizer: 分词器
+    device: 计算设备
+    max_batch_size: 每个桶最多包含的句子数
+    max_batch_tokens: 每个桶填充后的最大token数
+    cache: 翻译缓存（TranslationCache），为None时不使用缓存
+    cache_scope: 缓存作用域 (模型指纹, 翻译方向)
+    length_ratio: 长度比例，指定且未给出最大长度时按桶内最长源句计算max_new_tokens
+    should_stop: 返回True时中止翻译（包括正在进行的generate），并抛出TranslationCancelled
+    stats: TranslationStats，不为None时记录各阶段耗时、token数和缓存命中
+    shortlist: VocabShortlist，不为None时只对候选token计算lm_head投影
+    generate_kwargs: 传给model.generate的其他生成参数
+    返回: 译文列表，顺序与输入句子一致
+    """
+    results = [""] * len(sentences)
+    derive_length = length_ratio is not None and not (
+        "max_new_tokens" in generate_kwargs or "max_length" in generate_kwargs
+    )
+    cache_kwargs = dict(generate_kwargs, length_ratio=length_ratio) if derive_length else generate_kwargs
+    # 不支持词表裁剪的模型（INT8量化、ONNX）照常翻译，缓存键也不区分裁剪表
+    if shortlist is not None and not supports_shortlist(model):
+        shortlist = None
+    if shortlist is not None:
+        cache_kwargs = dict(cache_kwargs, shortlist=shortlist.fingerprint)
+    pending = [i for i, s in enumerate(sentences) if s.strip()]
+    if stats is not None:
+        stats.sentences += len(pending)
+
+    # 先查缓存，只把未命中的句子送入模型
+    keys = {}
+    if cache is not None:
+        remaining = []
+        for i in pending:
+            keys[i] = cache.make_key(cache_scope, cache_kwargs, sentences[i])
+            cached = cache.get(keys[i])
+            if cached is not None:
+                results[i] = cached
+            else:
+                remaining.append(i)
+        if stats is not None:
+            stats.cache_hits += len(pending) - len(remaining)
+            stats.cache_misses += len(remaining)
+        pending = remaining
+
+    if not pending:
+        return results
+
+    # 只批量分词一次（重复的句子直接使用token id缓存），得到每个句子的token长度
+    with measure(stats, "tokenize"):
+        encoded = encode_batch(tokenizer, [sentences[i] for i in pending], MAX_INPUT_LENGTH)
+    lengths = [len(ids) for ids in encoded]
+
+    for bucket in build_length_buckets(lengths, max_batch_size, max_batch_tokens):
+        if should_stop is not None and should_stop():
+            raise TranslationCancelled()
+        indices = [pending[j] for j in bucket]
+        with measure(stats, "tokenize"):
+            inputs = pad_batch([encoded[j] for j in bucket], tokenizer.pad_token_id, device)
+
+        bucket_kwargs = generate_kwargs
+        if derive_length:
+            source_length = max(lengths[j] for j in bucket)
+            bucket_kwargs = dict(generate_kwargs, max_new_tokens=max_new_tokens_for(source_length, length_ratio))
+
+        with torch.no_grad(), shortlist_scope(shortlist, model, inputs):
+            output = timed_generate(model, inputs, stats, **bucket_kwargs, **cancel_kwargs(should_stop))
+        # 被中止的批次只有部分译文，不能返回或写入缓存
+        if should_stop is not None and should_stop():
+            raise TranslationCancelled()
+
+        with measure(stats, "detokenize"):
+            decoded = tokenizer.batch_decode(output, skip_special_tokens=True)
+        for i, text in zip(indices, decoded):
+            results[i] = text
+
+        if cache is not None:
+            cache.put_many([(keys[i], sentences[i], results[i]) for i in indices])
+
+    return results
+
+class TokenCallbackStreamer(BaseStreamer):
+    """
+    生成流式回调器：每生成一个token就把当前已解码的文本交给回调函数
+    只支持批量大小为1的贪心解码（transformers不支持在束搜索中使用streamer）
+    """
+
+    def __init__(self, tokenizer, on_text):
+        """
+        tokenizer: 分词器
+        on_text: 回调函数，参数为当前已生成的文本
+        """
+        self.tokenizer = tokenizer
+        self.on_text = on_text
+        self.token_ids = []
+        self.skip_prompt = True
+
+    def put(self, value):
+        # 编码器-解码器模型第一次调用传入的是解码起始token，跳过
+        if self.skip_prompt:
+            self.skip_prompt = False
+            return
+        if value.dim() > 1:
+            value = value[0]
+        self.token_ids.extend(value.tolist())
+        self.on_text(self.tokenizer.decode(self.token_ids, skip_special_tokens=True))
+
+    def end(self):
+        self.on_text(self.tokenizer.decode(self.token_ids, skip_special_tokens=True))
+
+def translate_sentences_streaming(sentences, model, tokenizer, device, on_sentence,
+                                  on_partial=None, should_stop=None,
+                                  cache=None, cache_scope=None, length_ratio=None, stats=None,
+                                  shortlist=None, **generate_kwargs):
+    """
+    逐句流式翻译：每句翻译完成立即回调，句内每生成一个token也回调一次
+    sentences: 句子列表
+    model: 翻译模型
+    tokenizer: 分词器
+    device: 计算设备
+    on_sentence: 句子完成回调，参数为(句子下标, 译文)
+    on_partial: 句内token回调，参数为(句子下标, 当前已生成的译文)
+    should_stop: 返回True时停止翻译，正在生成的句子也会中止
+    cache: 翻译缓存（TranslationCache），为None时不使用缓存
+    cache_scope: 缓存作用域 (模型指纹, 翻译方向)
+    length_ratio: 长度比例，指定且未给出最大长度时按源句长度计算max_new_tokens
+    stats: TranslationStats，不为None时记录各阶段耗时、token数和缓存命中
+    shortlist: VocabShortlist，不为None时只对候选token计算lm_head投影
+    generate_kwargs: 传给model.generate的其他生成参数（num_beams固定为1）
+    """
+    generate_kwargs = dict(generate_kwargs, num_beams=1)
+    generate_kwargs.pop("early_stopping", None)
+    derive_length = length_ratio is not None and not (
+        "max_new_tokens" in generate_kwargs or "max_length" in generate_kwargs
+    )
+    cache_kwargs = dict(generate_kwargs, length_ratio=length_ratio) if derive_length else generate_kwargs
+    # 不支持词表裁剪的模型（INT8量化、ONNX）照常翻译，缓存键也不区分裁剪表
+    if shortlist is not None and not supports_shortlist(model):
+        shortlist = None
+    if shortlist is not None:
+        cache_kwargs = dict(cache_kwargs, shortlist=shortlist.fingerprint)
+    for index, sentence in enumerate(sentences):
+        if should_stop is not None and should_stop():
+            return
+        if not sentence.strip():
+            on_sentence(index, "")
+            continue
+        if stats is not None:
+            stats.sentences += 1
+
+        if cache is not None:
+            cache_key = cache.make_key(cache_scope, cache_kwargs, sentence)
+            cached = cache.get(cache_key)
+            if stats is not None:
+                stats.cache_hits += cached is not None
+                stats.cache_misses += cached is None
+            if cached is not None:
+                on_sentence(index, cached)
+                continue
+
+        with measure(stats, "tokenize"):
+            inputs = pad_batch(encode_batch(tokenizer, [sentence], MAX_INPUT_LENGTH), tokenizer.pad_token_id, device)
+
+        streamer = None
+        if on_partial is not None:
+            streamer = TokenCallbackStreamer(tokenizer, lambda text, i=index: on_partial(i, text))
+
+        sentence_kwargs = generate_kwargs
+        if derive_length:
+            source_length = inputs["input_ids"].shape[1]
+            sentence_kwargs = dict(generate_kwargs, max_new_tokens=max_new_tokens_for(source_length, length_ratio))
+
+        with torch.no_grad(), shortlist_scope(shortlist, model, inputs):
+            output = timed_generate(
+                model, inputs, stats, streamer=streamer, **sentence_kwargs, **cancel_kwargs(should_stop)
+            )
+        if should_stop is not None and should_stop():
+            return
+
+        with measure(stats, "detokenize"):
+            result = tokenizer.decode(output[0], skip_special_tokens=True)
+        if cache is not None:
+            cache.put(cache_key, sentence, result)
+        on_sentence(index, result)
+
+def plan_incremental_update(old_sentences, old_results, new_sentences):
+    """
+    对比新旧分句结果，复用未变化句子的译文
+    old_sentences: 上一次的句子列表
+    old_results: 上一次每个句子的译文列表
+    new_sentences: 本次的句子列表
+    返回: (results, changed)，results中未变化句子已填入旧译文，
+          changed为需要重新翻译的句子下标列表
+    """
+    results = [None] * len(new_sentences)
+    changed = []
+    matcher = difflib.SequenceMatcher(a=old_sentences, b=new_sentences, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            for i, j in zip(range(i1, i2), range(j1, j2)):
+                # 旧译文缺失（例如上一次流式翻译被中断）时也需要重新翻译
+                if old_results[i] is None:
+                    changed.append(j)
+                else:
+                    results[j] = old_results[i]
+        else:
+            changed.extend(range(j1, j2))
+    changed.sort()
+    return results, changed
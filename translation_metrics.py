@@ -0,0 +1,273 @@
+# 翻译性能指标
+# 记录每次翻译各阶段（分词、编码器、解码步、反分词）的耗时、输入输出token数、束宽和缓存命中，
+# 并累计为全局指标，可导出为Prometheus文本格式或JSON；可选地为generate调用导出torch profiler跟踪
+# 本模块在导入时不依赖PyTorch，图形界面启动时即可使用
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+STAGES = ("tokenize", "encode", "decode", "detokenize")
+STAGE_NAMES = {"tokenize": "分词", "encode": "编码器", "decode": "解码", "detokenize": "反分词"}
+
+# 请求延迟直方图的分桶上界（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS_FILE_ENV = "TRANSLATOR_METRICS_FILE"  # 设置后图形界面每次翻译完成都导出指标
+TRACE_DIR_ENV = "TRANSLATOR_TRACE_DIR"        # 设置后图形界面为每次generate导出profiler跟踪
+
+class TranslationStats:
+    """一次翻译请求的性能统计"""
+
+    def __init__(self, trace_dir=None):
+        """
+        trace_dir: 不为None时，每次generate都用torch profiler记录并导出Chrome跟踪文件到该目录
+        """
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.sentences = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.decode_steps = 0
+        self.generate_calls = 0
+        self.beams = 1
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.trace_dir = trace_dir
+        self.traces = []
+        self.start = time.perf_counter()
+        self.total = None
+
+    @contextmanager
+    def stage(self, name):
+        """统计代码块的耗时并累加到指定阶段"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - start
+
+    def finish(self):
+        """结束计时，返回自身"""
+        self.total = time.perf_counter() - self.start
+        return self
+
+    @property
+    def elapsed(self):
+        """请求总耗时（秒），未结束时为当前已用时间"""
+        return self.total if self.total is not None else time.perf_counter() - self.start
+
+    def tokens_per_second(self):
+        """每秒生成的译文token数"""
+        return self.output_tokens / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self):
+        """用于状态栏显示的简短摘要，如“212 ms，38 tok/s”"""
+        return f"{self.elapsed * 1000:.0f} ms，{self.tokens_per_second():.0f} tok/s"
+
+    def report(self):
+        """多行的详细报告"""
+        lines = [f"总耗时 {self.elapsed * 1000:.1f} ms（{self.sentences}句，{self.generate_calls}次generate）"]
+        for name in STAGES:
+            lines.append(f"  {STAGE_NAMES[name]}: {self.stages[name] * 1000:.1f} ms")
+        lines.append(f"  token: 输入{self.input_tokens}，输出{self.output_tokens}，"
+                     f"解码步{self.decode_steps}，束宽{self.beams}，{self.tokens_per_second():.1f} tok/s")
+        lines.append(f"  翻译缓存: 命中{self.cache_hits}，未命中{self.cache_misses}")
+        for path in self.traces:
+            lines.append(f"  profiler跟踪: {path}")
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {
+            "total_ms": round(self.elapsed * 1000, 2),
+            "stages_ms": {name: round(seconds * 1000, 2) for name, seconds in self.stages.items()},
+            "sentences": self.sentences,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "decode_steps": self.decode_steps,
+            "generate_calls": self.generate_calls,
+            "beams": self.beams,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "tokens_per_second": round(self.tokens_per_second(), 2),
+            "traces": list(self.traces),
+        }
+
+def measure(stats, name):
+    """stats为None时不计时"""
+    return stats.stage(name) if stats is not None else nullcontext()
+
+def _hook_encoder(model, durations):
+    """
+    在PyTorch模型的编码器上注册计时钩子，编码器每次前向的耗时追加到durations
+    返回: 钩子句柄列表（ONNX等非PyTorch模型返回空列表）
+    """
+    get_encoder = getattr(model, "get_encoder", None)
+    if get_encoder is None:
+        return []
+    encoder = get_encoder()
+    started = []
+
+    def before(module, args):
+        started.append(time.perf_counter())
+
+    def after(module, args, output):
+        durations.append(time.perf_counter() - started.pop())
+
+    return [encoder.register_forward_pre_hook(before), encoder.register_forward_hook(after)]
+
+@contextmanager
+def _profile(stats):
+    """stats.trace_dir不为None时用torch profiler记录代码块并导出Chrome跟踪文件"""
+    if stats.trace_dir is None:
+        yield
+        return
+    import torch
+    from torch.profiler import profile, ProfilerActivity
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    with profile(activities=activities, record_shapes=True) as prof:
+        yield
+    os.makedirs(stats.trace_dir, exist_ok=True)
+    path = os.path.join(
+        stats.trace_dir, f"generate_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_{stats.generate_calls}.json"
+    )
+    prof.export_chrome_trace(path)
+    stats.traces.append(path)
+
+def timed_generate(model, inputs, stats=None, **generate_kwargs):
+    """
+    调用model.generate并记录编码器耗时、解码耗时、输入输出token数和解码步数
+    inputs: pad_batch返回的input_ids和attention_mask
+    stats: TranslationStats，为None时直接调用generate
+    """
+    if stats is None:
+        return model.generate(**inputs, **generate_kwargs)
+    import torch
+
+    stats.generate_calls += 1
+    stats.beams = generate_kwargs.get("num_beams") or getattr(model.generation_config, "num_beams", None) or 1
+    stats.input_tokens += int(inputs["attention_mask"].sum())
+
+    durations = []
+    hooks = _hook_encoder(model, durations)
+    start = time.perf_counter()
+    try:
+        with _profile(stats):
+            output = model.generate(**inputs, **generate_kwargs)
+    finally:
+        for hook in hooks:
+            hook.remove()
+    elapsed = time.perf_counter() - start
+
+    # ONNX模型没有可挂钩子的编码器模块，由generate自己记录编码器耗时
+    encode = sum(durations) if hooks else getattr(model, "last_encode_seconds", 0.0)
+    stats.stages["encode"] += encode
+    stats.stages["decode"] += elapsed - encode
+
+    # 第一列是解码起始token，填充和结束token不计入译文token数
+    ids = torch.as_tensor(output)
+    config = model.config
+    stats.decode_steps += ids.shape[1] - 1
+    generated = ids[:, 1:]
+    stats.output_tokens += int(((generated != config.pad_token_id) & (generated != config.eos_token_id)).sum())
+    return output
+
+class MetricsRegistry:
+    """累计所有翻译请求的指标（线程安全）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (指标名, 来源) -> 值
+        self.stage_seconds = {}  # (阶段, 来源) -> 累计秒数
+        self.latency = {}  # 来源 -> {"buckets": [...], "sum": 秒数, "count": 请求数}
+
+    def record(self, stats, source="gui"):
+        """
+        记录一次已结束的翻译请求
+        source: 请求来源，如"gui"、"cli"
+        """
+        with self.lock:
+            for name in ("sentences", "input_tokens", "output_tokens", "decode_steps",
+                         "generate_calls", "cache_hits", "cache_misses"):
+                key = (name, source)
+                self.counters[key] = self.counters.get(key, 0) + getattr(stats, name)
+            key = ("requests", source)
+            self.counters[key] = self.counters.get(key, 0) + 1
+            for name, seconds in stats.stages.items():
+                key = (name, source)
+                self.stage_seconds[key] = self.stage_seconds.get(key, 0.0) + seconds
+
+            latency = self.latency.setdefault(
+                source, {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0}
+            )
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if stats.elapsed <= bound:
+                    latency["buckets"][i] += 1
+            latency["sum"] += stats.elapsed
+            latency["count"] += 1
+
+    def to_json(self):
+        """导出为JSON可序列化的字典"""
+        with self.lock:
+            sources = sorted({source for _, source in self.counters})
+            return {
+                source: {
+                    "counters": {name: value for (name, s), value in self.counters.items() if s == source},
+                    "stage_seconds": {
+                        name: round(value, 6) for (name, s), value in self.stage_seconds.items() if s == source
+                    },
+                    "latency": {
+                        "buckets": dict(zip(map(str, LATENCY_BUCKETS), self.latency[source]["buckets"])),
+                        "sum": round(self.latency[source]["sum"], 6),
+                        "count": self.latency[source]["count"],
+                    },
+                }
+                for source in sources
+            }
+
+    def to_prometheus(self):
+        """导出为Prometheus文本格式"""
+        lines = []
+        with self.lock:
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                metric = f"translator_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for (n, source), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f'{metric}{{source="{source}"}} {value}')
+
+            if self.stage_seconds:
+                lines.append("# TYPE translator_stage_seconds_total counter")
+                for (stage, source), value in sorted(self.stage_seconds.items()):
+                    lines.append(f'translator_stage_seconds_total{{source="{source}",stage="{stage}"}} {value:.6f}')
+
+            if self.latency:
+                lines.append("# TYPE translator_request_seconds histogram")
+                for source, latency in sorted(self.latency.items()):
+                    for bound, count in zip(LATENCY_BUCKETS, latency["buckets"]):
+                        lines.append(f'translator_request_seconds_bucket{{source="{source}",le="{bound}"}} {count}')
+                    lines.append(
+                        f'translator_request_seconds_bucket{{source="{source}",le="+Inf"}} {latency["count"]}'
+                    )
+                    lines.append(f'translator_request_seconds_sum{{source="{source}"}} {latency["sum"]:.6f}')
+                    lines.append(f'translator_request_seconds_count{{source="{source}"}} {latency["count"]}')
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        """导出到文件：.json后缀为JSON，其余为Prometheus文本格式"""
+        if path.endswith(".json"):
+            data = json.dumps(self.to_json(), ensure_ascii=False, indent=2)
+        else:
+            data = self.to_prometheus()
+        # 先写临时文件再替换，采集程序不会读到写了一半的文件
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+# 进程内的全局指标
+METRICS = MetricsRegistry()
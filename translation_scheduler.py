@@ -0,0 +1,95 @@
+# 翻译请求调度器
+# 界面的所有翻译都在调度器的后台线程中执行，只翻译最新的文本：
+# 新请求取代尚未开始的旧请求，并通过取消标志中止正在进行的旧请求（generate每一步都会检查）
+import threading
+
+PRIORITY_AUTO = 0    # 输入变化、切换选项等自动触发的翻译
+PRIORITY_MANUAL = 1  # 点击“翻译”按钮的手动翻译
+
+class TranslationRequest:
+    """一个翻译请求"""
+
+    def __init__(self, job, priority, on_done=None, on_error=None):
+        """
+        job: 在后台线程中执行的函数，参数为is_cancelled（返回请求是否已取消）
+        priority: 请求优先级
+        on_done: 完成回调，参数为job的返回值（在后台线程中调用）
+        on_error: 出错回调，参数为异常（在后台线程中调用）
+        """
+        self.job = job
+        self.priority = priority
+        self.on_done = on_done
+        self.on_error = on_error
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+class LatestWinsScheduler:
+    """
+    单线程翻译调度器
+    新请求会取消所有优先级不高于它的等待中或执行中的请求；
+    自动翻译不会打断手动翻译，而是在手动翻译完成后执行
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = {}    # 优先级 -> 等待中的请求（每个优先级只保留最新的一个）
+        self.current = None  # 正在执行的请求
+        self.completed = 0
+        self.superseded = 0  # 被更新的请求取代的请求数
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, job, priority=PRIORITY_AUTO, on_done=None, on_error=None):
+        """提交翻译请求，返回TranslationRequest"""
+        request = TranslationRequest(job, priority, on_done, on_error)
+        with self.condition:
+            for old_priority in list(self.pending):
+                if old_priority <= priority:
+                    self.pending.pop(old_priority).cancel()
+                    self.superseded += 1
+            if self.current is not None and self.current.priority <= priority:
+                self.current.cancel()
+            self.pending[priority] = request
+            self.condition.notify()
+        return request
+
+    def cancel_all(self):
+        """取消所有等待中和执行中的请求（如切换模型时）"""
+        with self.condition:
+            for request in self.pending.values():
+                request.cancel()
+            self.pending.clear()
+            if self.current is not None:
+                self.current.cancel()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                request = self.pending.pop(max(self.pending))
+                self.current = request
+
+            try:
+                result = request.job(request.is_cancelled)
+            except Exception as e:
+                # 被取消的请求抛出的异常（包括TranslationCancelled）不需要报告
+                if request.is_cancelled():
+                    self.superseded += 1
+                elif request.on_error is not None:
+                    request.on_error(e)
+            else:
+                if request.is_cancelled():
+                    self.superseded += 1
+                else:
+                    self.completed += 1
+                    if request.on_done is not None:
+                        request.on_done(result)
+            finally:
+                with self.condition:
+                    self.current = None
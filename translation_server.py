@@ -0,0 +1,286 @@
+# 本地HTTP翻译服务
+# 目的：同时加载英译中、中译英两个模型，供多个客户端共享
+# 在很短时间窗口内到达的请求会按方向合并成一次填充后的generate调用（动态微批处理）
+# 用法示例：
+#   python translation_server.py -m 2 --port 8000
+#   curl -X POST http://127.0.0.1:8000/translate -d '{"text": "Hello world.", "direction": "EN"}'
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+from translation_engine import (
+    BACKENDS, MODEL_PATHS, DECODING_PROFILES, DEFAULT_PROFILE,
+    MAX_INPUT_LENGTH, load_model, load_length_ratio, get_generate_kwargs, split_sentences, translate_sentences
+)
+
+MAX_BODY_SIZE = 1 << 20  # 请求体最大1MB
+
+class MicroBatcher:
+    """
+    单个翻译方向的动态微批处理器
+    收到第一条句子后最多再等待batch_window秒，把期间到达的句子合并成一批翻译
+    """
+
+    def __init__(self, model, tokenizer, device, batch_window=0.01, max_batch_size=32, length_ratio=None,
+                 max_batch_tokens=None, executor=None):
+        """
+        model: 翻译模型
+        tokenizer: 分词器
+        device: 计算设备
+        batch_window: 合并请求的时间窗口（秒）
+        max_batch_size: 每批最多包含的句子数
+        length_ratio: 长度比例，用于按源句长度计算最大生成长度
+        max_batch_tokens: 每次generate填充后的最大token数，为None时不限制（一批只调用一次generate）
+        executor: 执行推理的单线程执行器，多个方向应共用同一个，避免两个generate同时运行争用算子线程池；
+                  为None时单独创建
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.length_ratio = length_ratio
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens or max_batch_size * MAX_INPUT_LENGTH
+        self.queue = asyncio.Queue()
+        # 推理在专用线程中执行，事件循环保持响应
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+        self.batches = 0
+        self.sentences = 0
+
+    async def translate(self, sentence, profile=DEFAULT_PROFILE):
+        """提交一个句子，等待其译文"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sentence, profile, future))
+        return await future
+
+    async def run(self):
+        """批处理主循环"""
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(items) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # 不同解码策略的句子分别调用generate
+            groups = {}
+            for item in items:
+                groups.setdefault(item[1], []).append(item)
+            for profile, group in groups.items():
+                await self.run_group(loop, profile, group)
+
+    async def run_group(self, loop, profile, items):
+        """在推理线程中翻译一组使用相同解码策略的句子"""
+        sentences = [sentence for sentence, _, _ in items]
+        try:
+            results = await loop.run_in_executor(
+                self.executor, lambda: translate_sentences(
+                    sentences, self.model, self.tokenizer, self.device,
+                    max_batch_size=self.max_batch_size, max_batch_tokens=self.max_batch_tokens,
+                    length_ratio=self.length_ratio, **get_generate_kwargs(profile)
+                )
+            )
+        except Exception as e:
+            for _, _, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.sentences += len(items)
+        for (_, _, future), result in zip(items, results):
+            if not future.done():
+                future.set_result(result)
+
+class TranslationServer:
+    """极简的HTTP/1.1翻译服务，只依赖标准库asyncio"""
+
+    def __init__(self, batchers, default_profile=DEFAULT_PROFILE):
+        """
+        batchers: 翻译方向到MicroBatcher的字典
+        default_profile: 请求未指定解码策略时使用的策略
+        """
+        self.batchers = batchers
+        self.default_profile = default_profile
+        self.requests = 0
+        self.start_time = time.time()
+
+    async def translate(self, text, direction, profile):
+        """按句切分后并发提交给对应方向的批处理器"""
+        sentences = split_sentences(text)
+        batcher = self.batchers[direction]
+        results = await asyncio.gather(*(batcher.translate(s, profile) for s in sentences))
+        return " ".join(r for r in results if r)
+
+    def stats(self):
+        """服务运行统计"""
+        return {
+            "requests": self.requests,
+            "uptime": round(time.time() - self.start_time, 1),
+            "directions": {
+                direction: {
+                    "batches": b.batches,
+                    "sentences": b.sentences,
+                    "avg_batch_size": round(b.sentences / b.batches, 2) if b.batches else 0.0,
+                }
+                for direction, b in self.batchers.items()
+            },
+        }
+
+    async def handle_request(self, method, path, body):
+        """处理一个请求，返回(状态码, 响应对象)"""
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok", "directions": sorted(self.batchers)}
+        if method == "GET" and path == "/stats":
+            return 200, self.stats()
+        if method != "POST" or path != "/translate":
+            return 404, {"error": "not found"}
+
+        try:
+            payload = json.loads(body.decode("utf-8"))
+            text = payload["text"]
+            direction = payload.get("direction", "EN").upper()
+            profile = payload.get("profile", self.default_profile)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return 400, {"error": "请求体应为JSON: {\"text\": ..., \"direction\": \"EN\"|\"CN\"}"}
+        if not isinstance(text, str):
+            return 400, {"error": "text应为字符串"}
+        if direction not in self.batchers:
+            return 400, {"error": f"不支持的翻译方向: {direction}"}
+        if not isinstance(profile, str) or profile not in DECODING_PROFILES:
+            return 400, {"error": f"不支持的解码策略: {profile}"}
+
+        self.requests += 1
+        try:
+            translation = await self.translate(text, direction, profile)
+        except Exception as e:
+            return 500, {"error": f"翻译出错: {str(e)}"}
+        return 200, {"translation": translation, "direction": direction}
+
+    async def handle_connection(self, reader, writer):
+        """处理一个HTTP连接（支持keep-alive）"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                except ValueError:
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                # 请求体无效或过大时不读取请求体，响应后关闭连接
+                length = headers.get("content-length", "") or "0"
+                body_read = False
+                if not (length.isascii() and length.isdigit()):
+                    status, response = 400, {"error": "Content-Length无效"}
+                elif int(length) > MAX_BODY_SIZE:
+                    status, response = 413, {"error": "请求体过大"}
+                else:
+                    length = int(length)
+                    body = await reader.readexactly(length) if length else b""
+                    body_read = True
+                    status, response = await self.handle_request(method, path, body)
+
+                data = json.dumps(response, ensure_ascii=False).encode("utf-8")
+                keep_alive = headers.get("connection", "").lower() != "close" and body_read
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json; charset=utf-8\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1")
+                    + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="本地HTTP翻译服务（动态微批处理）")
+    parser.add_argument("-m", "--model", choices=["1", "2"], default="1",
+                        help="模型类型：1小数据量模型，2全量数据模型")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=8000, help="监听端口")
+    parser.add_argument("--batch-window", type=float, default=10.0, help="合并请求的时间窗口（毫秒）")
+    parser.add_argument("--max-batch-size", type=int, default=32, help="每批最多包含的句子数")
+    parser.add_argument("--max-batch-tokens", type=int, default=None,
+                        help="每次generate填充后的最大token数，超出时一批拆成多次generate（默认不限制）")
+    parser.add_argument("--threads", type=int, default=None, help="PyTorch线程数")
+    parser.add_argument("-p", "--profile", choices=DECODING_PROFILES, default=DEFAULT_PROFILE,
+                        help="默认解码策略（请求中可用profile字段指定）")
+    parser.add_argument("--int8", action="store_true", help="使用CPU INT8动态量化模型")
+    parser.add_argument("--backend", choices=BACKENDS, default="pytorch",
+                        help="推理后端：pytorch或onnx（onnxruntime CPU）")
+    return parser.parse_args()
+
+async def serve(args):
+    batchers = {}
+    # 两个方向共用一个推理线程，同一时刻只有一次generate使用PyTorch的算子线程池
+    executor = ThreadPoolExecutor(max_workers=1)
+    for direction in ("EN", "CN"):
+        model_path = MODEL_PATHS[(args.model, direction)]
+        if not os.path.exists(model_path):
+            print(f"跳过不存在的模型: {model_path}")
+            continue
+        print(f"正在加载模型: {model_path}")
+        model, tokenizer, device = load_model(model_path, quantize=args.int8, backend=args.backend)
+        batchers[direction] = MicroBatcher(
+            model, tokenizer, device,
+            batch_window=args.batch_window / 1000, max_batch_size=args.max_batch_size,
+            max_batch_tokens=args.max_batch_tokens,
+            length_ratio=load_length_ratio(model_path, tokenizer, direction), executor=executor
+        )
+
+    if not batchers:
+        print("没有可用的模型，请先运行训练脚本")
+        return 1
+
+    server = TranslationServer(batchers, args.profile)
+    tasks = [asyncio.create_task(b.run()) for b in batchers.values()]
+    http_server = await asyncio.start_server(server.handle_connection, args.host, args.port)
+    print(f"翻译服务已启动: http://{args.host}:{args.port}  （方向: {', '.join(sorted(batchers))}）")
+    try:
+        async with http_server:
+            await http_server.serve_forever()
+    finally:
+        for task in tasks:
+            task.cancel()
+        executor.shutdown(wait=False)
+    return 0
+
+def main():
+    args = parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    try:
+        return asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        print("\n翻译服务已停止")
+        return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,42 @@
 # 翻译器
 import os
+import argparse
 import torch
-from transformers import MarianMTModel, MarianTokenizer
+from transformers import MarianMTModel
+from fast_tokenizer import load_tokenizer, encode_batch
+from translation_cache import TranslationCache
+from translation_metrics import TranslationStats, METRICS, measure, timed_generate
+from speculative_decoding import SpeculativeMarianModel
+from vocab_shortlist import load_shortlist, shortlist_scope, supports_shortlist
+from translation_engine import (
+    get_generate_kwargs, load_length_ratio, max_new_tokens_for, pad_batch, MAX_INPUT_LENGTH,
+    DECODING_PROFILES, PROFILE_NAMES, DEFAULT_LENGTH_RATIO
+)
 
-def load_model(model_path):
+# 命令行翻译在解码策略之外使用的生成参数
+# 最大生成长度不再固定，而是按源句长度和语料上测得的长度比例计算
+EXTRA_GENERATE_KWARGS = {
+    "no_repeat_ngram_size": 2,    # 避免重复的n-gram
+    "length_penalty": 1.0,        # 长度惩罚
+    "min_length": 1               # 最小生成长度
+}
+DEFAULT_CLI_PROFILE = "quality"   # 默认使用完整束搜索
+
+def load_model(model_path, backend="pytorch"):
     """
     加载本地训练好的模型
     model_path: 本地模型路径
+    backend: 推理后端，"pytorch"或"onnx"（onnxruntime CPU）
     """
     if os.path.exists(model_path):
+        if backend == "onnx":
+            from onnx_backend import OnnxMarianModel
+            model = OnnxMarianModel(model_path)
+            tokenizer = load_tokenizer(model_path)
+            return model, tokenizer, model.device
+        
         model = MarianMTModel.from_pretrained(model_path)
-        tokenizer = MarianTokenizer.from_pretrained(model_path)
+        tokenizer = load_tokenizer(model_path)
         
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         model = model.to(device)
@@ -18,40 +44,81 @@ def load_model(model_path):
     else:
         raise FileNotFoundError(f"模型路径不存在: {model_path}")
 
-def translate_text(text, model, tokenizer, device):
-    """翻译文本"""
+def translate_text(text, model, tokenizer, device, cache=None, cache_scope=None,
+                   profile=DEFAULT_CLI_PROFILE, length_ratio=DEFAULT_LENGTH_RATIO, stats=None, shortlist=None):
+    """
+    翻译文本
+    cache: 翻译缓存（TranslationCache），为None时不使用缓存
+    cache_scope: 缓存作用域 (模型指纹, 翻译方向)
+    profile: 解码策略（fast/balanced/quality）
+    length_ratio: 译文与源句的token数之比，用于计算最大生成长度
+    stats: TranslationStats，不为None时记录各阶段耗时、token数和缓存命中
+    shortlist: VocabShortlist，不为None时只对候选token计算lm_head投影
+    """
     # 确保文本不为空
     if not text.strip():
         return ""
     
-    # 对输入进行预处理，防止生成重复翻译
-    inputs = tokenizer(text, return_tensors="pt", padding=True).to(device)
-    
-    # 设置生成参数，避免重复
-    translated = model.generate(
-        **inputs,
-        num_beams=5,               # 使用更大的搜索空间
-        no_repeat_ngram_size=2,    # 避免重复的n-gram
-        length_penalty=1.0,        # 长度惩罚
-        max_length=50,             # 最大生成长度
-        min_length=1               # 最小生成长度
-    )
-    
-    translated_text = tokenizer.decode(translated[0], skip_special_tokens=True)
-    
-    # 移除可能的重复
-    words = translated_text.split()
-    if len(words) > 1:
-        clean_words = []
-        for i, word in enumerate(words):
-            # 如果当前词与前一个词不同，或者这是第一个词，则保留
-            if i == 0 or word != words[i-1]:
-                clean_words.append(word)
-        translated_text = " ".join(clean_words)
+    generate_kwargs = get_generate_kwargs(profile, **EXTRA_GENERATE_KWARGS)
+    cache_kwargs = dict(generate_kwargs, length_ratio=length_ratio)
+    if shortlist is not None:
+        cache_kwargs["shortlist"] = shortlist.fingerprint
+    if stats is not None:
+        stats.sentences += 1
+    
+    # 优先从翻译缓存中获取
+    if cache is not None:
+        cache_key = cache.make_key(cache_scope, cache_kwargs, text)
+        cached = cache.get(cache_key)
+        if stats is not None:
+            stats.cache_hits += cached is not None
+            stats.cache_misses += cached is None
+        if cached is not None:
+            return cached
+    
+    # 对输入进行预处理，防止生成重复翻译（重复输入的句子直接使用token id缓存）
+    with measure(stats, "tokenize"):
+        inputs = pad_batch(encode_batch(tokenizer, [text], MAX_INPUT_LENGTH), tokenizer.pad_token_id, device)
+    
+    # 设置生成参数，避免重复；最大生成长度随源句长度变化，长句不会被截断
+    max_new_tokens = max_new_tokens_for(inputs["input_ids"].shape[1], length_ratio)
+    with shortlist_scope(shortlist, model, inputs):
+        translated = timed_generate(model, inputs, stats, max_new_tokens=max_new_tokens, **generate_kwargs)
+    
+    with measure(stats, "detokenize"):
+        translated_text = tokenizer.decode(translated[0], skip_special_tokens=True)
+        
+        # 移除可能的重复
+        words = translated_text.split()
+        if len(words) > 1:
+            clean_words = []
+            for i, word in enumerate(words):
+                # 如果当前词与前一个词不同，或者这是第一个词，则保留
+                if i == 0 or word != words[i-1]:
+                    clean_words.append(word)
+            translated_text = " ".join(clean_words)
+    
+    if cache is not None:
+        cache.put(cache_key, text, translated_text)
     
     return translated_text
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="英汉双向翻译器（命令行）")
+    parser.add_argument("--timing", action="store_true",
+                        help="每次翻译后输出各阶段耗时（分词、编码器、解码、反分词）、token数和缓存命中")
+    parser.add_argument("--metrics-file", default=None,
+                        help="每次翻译后把累计指标导出到该文件（.json为JSON格式，其余为Prometheus文本格式）")
+    parser.add_argument("--trace-dir", default=None, help="为每次generate导出torch profiler跟踪文件到该目录")
+    parser.add_argument("--draft", action="store_true",
+                        help="用小数据量模型作为草稿模型进行推测解码，译文与全量模型贪心解码相同（仅全量数据模型、PyTorch后端）")
+    parser.add_argument("--shortlist", action="store_true",
+                        help="使用模型目录中的词表裁剪表（vocab_shortlist.py构建）加速解码（仅PyTorch后端）")
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+    
     # 检查GPU是否可用
     gpu_available = torch.cuda.is_available()
     device_name = torch.cuda.get_device_name(0) if gpu_available else "CPU"
@@ -107,9 +174,53 @@ def main():
                 model_path = zh_en_full_path
                 print("使用全量数据训练模型")
         
+        # 选择推理后端
+        print("\n请选择推理后端:")
+        print("1: PyTorch")
+        print("2: ONNX Runtime (CPU)")
+        backend_choice = input("请选择推理后端 (1/2，默认1): ").strip()
+        backend = "onnx" if backend_choice == "2" else "pytorch"
+        
+        # 推测解码需要全量数据模型作为目标模型，且草稿模型和目标模型都在PyTorch上运行
+        use_draft = args.draft
+        if use_draft and (model_choice == "1" or backend == "onnx"):
+            print("推测解码只能用于全量数据模型和PyTorch后端，已关闭")
+            use_draft = False
+        
+        # 选择解码策略（推测解码固定为贪心解码）
+        if use_draft:
+            profile = "fast"
+            print("使用推测解码（贪心解码）")
+        else:
+            print("\n请选择解码策略:")
+            for name in DECODING_PROFILES:
+                print(f"{name}: {PROFILE_NAMES[name]}")
+            profile = input(f"请选择解码策略 (默认{DEFAULT_CLI_PROFILE}): ").strip().lower()
+            if profile not in DECODING_PROFILES:
+                profile = DEFAULT_CLI_PROFILE
+        
         # 加载模型
         try:
-            model, tokenizer, device = load_model(model_path)
+            model, tokenizer, device = load_model(model_path, backend)
+            if use_draft:
+                # 推测解码的译文与贪心解码相同，翻译缓存可以与fast策略共用
+                draft_path = en_zh_small_path if direction == "EN" else zh_en_small_path
+                draft, _, _ = load_model(draft_path)
+                model = SpeculativeMarianModel(model, draft)
+                print(f"草稿模型: {draft_path}")
+            cache = TranslationCache()
+            cache_scope = (cache.model_fingerprint(model_path), direction, backend)
+            length_ratio = load_length_ratio(model_path, tokenizer, direction)
+            shortlist = None
+            if args.shortlist:
+                if not supports_shortlist(model):
+                    print("词表裁剪只能用于PyTorch后端且不能与推测解码同时使用，已关闭")
+                else:
+                    shortlist = load_shortlist(model_path)
+                    if shortlist is None:
+                        print(f"{model_path} 中没有词表裁剪表，请先运行 vocab_shortlist.py --model-path {model_path} -d {direction}")
+                    else:
+                        print(f"使用词表裁剪表（{shortlist.meta.get('pairs', 0)}个句对构建）")
         except Exception as e:
             print(f"加载模型失败: {str(e)}")
             return
@@ -134,8 +245,17 @@ def main():
             if not user_input:
                 continue
                 
-            translated = translate_text(user_input, model, tokenizer, device)
+            stats = TranslationStats(args.trace_dir) if args.timing or args.metrics_file or args.trace_dir else None
+            translated = translate_text(
+                user_input, model, tokenizer, device, cache, cache_scope, profile, length_ratio, stats, shortlist
+            )
             print(f"翻译结果: {translated}")
+            if stats is not None:
+                METRICS.record(stats.finish(), source="cli")
+                if args.timing:
+                    print(stats.report())
+                if args.metrics_file:
+                    METRICS.dump(args.metrics_file)
             
         except EOFError:
             print("\n翻译程序结束，再见！")
@@ -145,6 +265,11 @@ def main():
             break
         except Exception as e:
             print(f"翻译出错: {str(e)}")
+    
+    print(cache.summary())
+    if isinstance(model, SpeculativeMarianModel):
+        print(f"推测解码: {model.stats.summary()}")
+    cache.close()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
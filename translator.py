@@ -1,16 +1,54 @@
+import time
+START_TIME = time.perf_counter()  # 用于统计界面显示前的启动耗时
 import os
-import torch
-from transformers import MarianMTModel, MarianTokenizer
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext
 from tkinter.font import Font
 import threading
-import queue
-import time
-from PIL import Image, ImageTk
 import re
 import sys
 import traceback
+from translation_config import MODEL_PATHS, DECODING_PROFILES, PROFILE_NAMES, DEFAULT_PROFILE
+from translation_cache import TranslationCache
+from translation_scheduler import LatestWinsScheduler, PRIORITY_AUTO, PRIORITY_MANUAL
+from translation_metrics import TranslationStats, METRICS, METRICS_FILE_ENV, TRACE_DIR_ENV
+
+# PyTorch、transformers和翻译引擎导入较慢，在界面显示后由import_ml_stack在后台线程中导入
+torch = None
+
+def import_ml_stack():
+    """
+    导入推理所需的重量级模块并绑定为模块级名称（在后台线程中运行）
+    返回: [(模块名, 导入耗时秒数), ...]
+    """
+    global torch, split_sentences, translate_sentences, translate_sentences_streaming
+    global plan_incremental_update, get_generate_kwargs, load_length_ratio
+    global load_pretrained_model, warm_up_model, load_quantized_model, OnnxMarianModel, ModelRegistry
+    global load_shortlist, supports_shortlist
+    timings = []
+
+    start = time.perf_counter()
+    import torch
+    timings.append(("torch", time.perf_counter() - start))
+
+    start = time.perf_counter()
+    import transformers
+    timings.append(("transformers", time.perf_counter() - start))
+
+    start = time.perf_counter()
+    from translation_engine import (
+        split_sentences, translate_sentences, translate_sentences_streaming, plan_incremental_update,
+        get_generate_kwargs, load_length_ratio, load_pretrained_model, warm_up_model
+    )
+    timings.append(("translation_engine", time.perf_counter() - start))
+
+    start = time.perf_counter()
+    from quantization import load_quantized_model
+    from onnx_backend import OnnxMarianModel
+    from model_registry import ModelRegistry
+    from vocab_shortlist import load_shortlist, supports_shortlist
+    timings.append(("其他模块", time.perf_counter() - start))
+    return timings
 
 class ColorfulTranslatorApp:
     def __init__(self, master):
@@ -24,30 +62,47 @@ class ColorfulTranslatorApp:
         
         # 初始化变量 - 必须在create_widgets之前
         self.auto_translate_var = tk.BooleanVar(value=True)  # 默认开启自动翻译
+        self.streaming_var = tk.BooleanVar(value=False)  # 流式输出（逐句、逐token显示）
+        self.quantize_var = tk.BooleanVar(value=False)  # CPU INT8动态量化
+        self.backend_var = tk.StringVar(value="pytorch")  # 推理后端：pytorch或onnx
+        self.profile_var = tk.StringVar(value=DEFAULT_PROFILE)  # 解码策略
+        self.shortlist_var = tk.BooleanVar(value=False)  # 词表裁剪（需先用vocab_shortlist.py构建）
         self.direction_var = tk.StringVar(value="EN")
         self.model_choice = tk.StringVar(value="1")
         
         # 创建界面组件
         self.create_widgets()
         
-        # 模型缓存
-        self.model_cache = {}
-        self.translation_queue = queue.Queue()
-        self.translation_thread = None
-        self.is_processing = False
-        
-        # 设置性能选项 - 自动使用GPU和FP16（如果可用）
-        self.use_gpu = torch.cuda.is_available()
-        self.use_fp16 = torch.cuda.is_available()
-        
-        # 确保最基本的tokenizer初始化
-        self.ensure_basic_tokenizer()
-        
-        # 初始化模型
-        self.load_model()
-        
-        # 启动后台翻译线程
-        self.start_background_worker()
+        # 模型注册表：在内存预算内缓存模型，超出时按LRU淘汰（导入完成后创建）
+        self.model_registry = None
+        self.ml_ready = False  # PyTorch等模块是否已导入
+        self.loading_models = set()  # 正在后台加载的模型缓存键
+        self.model_ready = False
+        # 翻译调度器：所有翻译都在后台线程中执行，只翻译最新的输入
+        self.scheduler = LatestWinsScheduler()
+        
+        # 翻译记忆缓存（内存LRU + 磁盘SQLite）
+        self.translation_cache = TranslationCache()
+        self.cache_scope = None
+        self.length_ratio = None
+        # 当前模型的词表裁剪表（模型目录中没有时为None），按模型目录缓存
+        self.shortlist = None
+        self.shortlists = {}
+        
+        # 增量翻译状态：上一次的分句结果和逐句译文
+        self.reset_incremental_state()
+        
+        # 性能选项在PyTorch导入后设置 - 自动使用GPU和FP16（如果可用）
+        self.use_gpu = False
+        self.use_fp16 = False
+        
+        # 检查本地模型，不再同步加载后备tokenizer
+        self.check_local_models()
+        
+        # 窗口先显示出来，再在后台导入PyTorch等模块并加载模型
+        self.set_model_ready(False)
+        self.master.after_idle(self.on_window_shown)
+        self.start_ml_import()
     
     def setup_window(self):
         """配置主窗口"""
@@ -295,6 +350,74 @@ class ColorfulTranslatorApp:
         )
         self.auto_translate_check.pack(side=tk.LEFT, padx=20)
         
+        # 流式输出选项：逐句显示译文，句内逐token显示（使用贪心解码）
+        self.streaming_check = tk.Checkbutton(
+            direction_frame,
+            text="流式输出",
+            variable=self.streaming_var,
+            bg="#e6e6fa",
+            font=("Microsoft YaHei", 11)
+        )
+        self.streaming_check.pack(side=tk.LEFT, padx=5)
+        
+        # INT8量化选项：在CPU上使用动态量化模型
+        self.quantize_check = tk.Checkbutton(
+            direction_frame,
+            text="INT8量化(CPU)",
+            variable=self.quantize_var,
+            bg="#e6e6fa",
+            font=("Microsoft YaHei", 11),
+            command=self.on_quantize_changed
+        )
+        self.quantize_check.pack(side=tk.LEFT, padx=5)
+        
+        # ONNX Runtime后端选项
+        self.onnx_check = tk.Checkbutton(
+            direction_frame,
+            text="ONNX加速",
+            variable=self.backend_var,
+            onvalue="onnx",
+            offvalue="pytorch",
+            bg="#e6e6fa",
+            font=("Microsoft YaHei", 11),
+            command=self.on_backend_changed
+        )
+        self.onnx_check.pack(side=tk.LEFT, padx=5)
+        
+        # 词表裁剪选项：只对候选token计算输出层投影（PyTorch FP32模型）
+        self.shortlist_check = tk.Checkbutton(
+            direction_frame,
+            text="词表裁剪",
+            variable=self.shortlist_var,
+            bg="#e6e6fa",
+            font=("Microsoft YaHei", 11),
+            command=self.on_shortlist_changed
+        )
+        self.shortlist_check.pack(side=tk.LEFT, padx=5)
+        
+        # 解码策略
+        profile_frame = tk.Frame(control_panel, bg="#e6e6fa")
+        profile_frame.pack(side=tk.LEFT, padx=10, pady=5)
+        
+        profile_label = tk.Label(
+            profile_frame,
+            text="解码策略:",
+            bg="#e6e6fa",
+            font=("Microsoft YaHei", 11)
+        )
+        profile_label.pack(side=tk.LEFT, padx=(0, 10))
+        
+        for profile in DECODING_PROFILES:
+            tk.Radiobutton(
+                profile_frame,
+                text=PROFILE_NAMES[profile],
+                variable=self.profile_var,
+                value=profile,
+                bg="#e6e6fa",
+                font=("Microsoft YaHei", 11),
+                command=self.on_profile_changed
+            ).pack(side=tk.LEFT, padx=5)
+        
         # 模型选择
         model_frame = tk.Frame(control_panel, bg="#e6e6fa")
         model_frame.pack(side=tk.RIGHT, padx=20, pady=5)
@@ -413,178 +536,241 @@ class ColorfulTranslatorApp:
         # 重新加载选择的模型
         self.load_model()
     
-    def get_model_key(self):
-        """获取当前模型的缓存键"""
+    def on_quantize_changed(self):
+        """INT8量化选项改变时的处理"""
+        status = "开启" if self.quantize_var.get() else "关闭"
+        self.update_status(f"INT8量化已{status}")
+        self.load_model()
+    
+    def on_profile_changed(self):
+        """解码策略改变时的处理"""
+        self.update_status(f"解码策略已切换为{PROFILE_NAMES[self.profile_var.get()]}")
+        if self.auto_translate_var.get():
+            self.translate_text(PRIORITY_AUTO)
+    
+    def on_backend_changed(self):
+        """推理后端改变时的处理"""
+        backend = "ONNX Runtime" if self.backend_var.get() == "onnx" else "PyTorch"
+        self.update_status(f"推理后端已切换为{backend}")
+        self.load_model()
+    
+    def on_shortlist_changed(self):
+        """词表裁剪选项改变时的处理"""
+        if self.shortlist_var.get() and self.model_ready and not self.shortlist_available():
+            self.update_status("当前模型不支持词表裁剪（需要PyTorch FP32模型，并先运行vocab_shortlist.py构建裁剪表）")
+        else:
+            status = "开启" if self.shortlist_var.get() else "关闭"
+            self.update_status(f"词表裁剪已{status}")
+        if self.auto_translate_var.get() and self.model_ready:
+            self.translate_text(PRIORITY_AUTO)
+    
+    def shortlist_available(self):
+        """当前模型是否可以使用词表裁剪"""
+        return self.shortlist is not None and supports_shortlist(self.model)
+    
+    def get_model_variant(self):
+        """当前的模型变体，不同变体的翻译结果分别缓存"""
+        if self.backend_var.get() == "onnx":
+            return "onnx"
+        return "int8" if self.quantize_var.get() else "fp32"
+    
+    def get_model_key(self, direction=None):
+        """获取模型的缓存键，direction为None时使用当前翻译方向"""
         model_choice = self.model_choice.get()
-        direction = self.direction_var.get()
+        direction = direction or self.direction_var.get()
         use_gpu = self.use_gpu
         use_fp16 = self.use_fp16
-        return f"{model_choice}_{direction}_{use_gpu}_{use_fp16}"
+        variant = self.get_model_variant()
+        return f"{model_choice}_{direction}_{use_gpu}_{use_fp16}_{variant}"
     
-    def load_model(self):
-        """加载选定的翻译模型（使用缓存）"""
-        try:
-            small_model_paths = {
-                "EN": "./train_small/en_zh_translator_small",
-                "CN": "./train_small/zh_en_translator_small"
-            }
-            large_model_paths = {
-                "EN": "./train/en_zh_translator",
-                "CN": "./train/zh_en_translator"
-            }
+    def on_window_shown(self):
+        """界面首次显示后记录启动耗时"""
+        print(f"界面已显示，用时{time.perf_counter() - START_TIME:.2f}秒")
 
-            model_choice = self.model_choice.get()
-            direction = self.direction_var.get()
+    def start_ml_import(self):
+        """在后台线程中导入PyTorch、transformers和翻译引擎"""
+        self.update_status("⏳ 正在加载PyTorch和transformers...")
+
+        def worker():
+            try:
+                timings = import_ml_stack()
+                self.master.after(0, lambda: self.on_ml_imported(timings))
+            except Exception as e:
+                traceback.print_exc()
+                self.master.after(0, lambda err=e: self.on_ml_import_failed(err))
 
-            # 确定模型路径
-            if model_choice == "1":  # 小数据训练模型
-                model_path = small_model_paths[direction]
-                model_type = "小数据量模型（测试用）"
-            else:  # 大数据训练模型
-                model_path = large_model_paths[direction]
-                model_type = "全量数据模型（实际应用）"
+        threading.Thread(target=worker, daemon=True).start()
 
-            # 检查是否存在模型
-            if not os.path.exists(model_path):
-                error_msg = f"模型路径不存在: {model_path}"
-                print(error_msg)
-                messagebox.showerror("错误", error_msg)
-                self.update_status("🔴 模型路径不存在")
-                return False
-            
-            # 获取模型缓存键
-            model_key = self.get_model_key()
-            
-            # 检查是否已缓存
-            if model_key in self.model_cache:
-                self.model, self.tokenizer, self.device = self.model_cache[model_key]
-                direction_text = "英译中" if direction == "EN" else "中译英"
-                self.update_status(f"✅ {model_type}已加载({direction_text})")
-                return True
-            else:
-                # 更新状态
-                self.update_status(f"⏳ 正在加载{model_type}...")
-                self.master.update()
-                
-                # 设置设备
-                device_name = "GPU" if self.use_gpu and torch.cuda.is_available() else "CPU"
-                self.device = torch.device("cuda" if self.use_gpu and torch.cuda.is_available() else "cpu")
-                
-                try:
-                    # 加载模型
-                    self.model, self.tokenizer = self.load_model_from_path(model_path, self.device)
-                    
-                    # 缓存模型
-                    self.model_cache[model_key] = (self.model, self.tokenizer, self.device)
-                    
-                    direction_text = "英译中" if direction == "EN" else "中译英"
-                    self.update_status(f"✅ {model_type}加载成功({direction_text}, {device_name})")
-                    return True
-                except Exception as e:
-                    error_msg = f"加载模型失败: {str(e)}"
-                    print(error_msg)
-                    messagebox.showerror("错误", error_msg)
-                    self.update_status("❌ 模型加载失败")
-                    return False
-                
-        except Exception as e:
-            error_msg = f"模型加载错误: {str(e)}"
+    def on_ml_imported(self, timings):
+        """模块导入完成（主线程）：报告各模块耗时，然后加载模型"""
+        self.use_gpu = torch.cuda.is_available()
+        self.use_fp16 = torch.cuda.is_available()
+        self.model_registry = ModelRegistry()
+        self.ml_ready = True
+
+        detail = "，".join(f"{name} {seconds:.2f}s" for name, seconds in timings)
+        print(f"PyTorch版本: {torch.__version__}，CUDA是否可用: {torch.cuda.is_available()}")
+        if torch.cuda.is_available():
+            print(f"CUDA设备: {torch.cuda.get_device_name(0)}")
+        print(f"模块导入耗时: {detail}（启动后{time.perf_counter() - START_TIME:.2f}秒）")
+        self.update_status(f"模块导入完成：{detail}")
+        self.load_model()
+
+    def on_ml_import_failed(self, error):
+        """模块导入失败（主线程）"""
+        messagebox.showerror("启动错误", f"导入PyTorch或transformers失败:\n{str(error)}\n\n请确保已安装所有必要的库和依赖。")
+        self.update_status("❌ 模块导入失败")
+
+    def load_model(self):
+        """
+        切换到当前选择的翻译模型
+        已加载的模型直接启用；否则在后台线程中加载，界面保持响应，加载完成后才允许翻译
+        """
+        if not self.ml_ready:
+            # 模块导入完成后会按当前选择加载模型
+            return False
+        model_choice = self.model_choice.get()
+        direction = self.direction_var.get()
+        model_path = MODEL_PATHS[(model_choice, direction)]
+        model_type = "小数据量模型（测试用）" if model_choice == "1" else "全量数据模型（实际应用）"
+
+        # 检查是否存在模型
+        if not os.path.exists(model_path):
+            error_msg = f"模型路径不存在: {model_path}"
             print(error_msg)
             messagebox.showerror("错误", error_msg)
-            self.update_status("❌ 模型加载错误")
+            self.set_model_ready(False)
+            self.update_status("🔴 模型路径不存在")
             return False
-    
-    def load_model_from_path(self, model_path, device):
-        """从指定路径加载模型"""
-        # 创建进度窗口
-        progress_window = tk.Toplevel(self.master)
-        progress_window.title("加载模型")
-        progress_window.geometry("300x100")
-        progress_window.resizable(False, False)
-        progress_window.transient(self.master)
-        progress_window.grab_set()
-        
-        # 居中显示
-        x = self.master.winfo_rootx() + (self.master.winfo_width() // 2) - 150
-        y = self.master.winfo_rooty() + (self.master.winfo_height() // 2) - 50
-        progress_window.geometry(f"+{x}+{y}")
-        
-        # 添加进度标签
-        progress_label = ttk.Label(progress_window, text="正在加载模型，请稍候...", font=self.subtitle_font)
-        progress_label.pack(pady=10)
-        
-        progress = ttk.Progressbar(progress_window, orient=tk.HORIZONTAL, length=250, mode='indeterminate')
-        progress.pack(pady=10)
-        progress.start(10)
-        
-        # 更新UI
-        self.master.update_idletasks()
-        
+
+        model_key = self.get_model_key()
+        if model_key in self.model_registry:
+            self.activate_model(model_key)
+            return True
+
+        # 新模型就绪之前不能继续使用旧方向的模型翻译
+        self.set_model_ready(False)
+        self.update_status(f"⏳ 正在后台加载{model_type}...")
+        self.start_model_loading(model_key, model_path, direction, self.get_model_variant())
+        return True
+
+    def start_model_loading(self, model_key, model_path, direction, variant):
+        """在后台线程中加载模型；同一模型只加载一次"""
+        if model_key in self.model_registry or model_key in self.loading_models:
+            return
+        self.loading_models.add(model_key)
+
+        def worker():
+            try:
+                entry = self.load_model_from_path(model_path, direction, variant)
+                self.master.after(0, lambda: self.on_model_loaded(model_key, entry))
+            except Exception as e:
+                traceback.print_exc()
+                self.master.after(0, lambda err=e: self.on_model_load_failed(model_key, err))
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def on_model_loaded(self, model_key, entry):
+        """模型加载完成（主线程）：缓存模型，如果仍是当前选择则启用，并预加载另一翻译方向"""
+        self.loading_models.discard(model_key)
+        # 正在使用的模型不会因为预加载而被淘汰
+        active_key = self.get_model_key() if self.model_ready else None
+        self.model_registry.put(model_key, *entry, protected=[k for k in (active_key,) if k])
+        if model_key == self.get_model_key():
+            self.activate_model(model_key)
+            self.preload_other_direction()
+
+    def on_model_load_failed(self, model_key, error):
+        """模型加载失败（主线程）"""
+        self.loading_models.discard(model_key)
+        if model_key != self.get_model_key():
+            # 预加载失败不打扰用户，切换到该方向时会重新加载
+            print(f"预加载模型失败: {str(error)}")
+            return
+        error_msg = f"加载模型失败: {str(error)}"
+        print(error_msg)
+        messagebox.showerror("错误", error_msg)
+        self.update_status("❌ 模型加载失败")
+
+    def activate_model(self, model_key):
+        """启用已加载的模型"""
+        entry = self.model_registry.get(model_key)
+        self.model, self.tokenizer, self.device = entry.model, entry.tokenizer, entry.device
+        self.cache_scope, self.length_ratio = entry.cache_scope, entry.length_ratio
+        if entry.model_path not in self.shortlists:
+            self.shortlists[entry.model_path] = load_shortlist(entry.model_path)
+        self.shortlist = self.shortlists[entry.model_path]
+        model_type = "小数据量模型（测试用）" if self.model_choice.get() == "1" else "全量数据模型（实际应用）"
+        direction_text = "英译中" if self.direction_var.get() == "EN" else "中译英"
+        device_name = {"int8": "CPU INT8", "onnx": "CPU ONNX"}.get(
+            self.get_model_variant(), "GPU" if self.device.type == "cuda" else "CPU"
+        )
+        self.reset_incremental_state()
+        self.set_model_ready(True)
+        self.update_status(
+            f"✅ {model_type}已就绪({direction_text}, {device_name})（{self.model_registry.summary()}）"
+        )
+        if self.auto_translate_var.get() and self.input_text.get("1.0", tk.END).strip():
+            self.translate_text(PRIORITY_AUTO)
+
+    def preload_other_direction(self):
+        """当前模型就绪后，在后台预加载另一翻译方向的同类模型，切换方向时无需等待"""
+        model_choice = self.model_choice.get()
+        direction = "CN" if self.direction_var.get() == "EN" else "EN"
+        model_path = MODEL_PATHS[(model_choice, direction)]
+        if not os.path.exists(model_path):
+            return
+        model_key = self.get_model_key(direction=direction)
+        self.start_model_loading(model_key, model_path, direction, self.get_model_variant())
+
+    def set_model_ready(self, ready):
+        """设置模型是否就绪，未就绪时禁用翻译按钮"""
+        self.model_ready = ready
+        self.translate_button.config(state=tk.NORMAL if ready else tk.DISABLED)
+
+    def load_model_from_path(self, model_path, direction, variant):
+        """
+        从指定路径加载模型（在后台线程中运行，不能访问Tk控件和变量）
+        variant: 模型变体，"onnx"、"int8"或"fp32"
+        返回: (model_path, model, tokenizer, device, cache_scope, length_ratio)
+        """
+        start = time.perf_counter()
+        # INT8动态量化模型和ONNX Runtime后端只在CPU上运行
+        use_cuda = self.use_gpu and variant == "fp32"
+        device = torch.device("cuda" if use_cuda else "cpu")
+
+        # 同一模型目录的各个变体共用一个tokenizer
+        tokenizer = self.model_registry.get_tokenizer(model_path)
         try:
-            # 逐步加载模型以保持UI响应
-            progress_label.config(text="正在加载分词器...")
-            self.master.update_idletasks()
-            tokenizer = MarianTokenizer.from_pretrained(model_path)
-            
-            progress_label.config(text="正在加载模型...")
-            self.master.update_idletasks()
-            
-            # 根据设备和选项加载模型
-            if hasattr(self, 'quantize_var') and getattr(self, 'quantize_var').get() and device.type == 'cpu':
-                # 使用8位量化来减少内存占用
-                from transformers import AutoModelForSeq2SeqLM
-                model = AutoModelForSeq2SeqLM.from_pretrained(
-                    model_path, 
-                    torch_dtype=torch.int8,
-                    device_map="auto",
-                    load_in_8bit=True
-                )
+            if variant == "onnx":
+                # 使用onnxruntime CPU后端（首次使用时自动导出ONNX模型）
+                model = OnnxMarianModel(model_path)
+            elif variant == "int8":
+                # 使用INT8动态量化来减少内存占用和CPU推理延迟（量化结果缓存在模型目录中）
+                model, tokenizer = load_quantized_model(model_path, tokenizer)
             else:
-                model = MarianMTModel.from_pretrained(model_path)
-                model = model.to(device)
-                
+                # safetensors权重通过内存映射加载
+                model = load_pretrained_model(model_path).to(device)
                 # 如果启用了FP16且支持GPU
-                if self.use_fp16 and torch.cuda.is_available() and device.type == 'cuda':
-                    progress_label.config(text="正在优化模型(FP16)...")
-                    self.master.update_idletasks()
+                if self.use_fp16 and use_cuda:
                     model = model.half()  # 转换为FP16
-            
-            return model, tokenizer
-        except Exception as e:
-            print(f"加载模型错误: {str(e)}")
-            import traceback
-            traceback.print_exc()
+                model.eval()
+
+            # 翻译缓存按模型指纹、翻译方向和模型变体区分
+            cache_scope = (self.translation_cache.model_fingerprint(model_path), direction, variant)
+            # 按dataset语料测得的长度比例决定译文最大长度
+            length_ratio = load_length_ratio(model_path, tokenizer, direction)
+
+            # 预热后再标记就绪，第一次翻译不再承担初始化开销
+            warm_up = warm_up_model(model, tokenizer, device, direction)
+            print(f"模型加载完成: {model_path}（{variant}），"
+                  f"用时{time.perf_counter() - start:.2f}秒，其中预热{warm_up:.2f}秒")
+        except BaseException:
+            # 加载失败时释放对共享tokenizer的引用，使其可以被注册表回收
+            self.model_registry.release_tokenizer(model_path)
             raise
-        finally:
-            # 关闭进度窗口
-            progress_window.destroy()
-    
-    def start_background_worker(self):
-        """启动后台翻译线程"""
-        def worker():
-            while True:
-                try:
-                    # 从队列中获取翻译任务
-                    text, callback = self.translation_queue.get(block=True)
-                    self.is_processing = True
-                    
-                    # 执行翻译，注意：不要调用translate_text方法，避免递归
-                    result = self.perform_batch_translation(text)
-                    
-                    # 在主线程中更新UI
-                    self.master.after(0, lambda r=result: callback(r))
-                    
-                    self.is_processing = False
-                    self.translation_queue.task_done()
-                except Exception as e:
-                    self.master.after(0, lambda: self.update_status(f"🔴 翻译出错: {str(e)}"))
-                    self.is_processing = False
-                    self.translation_queue.task_done()
-        
-        # 创建并启动线程
-        self.translation_thread = threading.Thread(target=worker, daemon=True)
-        self.translation_thread.start()
-    
+        return model_path, model, tokenizer, device, cache_scope, length_ratio
+
     def on_input_changed(self, event=None):
         """当输入文本变化时调用"""
         # 正确方式重置修改标志
@@ -593,8 +779,8 @@ class ColorfulTranslatorApp:
         if not self.auto_translate_var.get():
             return
         
-        # 如果模型未加载或正在处理，则返回
-        if not hasattr(self, 'model') or not hasattr(self, 'tokenizer') or self.is_processing:
+        # 如果模型未加载，则返回（正在翻译时新的输入会取代旧的翻译请求）
+        if not self.model_ready:
             return
             
         # 获取当前输入文本
@@ -607,7 +793,7 @@ class ColorfulTranslatorApp:
             self.master.after_cancel(self._translate_after_id)
         
         # 0.8秒后执行翻译，提供更快响应
-        self._translate_after_id = self.master.after(800, self.translate_text)
+        self._translate_after_id = self.master.after(800, lambda: self.translate_text(PRIORITY_AUTO))
     
     def on_auto_translate_toggle(self):
         """自动翻译选项切换时的回调函数"""
@@ -616,95 +802,230 @@ class ColorfulTranslatorApp:
         
         # 如果开启了自动翻译，立即执行一次翻译
         if self.auto_translate_var.get():
-            self.translate_text()
+            self.translate_text(PRIORITY_AUTO)
     
-    def translate_text(self):
-        """执行翻译操作"""
+    def translate_text(self, priority=PRIORITY_MANUAL):
+        """
+        提交翻译请求（只重新翻译发生变化的句子）
+        翻译在调度器的后台线程中执行，新的请求会取代尚未完成的旧请求
+        priority: 请求优先级，按钮触发为手动翻译，其余为自动翻译
+        """
         input_text = self.input_text.get("1.0", tk.END).strip()
         if not input_text:
             self.update_status("请先输入文本")
             return
         
-        self.update_status("正在翻译...")
-        self.translate_button.config(state=tk.DISABLED)
-        self.output_text.config(state=tk.NORMAL)
-        self.output_text.delete("1.0", tk.END)
+        if not self.model_ready:
+            # 模型在后台加载，加载完成后会自动翻译当前输入
+            self.update_status("⏳ 模型加载中，请稍候...")
+            return
         
-        try:
-            # 获取当前的翻译方向和模型类型
-            direction = self.direction_var.get()
-            model_type = self.model_choice.get()
-            
-            # 执行翻译
-            if hasattr(self, 'model') and hasattr(self, 'tokenizer'):
-                result = self.perform_batch_translation(input_text)
-                self.output_text.insert(tk.END, result.strip())
-                self.update_status("翻译完成")
-            else:
-                self.output_text.insert(tk.END, "翻译模型未加载")
-                self.update_status("模型未加载")
-        except Exception as e:
-            self.output_text.insert(tk.END, f"翻译错误: {str(e)}")
-            self.update_status("翻译失败")
-            print(f"翻译错误: {str(e)}")
-            traceback.print_exc()
-        finally:
-            self.output_text.config(state=tk.DISABLED)
-            self.translate_button.config(state=tk.NORMAL)
-    
-    def perform_batch_translation(self, input_text):
-        """将长文本分批翻译"""
-        if not input_text.strip():
-            return ""
-            
-        # 将长文本分段处理以避免超出最大长度限制
-        max_length = 512  # 假设最大长度为512个token
-        result = ""
+        sentences = split_sentences(input_text)
         
-        # 简单处理：按句子分段
-        sentences = re.split(r'(?<=[.!?。！？])\s+', input_text)
-        batch = ""
+        # 模型、方向或解码策略变化后，旧译文不可复用
+        if self.last_scope != self.current_scope():
+            results, changed = plan_incremental_update([], [], sentences)
+        else:
+            results, changed = plan_incremental_update(self.last_sentences, self.last_results, sentences)
+        
+        # 请求之间的取代只由调度器按优先级决定：自动翻译不会取消进行中的手动翻译，而是排在它之后；
+        # stream_id只在切换模型或方向时变化，使之前所有请求的界面回调作废
+        stream_id = self.stream_id
+        request = None
+        
+        def is_current():
+            return stream_id == self.stream_id and request is not None and not request.is_cancelled()
+        
+        if self.streaming_var.get():
+            request = self.start_streaming_translation(is_current, sentences, results, changed, priority)
+            return
         
-        for sentence in sentences:
-            if len(batch) + len(sentence) < max_length:
-                batch += " " + sentence if batch else sentence
+        if changed:
+            self.update_status("正在翻译...")
+        # 后台线程不能访问Tk变量，先取出本次翻译需要的全部状态
+        model, tokenizer, device = self.model, self.tokenizer, self.device
+        kwargs = self.translation_kwargs()
+        stats = TranslationStats(os.environ.get(TRACE_DIR_ENV))
+        
+        def job(is_cancelled):
+            # 没有变化的句子时同样经过调度器，不会覆盖进行中的手动翻译的结果
+            if not changed:
+                return []
+            return translate_sentences(
+                [sentences[i] for i in changed], model, tokenizer, device,
+                should_stop=lambda: is_cancelled() or self.stream_id != stream_id, stats=stats, **kwargs
+            )
+        
+        request = self.scheduler.submit(
+            job, priority,
+            on_done=lambda translated: self.master.after(
+                0, lambda: self.finish_translation(
+                    is_current, sentences, results, changed, translated, stats if changed else None
+                )
+            ),
+            on_error=lambda e: self.master.after(0, lambda: self.on_translation_error(is_current, e))
+        )
+    
+    def finish_translation(self, is_current, sentences, results, changed, translated, stats=None):
+        """在主线程中写入翻译结果，已被新请求取代的结果直接丢弃"""
+        if not is_current():
+            return
+        for i, text in zip(changed, translated):
+            results[i] = text
+        self.last_scope = self.current_scope()
+        self.last_sentences = sentences
+        self.last_results = results
+        self.replace_output_text(" ".join(r for r in results if r).strip())
+        timing = f"，{self.record_stats(stats)}" if stats is not None else ""
+        self.update_status(
+            f"翻译完成，更新{len(changed)}/{len(sentences)}句{timing}（{self.translation_cache.summary()}）"
+        )
+    
+    def record_stats(self, stats):
+        """结束一次翻译的性能统计：计入全局指标、输出详细报告，返回状态栏摘要"""
+        METRICS.record(stats.finish(), source="gui")
+        print(stats.report())
+        metrics_file = os.environ.get(METRICS_FILE_ENV)
+        if metrics_file:
+            try:
+                METRICS.dump(metrics_file)
+            except OSError as e:
+                print(f"导出性能指标失败: {str(e)}")
+        return stats.summary()
+    
+    def on_translation_error(self, is_current, error):
+        """在主线程中报告翻译错误"""
+        if not is_current():
+            return
+        print(f"翻译错误: {str(error)}")
+        traceback.print_exception(type(error), error, error.__traceback__)
+        self.replace_output_text(f"翻译错误: {str(error)}")
+        self.reset_incremental_state()
+        self.update_status("翻译失败")
+    
+    def translation_kwargs(self):
+        """当前解码策略的生成参数，以及翻译缓存和长度比例"""
+        return dict(
+            get_generate_kwargs(self.profile_var.get()),
+            cache=self.translation_cache,
+            cache_scope=self.cache_scope,
+            length_ratio=self.length_ratio,
+            shortlist=self.shortlist if self.shortlist_var.get() else None
+        )
+    
+    def current_scope(self):
+        """增量翻译状态的作用域：模型、方向、解码策略和词表裁剪"""
+        return (self.cache_scope, self.profile_var.get(), self.shortlist_var.get() and self.shortlist_available())
+    
+    def reset_incremental_state(self):
+        """清空增量翻译状态，下次翻译将处理全部句子"""
+        self.last_scope = None
+        self.last_sentences = []
+        self.last_results = []
+        # 翻译请求编号，变化后之前所有请求的界面回调全部作废
+        self.stream_id = getattr(self, 'stream_id', 0) + 1
+    
+    def start_streaming_translation(self, is_current, sentences, results, changed, priority):
+        """
+        在调度器线程中逐句流式翻译发生变化的句子，通过master.after更新输出框
+        请求开始执行时才替换增量翻译状态，排在手动翻译之后的自动翻译不会打乱其输出
+        返回: 调度器中的TranslationRequest
+        """
+        stream_id = self.stream_id
+        model, tokenizer, device = self.model, self.tokenizer, self.device
+        kwargs = self.translation_kwargs()
+        stats = TranslationStats(os.environ.get(TRACE_DIR_ENV))
+        
+        def on_partial(k, text):
+            self.master.after(0, lambda: self.update_stream_sentence(is_current, changed[k], text, False, len(changed)))
+        
+        def on_sentence(k, text):
+            self.master.after(0, lambda: self.update_stream_sentence(is_current, changed[k], text, True, len(changed)))
+        
+        def job(is_cancelled):
+            # master.after按提交顺序执行，状态总是在本请求的译文更新之前替换
+            self.master.after(0, lambda: self.begin_streaming(is_current, sentences, results, changed, stats))
+            if changed:
+                translate_sentences_streaming(
+                    [sentences[i] for i in changed], model, tokenizer, device,
+                    on_sentence, on_partial,
+                    should_stop=lambda: is_cancelled() or self.stream_id != stream_id,
+                    stats=stats, **kwargs
+                )
+        
+        return self.scheduler.submit(
+            job, priority,
+            on_error=lambda e: self.master.after(0, lambda: self.on_translation_error(is_current, e))
+        )
+    
+    def begin_streaming(self, is_current, sentences, results, changed, stats):
+        """在主线程中开始显示一次流式翻译"""
+        if not is_current():
+            return
+        self.last_scope = self.current_scope()
+        self.last_sentences = sentences
+        self.last_results = results
+        self.stream_done = 0
+        self.stream_stats = stats
+        self.render_stream_output()
+        if changed:
+            self.update_status("正在翻译...")
+        else:
+            self.update_status(f"翻译完成，更新0/{len(sentences)}句")
+    
+    def update_stream_sentence(self, is_current, index, text, final, total):
+        """在主线程中更新一句流式译文"""
+        if not is_current():
+            return
+        # 未完成的句子保持为None，被打断时下次翻译会重新处理
+        if final:
+            self.last_results[index] = text
+            self.stream_done += 1
+            self.render_stream_output()
+            if self.stream_done == total:
+                timing = self.record_stats(self.stream_stats)
+                self.update_status(
+                    f"翻译完成，更新{total}/{len(self.last_sentences)}句，{timing}（{self.translation_cache.summary()}）"
+                )
             else:
-                # 翻译当前批次
-                partial_result = self.perform_translation(batch)
-                result += partial_result + " "
-                # 开始新批次
-                batch = sentence
-        
-        # 翻译最后一个批次
-        if batch:
-            partial_result = self.perform_translation(batch)
-            result += partial_result
-            
-        return result.strip()
+                self.update_status(f"正在翻译... {self.stream_done}/{total}")
+        else:
+            self.render_stream_output(index, text)
     
-    def perform_translation(self, text):
-        """执行实际的翻译操作"""
-        if not text.strip():
-            return ""
-            
+    def render_stream_output(self, partial_index=None, partial_text=""):
+        """按原句顺序拼接已完成的译文和当前句的部分译文"""
+        parts = []
+        for i, result in enumerate(self.last_results):
+            if i == partial_index:
+                result = partial_text
+            if result:
+                parts.append(result)
+        self.replace_output_text(" ".join(parts))
+    
+    def replace_output_text(self, new_text):
+        """只替换输出框中与新译文不同的部分，保留未变化的内容和滚动位置"""
+        self.output_text.config(state=tk.NORMAL)
         try:
-            # 使用当前模型和tokenizer进行翻译
-            inputs = self.tokenizer(text, return_tensors="pt", padding=True, truncation=True, max_length=512)
+            old_text = self.output_text.get("1.0", "end-1c")
+            if old_text == new_text:
+                return
             
-            # 将输入移动到正确的设备
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+            # 计算公共前缀和公共后缀
+            prefix = 0
+            limit = min(len(old_text), len(new_text))
+            while prefix < limit and old_text[prefix] == new_text[prefix]:
+                prefix += 1
+            suffix = 0
+            limit -= prefix
+            while suffix < limit and old_text[-1 - suffix] == new_text[-1 - suffix]:
+                suffix += 1
             
-            # 生成翻译
-            with torch.no_grad():
-                output = self.model.generate(**inputs)
-            
-            # 解码结果
-            result = self.tokenizer.decode(output[0], skip_special_tokens=True)
-            return result
-        except Exception as e:
-            print(f"翻译过程中出错: {str(e)}")
-            traceback.print_exc()
-            return f"[翻译错误: {str(e)}]"
+            start = f"1.0 + {prefix} chars"
+            end = f"1.0 + {len(old_text) - suffix} chars"
+            self.output_text.delete(start, end)
+            self.output_text.insert(start, new_text[prefix:len(new_text) - suffix])
+        finally:
+            self.output_text.config(state=tk.DISABLED)
     
     def clear_input(self):
         """清空输入文本框"""
@@ -726,61 +1047,20 @@ class ColorfulTranslatorApp:
         self.status_bar.config(text=message)
         self.master.update_idletasks()
     
-    def ensure_basic_tokenizer(self):
-        """确保至少有一个基本的tokenizer可用，作为后备"""
-        try:
-            # 添加一个简单的后备tokenizer
-            from transformers import MarianTokenizer
-            
-            print("正在初始化基本tokenizer...")
-            
-            # 尝试从本地加载
-            model_paths = [
-                "./train_small/en_zh_translator_small",
-                "./train_small/zh_en_translator_small",
-                "./train/en_zh_translator",
-                "./train/zh_en_translator"
-            ]
-            
-            # 检查是否存在本地模型
-            model_exists = False
-            for path in model_paths:
-                if os.path.exists(path):
-                    print(f"找到本地模型: {path}")
-                    try:
-                        self.tokenizer = MarianTokenizer.from_pretrained(path)
-                        print("基本tokenizer初始化成功")
-                        model_exists = True
-                        break
-                    except Exception as e:
-                        print(f"从{path}加载tokenizer失败: {str(e)}")
-            
-            if not model_exists:
-                print("未找到本地模型，将使用最小功能集")
-                # 创建一个简单的替代tokenizer
-                self.tokenizer = None  # 暂无可用tokenizer
-                messagebox.showwarning("警告", "未找到预训练模型，某些功能可能不可用")
-                
-        except Exception as e:
-            print(f"初始化基本tokenizer失败: {str(e)}")
-            import traceback
-            traceback.print_exc()
+    def check_local_models(self):
+        """检查是否存在本地模型，一个都没有时给出警告"""
+        existing = [path for path in MODEL_PATHS.values() if os.path.exists(path)]
+        for path in existing:
+            print(f"找到本地模型: {path}")
+        if not existing:
+            print("未找到本地模型，将使用最小功能集")
+            messagebox.showwarning("警告", "未找到预训练模型，某些功能可能不可用")
 
 if __name__ == "__main__":
     try:
-        # 预加载部分模块以减少启动时间
-        import threading
-        import torch
-        import os
-        import sys
-        import traceback
-        
+        # PyTorch等重量级模块在界面显示后于后台线程中导入，见import_ml_stack
         print("正在启动英汉双向神经机器翻译系统...")
         print(f"Python版本: {sys.version}")
-        print(f"PyTorch版本: {torch.__version__}")
-        print(f"CUDA是否可用: {torch.cuda.is_available()}")
-        if torch.cuda.is_available():
-            print(f"CUDA设备: {torch.cuda.get_device_name(0)}")
         
         # 检查关键目录
         required_dirs = ["train_small", "train"]
@@ -0,0 +1,296 @@
+# 词表裁剪（lexical shortlist）
+# 目的：解码时每一步都要把隐状态投影到整个词表（opus-mt约6.5万个token），而一个句子的译文只会用到其中很少一部分。
+# 离线在dataset平行语料上用IBM Model 1（EM词对齐）估计词汇翻译概率p(t|s)，为每个源token保留概率最高的候选；
+# 推理时只对“源句各token的候选 + 高频token + 源句token本身”计算lm_head投影，其余token的logits为-inf
+# 用法示例：
+#   python vocab_shortlist.py --model-path ./train/en_zh_translator --direction EN            # 构建并评估
+#   python vocab_shortlist.py --model-path ./train/en_zh_translator --direction EN --rebuild  # 重新构建
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from collections import Counter
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+
+SHORTLIST_FILE = "shortlist.npz"  # 保存在模型目录中
+DEFAULT_TOP_K = 50                # 每个源token保留的候选数
+DEFAULT_FREQUENT = 200            # 始终保留的高频目标token数
+MIN_PROBABILITY = 1e-3            # 翻译概率低于该值的候选视为噪声
+EM_ITERATIONS = 5                 # IBM Model 1的EM迭代次数
+TRAIN_RATIO = 0.9                 # 与训练脚本的划分一致：前90%用于构建，后10%用于评估
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dataset")
+
+def corpus_paths(direction, data_dir=DATA_DIR):
+    """翻译方向对应的(源语言文件, 目标语言文件)"""
+    en, zh = os.path.join(data_dir, "data.en"), os.path.join(data_dir, "data.zh")
+    return (en, zh) if direction == "EN" else (zh, en)
+
+def read_parallel(direction, data_dir=DATA_DIR):
+    """读取平行语料，返回(源句列表, 译文列表)，去掉任一侧为空的句对"""
+    source_path, target_path = corpus_paths(direction, data_dir)
+    with open(source_path, "r", encoding="utf-8") as f:
+        sources = [line.strip() for line in f]
+    with open(target_path, "r", encoding="utf-8") as f:
+        targets = [line.strip() for line in f]
+    pairs = [(s, t) for s, t in zip(sources, targets) if s and t]
+    return [s for s, _ in pairs], [t for _, t in pairs]
+
+class VocabShortlist:
+    """源token -> 候选目标token的词表裁剪表"""
+
+    def __init__(self, offsets, candidates, frequent, special, meta):
+        """
+        offsets: 长度为词表大小+1的数组，源token s的候选为candidates[offsets[s]:offsets[s + 1]]
+        candidates: 所有源token的候选目标token
+        frequent: 始终保留的高频目标token
+        special: 始终保留的特殊token（结束token等）
+        meta: 构建参数和语料信息
+        """
+        self.offsets = offsets
+        self.candidates = candidates
+        self.frequent = frequent
+        self.special = special
+        self.meta = meta
+        self.vocab_size = len(offsets) - 1
+        # 参与翻译缓存键，裁剪表不同时译文可能不同
+        self.fingerprint = meta.get("fingerprint", "")
+
+    def token_ids(self, input_ids):
+        """
+        一批源句可以生成的目标token（升序）
+        input_ids: 源句token id张量或数组
+        """
+        source = np.unique(np.asarray(input_ids.cpu() if hasattr(input_ids, "cpu") else input_ids))
+        source = source[(source >= 0) & (source < self.vocab_size)]
+        parts = [self.frequent, self.special, source]
+        parts.extend(self.candidates[self.offsets[s]:self.offsets[s + 1]] for s in source)
+        return np.unique(np.concatenate(parts)).astype(np.int64)
+
+    def save(self, path):
+        np.savez(
+            path, offsets=self.offsets, candidates=self.candidates, frequent=self.frequent,
+            special=self.special, meta=np.array(json.dumps(self.meta))
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["offsets"], data["candidates"], data["frequent"], data["special"],
+                   json.loads(str(data["meta"])))
+
+def lexical_table(source_ids, target_ids, vocab_size, iterations=EM_ITERATIONS):
+    """
+    用IBM Model 1的EM算法在句对上估计词汇翻译概率p(t|s)（与fast_align等词对齐工具输出的词汇表含义相同）
+    每个目标token对齐到源句中的某个token或空token，概率只在同一句对中出现过的(s, t)上估计
+    source_ids / target_ids: 每个句对的源句、译文token id列表
+    返回: (源token数组, 目标token数组, p(t|s)数组)
+    """
+    null = vocab_size  # 空token，吸收没有对应源token的目标token
+    sources, targets, positions = [], [], []
+    position = 0
+    for src, tgt in zip(source_ids, target_ids):
+        src = np.asarray(list(src) + [null], dtype=np.int64)
+        tgt = np.asarray(tgt, dtype=np.int64)
+        # 每个目标位置与源句的每个位置（含空token）组成一个对齐候选
+        sources.append(np.tile(src, len(tgt)))
+        targets.append(np.repeat(tgt, len(src)))
+        positions.append(np.repeat(np.arange(position, position + len(tgt)), len(src)))
+        position += len(tgt)
+    sources, targets, positions = np.concatenate(sources), np.concatenate(targets), np.concatenate(positions)
+    keys, pair_index = np.unique(sources * (vocab_size + 1) + targets, return_inverse=True)
+    pair_source, pair_target = keys // (vocab_size + 1), keys % (vocab_size + 1)
+    del sources, targets
+
+    prob = np.ones(len(keys))
+    for _ in range(iterations):
+        # E步：目标位置对齐到各源位置的后验概率；M步：按期望对齐次数重新估计p(t|s)
+        weights = prob[pair_index]
+        posterior = weights / np.bincount(positions, weights=weights)[positions]
+        counts = np.bincount(pair_index, weights=posterior, minlength=len(keys))
+        totals = np.bincount(pair_source, weights=counts, minlength=vocab_size + 1)
+        prob = counts / totals[pair_source]
+    keep = pair_source != null
+    return pair_source[keep], pair_target[keep], prob[keep]
+
+def build_shortlist(tokenizer, sources, targets, vocab_size, top_k=DEFAULT_TOP_K,
+                    frequent=DEFAULT_FREQUENT, min_prob=MIN_PROBABILITY, iterations=EM_ITERATIONS):
+    """
+    根据词对齐得到的词汇翻译表构建词表裁剪表
+    每个源token s按p(t|s)保留前top_k个、且概率不低于min_prob的目标token t
+    """
+    source_ids = tokenizer(sources, add_special_tokens=False)["input_ids"]
+    target_ids = tokenizer(text_target=targets, add_special_tokens=False)["input_ids"]
+
+    pair_source, pair_target, prob = lexical_table(source_ids, target_ids, vocab_size, iterations)
+    # 按源token分组，组内按概率从高到低排序，概率相同时按token id
+    order = np.lexsort((pair_target, -prob, pair_source))
+    pair_source, pair_target, prob = pair_source[order], pair_target[order], prob[order]
+    rank = np.arange(len(order)) - np.searchsorted(pair_source, pair_source)
+    keep = (rank < top_k) & (prob >= min_prob)
+    candidates = pair_target[keep].astype(np.int32)
+    offsets = np.zeros(vocab_size + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(pair_source[keep], minlength=vocab_size))
+
+    target_count = Counter()
+    for tgt in target_ids:
+        target_count.update(set(tgt))
+    frequent_ids = np.array(sorted(t for t, _ in target_count.most_common(frequent)), dtype=np.int32)
+    special = np.array(sorted({tokenizer.eos_token_id, tokenizer.unk_token_id}), dtype=np.int32)
+    meta = {"method": "ibm1", "iterations": iterations, "top_k": top_k, "frequent": frequent,
+            "min_prob": min_prob, "pairs": len(sources)}
+    meta["fingerprint"] = hashlib.sha256(
+        json.dumps(meta, sort_keys=True).encode("utf-8") + candidates.tobytes() + frequent_ids.tobytes()
+    ).hexdigest()[:16]
+    return VocabShortlist(offsets, candidates, frequent_ids, special, meta)
+
+def load_shortlist(model_path):
+    """加载模型目录中的词表裁剪表，不存在时返回None"""
+    path = os.path.join(model_path, SHORTLIST_FILE)
+    if not os.path.exists(path):
+        return None
+    return VocabShortlist.load(path)
+
+class ShortlistLMHead(torch.nn.Module):
+    """
+    只对候选token计算投影的lm_head，其余token的logits为-inf
+    全词表大小的输出张量按形状复用：非候选位置始终为-inf，每步只写入候选位置，不必每步分配并填充整个词表。
+    返回的张量在下一次调用时会被覆盖（Marian在其上加final_logits_bias，得到的是新张量）
+    """
+
+    def __init__(self, lm_head, token_ids):
+        super().__init__()
+        self.out_features = lm_head.out_features
+        self.token_ids = torch.as_tensor(token_ids, device=lm_head.weight.device)
+        self.weight = lm_head.weight.detach()[self.token_ids].contiguous()
+        self.outputs = {}  # (形状, dtype) -> 复用的输出张量
+
+    def forward(self, hidden_states):
+        logits = torch.nn.functional.linear(hidden_states, self.weight)
+        shape = (*logits.shape[:-1], self.out_features)
+        full = self.outputs.get((shape, logits.dtype))
+        if full is None:
+            full = logits.new_full(shape, -float("inf"))
+            self.outputs[(shape, logits.dtype)] = full
+        full.index_copy_(-1, self.token_ids, logits)
+        return full
+
+def supports_shortlist(model):
+    """只有lm_head为普通Linear的PyTorch模型支持词表裁剪（INT8量化和ONNX模型不支持）"""
+    return isinstance(getattr(model, "lm_head", None), torch.nn.Linear)
+
+class _ShortlistScope:
+    """在一次generate期间把模型的lm_head替换为ShortlistLMHead"""
+
+    def __init__(self, shortlist, model, inputs):
+        self.model = model
+        # 填充位置不是源句token，不参与候选
+        input_ids = inputs["input_ids"][inputs["attention_mask"].bool()]
+        self.head = ShortlistLMHead(model.lm_head, shortlist.token_ids(input_ids))
+
+    def __enter__(self):
+        self.original = self.model.lm_head
+        self.model.lm_head = self.head
+        return self.head
+
+    def __exit__(self, *exc):
+        self.model.lm_head = self.original
+        return False
+
+def shortlist_scope(shortlist, model, inputs):
+    """
+    在with块内对model启用词表裁剪
+    inputs: pad_batch返回的input_ids和attention_mask
+    shortlist为None或模型不支持时不做任何处理
+    """
+    if shortlist is None or not supports_shortlist(model):
+        return nullcontext()
+    return _ShortlistScope(shortlist, model, inputs)
+
+def evaluate(model, tokenizer, device, sources, references, shortlist, direction, **generate_kwargs):
+    """
+    对比使用和不使用词表裁剪的翻译结果和耗时
+    返回: 报告字典
+    """
+    import sacrebleu
+    from translation_engine import translate_sentences
+
+    def run(use_shortlist):
+        start = time.perf_counter()
+        outputs = translate_sentences(
+            sources, model, tokenizer, device, max_batch_size=1, length_ratio=length_ratio,
+            shortlist=shortlist if use_shortlist else None, **generate_kwargs
+        )
+        return outputs, time.perf_counter() - start
+
+    length_ratio = generate_kwargs.pop("length_ratio")
+    # 预热，不计入耗时
+    run(False)
+    run(True)
+    full, full_seconds = run(False)
+    short, short_seconds = run(True)
+
+    tokenize = "zh" if direction == "EN" else "13a"
+    sizes = [len(shortlist.token_ids(ids)) for ids in tokenizer(sources, add_special_tokens=False)["input_ids"]]
+    return {
+        "sentences": len(sources),
+        "vocab_size": shortlist.vocab_size,
+        "mean_shortlist_size": round(float(np.mean(sizes)), 1),
+        "full_seconds": round(full_seconds, 3),
+        "shortlist_seconds": round(short_seconds, 3),
+        "speedup": round(full_seconds / short_seconds, 3),
+        "full_bleu": round(sacrebleu.corpus_bleu(full, [references], tokenize=tokenize).score, 2),
+        "shortlist_bleu": round(sacrebleu.corpus_bleu(short, [references], tokenize=tokenize).score, 2),
+        "identical": sum(a == b for a, b in zip(full, short)),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="构建词表裁剪表，并评估其对翻译速度和BLEU的影响")
+    parser.add_argument("--model-path", required=True, help="模型目录")
+    parser.add_argument("-d", "--direction", choices=["EN", "CN"], required=True, help="翻译方向")
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K, help="每个源token保留的候选数")
+    parser.add_argument("--frequent", type=int, default=DEFAULT_FREQUENT, help="始终保留的高频目标token数")
+    parser.add_argument("--rebuild", action="store_true", help="重新构建已存在的裁剪表")
+    parser.add_argument("--samples", type=int, default=200, help="评估句子数（取自语料最后10%%）")
+    parser.add_argument("--profile", default="fast", help="评估使用的解码策略")
+    args = parser.parse_args()
+
+    from translation_engine import load_model, load_length_ratio, get_generate_kwargs
+
+    model, tokenizer, device = load_model(args.model_path)
+    sources, targets = read_parallel(args.direction)
+    split = int(len(sources) * TRAIN_RATIO)
+
+    path = os.path.join(args.model_path, SHORTLIST_FILE)
+    if args.rebuild or not os.path.exists(path):
+        start = time.perf_counter()
+        shortlist = build_shortlist(
+            tokenizer, sources[:split], targets[:split], model.config.vocab_size, args.top_k, args.frequent
+        )
+        shortlist.save(path)
+        print(f"词表裁剪表已保存到 {path}（{split}个句对，耗时{time.perf_counter() - start:.1f}秒）")
+    else:
+        shortlist = VocabShortlist.load(path)
+        print(f"使用已有的词表裁剪表: {path}")
+    if shortlist.vocab_size != model.config.vocab_size:
+        print("裁剪表与模型词表大小不一致，请使用--rebuild重新构建")
+        return 1
+
+    report = evaluate(
+        model, tokenizer, device, sources[split:][:args.samples], targets[split:][:args.samples], shortlist,
+        args.direction, length_ratio=load_length_ratio(args.model_path, tokenizer, args.direction),
+        **get_generate_kwargs(args.profile)
+    )
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    print(f"平均候选数 {report['mean_shortlist_size']}/{report['vocab_size']}，"
+          f"加速比 {report['speedup']:.2f}x，BLEU {report['full_bleu']} -> {report['shortlist_bleu']}，"
+          f"译文相同 {report['identical']}/{report['sentences']}句")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())